@@ -0,0 +1,16 @@
+"""
+Non-maximum suppression shared by ssd and rcnn.
+
+nms          : greedy nms, dense IoU matrix for small inputs and blocked bitmask for large ones,
+               greedy_nms, matrix_nms and bitmask_nms are the individual methods
+batched_nms  : class-aware nms of all classes in one call
+soft_nms     : linear or gaussian soft-nms
+topk_indices : indices of the k highest scores, in descending order
+iou_matrix   : pairwise IoU of two box sets
+
+Boxes are (x1, y1, x2, y2) rows. Use offset=1 for the pixel convention of rcnn,
+where a box covers x2 - x1 + 1 pixels.
+"""
+from .greedy import nms, greedy_nms, matrix_nms, bitmask_nms, iou_matrix, topk_indices
+from .batched import batched_nms
+from .soft import soft_nms
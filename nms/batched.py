@@ -0,0 +1,35 @@
+import numpy as np
+from .greedy import nms, topk_indices
+
+
+def batched_nms(boxes, scores, labels, thresh, offset=0, topk=-1, method='auto'):
+    """
+    class-aware nms of all classes in one call.
+    boxes of different classes never suppress each other, so boxes are sorted
+    once by (class, score) and each class is a contiguous run for nms.
+    :param boxes: (n, 4) array of (x1, y1, x2, y2)
+    :param scores: (n,) array
+    :param labels: (n,) class ids
+    :param topk: only the topk highest scores of all classes are considered, -1 for all
+    :return: indexes of kept boxes, in descending score order
+    """
+    boxes = np.asarray(boxes)
+    scores = np.asarray(scores)
+    labels = np.asarray(labels)
+    if boxes.shape[0] == 0:
+        return np.zeros((0,), dtype=int)
+    sorder = topk_indices(scores, topk)
+    # stable sort keeps the score order inside each class
+    order = sorder[np.argsort(labels[sorder], kind='mergesort')]
+    starts = np.where(np.diff(labels[order]) != 0)[0] + 1
+    starts = np.hstack(([0], starts, [order.size]))
+
+    keep = []
+    for s0, s1 in zip(starts[:-1], starts[1:]):
+        idx = order[s0:s1]
+        keep.append(idx[nms(boxes[idx], None, thresh, offset=offset, method=method)])
+    keep = np.hstack(keep)
+    # back to the score order of all classes
+    rank = np.empty((boxes.shape[0],), dtype=int)
+    rank[sorder] = np.arange(sorder.size)
+    return keep[np.argsort(rank[keep], kind='mergesort')]
@@ -0,0 +1,104 @@
+"""
+Micro-benchmark of the nms package against the per-box python loops it replaces.
+
+usage: python nms/benchmark.py [--counts 100,1000,20000]
+"""
+from __future__ import print_function
+import argparse
+import os
+import sys
+import time
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from nms import nms, batched_nms, soft_nms
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='NMS micro-benchmark')
+    parser.add_argument('--counts', dest='counts', type=str,
+                        default='100,500,1000,2000,5000,10000,20000',
+                        help='comma separated numbers of boxes')
+    parser.add_argument('--num-class', dest='num_class', type=int, default=20,
+                        help='number of classes for class-aware nms')
+    parser.add_argument('--thresh', dest='thresh', type=float, default=0.45)
+    parser.add_argument('--max-loop-boxes', dest='max_loop_boxes', type=int, default=5000,
+                        help='skip the python loop references and soft-nms above this count')
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def reference_nms(dets, thresh):
+    # per-box loop of ssd/tools/do_nms.py, dets sorted by score
+    areas = (dets[:, 2] - dets[:, 0]) * (dets[:, 3] - dets[:, 1])
+    vmask = np.ones((dets.shape[0],), dtype=int)
+    vidx = []
+    for i, d in enumerate(dets):
+        if vmask[i] == 0:
+            continue
+        iw = np.minimum(d[2], dets[i:, 2]) - np.maximum(d[0], dets[i:, 0])
+        ih = np.minimum(d[3], dets[i:, 3]) - np.maximum(d[1], dets[i:, 1])
+        I = np.maximum(iw, 0) * np.maximum(ih, 0)
+        iou = I / np.maximum(areas[i:] + areas[i] - I, 1e-08)
+        vmask[np.where(iou > thresh)[0] + i] = 0
+        vidx.append(i)
+    return vidx
+
+
+def reference_class_nms(boxes, scores, labels, n_class, thresh):
+    # per-class loop of the old do_nms
+    keep = []
+    for c in range(n_class):
+        cidx = np.where(labels == c)[0]
+        if cidx.size == 0:
+            continue
+        cidx = cidx[np.argsort(scores[cidx])[::-1]]
+        keep.append(cidx[reference_nms(boxes[cidx], thresh)])
+    return np.hstack(keep)
+
+
+def random_boxes(n, rng):
+    # detector-like output: clusters of jittered boxes around a few objects
+    n_obj = max(n // 20, 1)
+    centers = rng.uniform(0, 1, (n_obj, 2))
+    sizes = np.exp(rng.uniform(np.log(0.02), np.log(0.5), (n_obj, 2)))
+    oidx = rng.randint(0, n_obj, n)
+    c = centers[oidx] + rng.normal(0, 0.1, (n, 2)) * sizes[oidx]
+    s = sizes[oidx] * np.exp(rng.normal(0, 0.1, (n, 2)))
+    boxes = np.hstack((c - s / 2, c + s / 2)).astype(np.float32)
+    return boxes, rng.uniform(0, 1, n).astype(np.float32)
+
+
+def timeit(fn, min_time=0.2):
+    n_run = 0
+    tic = time.time()
+    while True:
+        fn()
+        n_run += 1
+        elapsed = time.time() - tic
+        if elapsed > min_time:
+            return elapsed * 1000.0 / n_run
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    rng = np.random.RandomState(args.seed)
+
+    cols = ['loop', 'greedy', 'matrix', 'bitmask', 'cls loop', 'batched', 'soft']
+    print('{:>7s}'.format('n_box') + ''.join(['{:>11s}'.format(c) for c in cols]) + '   (ms)')
+    for n in [int(c) for c in args.counts.split(',')]:
+        boxes, scores = random_boxes(n, rng)
+        labels = rng.randint(0, args.num_class, n)
+        sidx = np.argsort(scores)[::-1]
+        sboxes = boxes[sidx]
+        small = n <= args.max_loop_boxes
+
+        res = []
+        res.append(timeit(lambda: reference_nms(sboxes, args.thresh)) if small else None)
+        res.append(timeit(lambda: nms(sboxes, None, args.thresh, method='greedy')))
+        res.append(timeit(lambda: nms(sboxes, None, args.thresh, method='matrix')) if small else None)
+        res.append(timeit(lambda: nms(sboxes, None, args.thresh, method='bitmask')))
+        res.append(timeit(lambda: reference_class_nms( \
+                boxes, scores, labels, args.num_class, args.thresh)) if small else None)
+        res.append(timeit(lambda: batched_nms(boxes, scores, labels, args.thresh)))
+        res.append(timeit(lambda: soft_nms(boxes, scores, 0.3)) if small else None)
+        print('{:>7d}'.format(n) + ''.join(['{:>11s}'.format('-' if r is None else '{:.2f}'.format(r)) for r in res]))
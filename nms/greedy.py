@@ -0,0 +1,163 @@
+import numpy as np
+
+# nms(method='auto') uses the full IoU matrix up to this many boxes, and the bitmask path above it
+MATRIX_MAX_BOXES = 256
+
+
+def nms(boxes, scores=None, thresh=0.5, labels=None, offset=0, topk=-1, method='auto'):
+    """
+    greedy nms, suppress boxes with IoU > thresh to a kept box of higher score
+    :param boxes: (n, 4) array of (x1, y1, x2, y2)
+    :param scores: (n,) array, or None if boxes are already in descending score order
+    :param thresh: IoU threshold
+    :param labels: (n,) class ids, if given only boxes of the same class suppress each other
+    :param offset: 1 for the rcnn pixel convention, 0 otherwise
+    :param topk: only the topk highest scores are considered, -1 for all
+    :param method: 'greedy', 'matrix', 'bitmask' or 'auto'
+    :return: indexes of kept boxes, in descending score order
+    """
+    boxes = np.asarray(boxes)
+    n = boxes.shape[0]
+    if n == 0:
+        return np.zeros((0,), dtype=int)
+    if scores is None:
+        order = np.arange(n) if topk <= 0 else np.arange(min(n, topk))
+    else:
+        order = topk_indices(np.asarray(scores), topk)
+
+    sboxes = boxes[order, :4]
+    slabels = None if labels is None else np.asarray(labels)[order]
+    if method == 'auto':
+        method = 'matrix' if order.size <= MATRIX_MAX_BOXES else 'bitmask'
+    if method == 'greedy':
+        keep = greedy_nms(sboxes, thresh, slabels, offset)
+    elif method == 'matrix':
+        keep = matrix_nms(sboxes, thresh, slabels, offset)
+    elif method == 'bitmask':
+        keep = bitmask_nms(sboxes, thresh, slabels, offset)
+    else:
+        raise ValueError('unknown nms method {}'.format(method))
+    return order[keep]
+
+
+def greedy_nms(boxes, thresh, labels=None, offset=0):
+    """
+    greedy nms over boxes in descending score order.
+    each kept box is compared against the remaining boxes at once,
+    and suppressed boxes are dropped from the comparison.
+    :return: indexes of kept boxes
+    """
+    areas = box_areas(boxes, offset)
+    order = np.arange(boxes.shape[0])
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        suppress = _iou(boxes[i:i+1], boxes[rest], areas[i:i+1], areas[rest], offset)[0] > thresh
+        if labels is not None:
+            suppress &= labels[rest] == labels[i]
+        order = rest[suppress == False]
+    return np.array(keep, dtype=int)
+
+
+def matrix_nms(boxes, thresh, labels=None, offset=0):
+    """
+    greedy nms over boxes in descending score order, with a full IoU matrix.
+    fastest for a few hundred boxes.
+    :return: indexes of kept boxes
+    """
+    n = boxes.shape[0]
+    suppress = iou_matrix(boxes, boxes, offset) > thresh
+    if labels is not None:
+        suppress &= labels[:, np.newaxis] == labels[np.newaxis, :]
+
+    removed = np.zeros((n,), dtype=bool)
+    keep = []
+    for i in range(n):
+        if removed[i]:
+            continue
+        keep.append(i)
+        removed[i+1:] |= suppress[i, i+1:]
+    return np.array(keep, dtype=int)
+
+
+def bitmask_nms(boxes, thresh, labels=None, offset=0):
+    """
+    greedy nms over boxes in descending score order, for thousands of boxes.
+    boxes are processed in blocks of 64, as in the gpu kernel:
+    suppression inside a block is a 64 bit mask per box, scanned in order,
+    then the kept boxes of the block remove the later boxes they overlap.
+    :return: indexes of kept boxes
+    """
+    block = 64
+    n = boxes.shape[0]
+    areas = box_areas(boxes, offset)
+    alive = np.ones((n,), dtype=bool)
+    keep = []
+    for b0 in range(0, n, block):
+        b1 = min(n, b0 + block)
+        bidx = b0 + np.where(alive[b0:b1])[0]
+        if bidx.size == 0:
+            continue
+        suppress = _iou(boxes[bidx], boxes[bidx], areas[bidx], areas[bidx], offset) > thresh
+        if labels is not None:
+            suppress &= labels[bidx, np.newaxis] == labels[np.newaxis, bidx]
+        # row i as a 64 bit integer, bit (63 - j) for box j of the block
+        bits = np.packbits(suppress, axis=1)
+        bits = np.hstack((bits, np.zeros((bits.shape[0], 8 - bits.shape[1]), dtype=np.uint8)))
+        rows = bits.view('>u8').ravel().tolist()
+
+        removed = 0
+        kidx = []
+        for j, row in enumerate(rows):
+            if (removed >> (63 - j)) & 1:
+                continue
+            kidx.append(j)
+            removed |= row
+        kept = bidx[kidx]
+        keep.append(kept)
+
+        later = b1 + np.where(alive[b1:])[0]
+        if later.size == 0:
+            continue
+        suppress = _iou(boxes[kept], boxes[later], areas[kept], areas[later], offset) > thresh
+        if labels is not None:
+            suppress &= labels[kept, np.newaxis] == labels[np.newaxis, later]
+        alive[later[np.any(suppress, axis=0)]] = False
+    if not keep:
+        return np.zeros((0,), dtype=int)
+    return np.hstack(keep)
+
+
+def topk_indices(scores, k=-1):
+    """
+    indexes of the k highest scores in descending order, all of them if k <= 0
+    """
+    n = scores.shape[0]
+    if k <= 0 or k >= n:
+        return np.argsort(scores)[::-1]
+    idx = np.argpartition(scores, n - k)[n - k:]
+    return idx[np.argsort(scores[idx])[::-1]]
+
+
+def box_areas(boxes, offset=0):
+    return (boxes[:, 2] - boxes[:, 0] + offset) * (boxes[:, 3] - boxes[:, 1] + offset)
+
+
+def iou_matrix(boxes_a, boxes_b, offset=0):
+    """
+    pairwise IoU, (n_a, n_b)
+    """
+    return _iou(boxes_a, boxes_b, box_areas(boxes_a, offset), box_areas(boxes_b, offset), offset)
+
+
+def _iou(boxes_a, boxes_b, areas_a, areas_b, offset):
+    iw = np.minimum(boxes_a[:, 2:3], boxes_b[:, 2]) - np.maximum(boxes_a[:, 0:1], boxes_b[:, 0])
+    ih = np.minimum(boxes_a[:, 3:4], boxes_b[:, 3]) - np.maximum(boxes_a[:, 1:2], boxes_b[:, 1])
+    if offset:
+        iw += offset
+        ih += offset
+    inter = np.maximum(iw, 0) * np.maximum(ih, 0)
+    union = areas_a[:, np.newaxis] + areas_b[np.newaxis, :] - inter
+    return inter / np.maximum(union, 1e-08)
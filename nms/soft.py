@@ -0,0 +1,46 @@
+import numpy as np
+from .greedy import box_areas, _iou
+
+
+def soft_nms(boxes, scores, thresh=0.3, sigma=0.5, method='linear', score_thresh=1e-03,
+             labels=None, offset=0):
+    """
+    soft-nms, decay scores of boxes overlapping a picked box instead of removing them
+    :param boxes: (n, 4) array of (x1, y1, x2, y2)
+    :param scores: (n,) array
+    :param thresh: IoU threshold for the linear method
+    :param sigma: gaussian parameter
+    :param method: 'linear' or 'gaussian'
+    :param score_thresh: boxes whose decayed score drops below this are removed
+    :param labels: (n,) class ids, if given only boxes of the same class decay each other
+    :return: (indexes of kept boxes in picking order, their decayed scores)
+    """
+    assert method in ('linear', 'gaussian'), 'unknown soft-nms method {}'.format(method)
+    boxes = np.asarray(boxes)[:, :4]
+    scores = np.array(scores, dtype=np.float64)
+    if labels is not None:
+        labels = np.asarray(labels)
+    areas = box_areas(boxes, offset)
+
+    remain = np.where(scores >= score_thresh)[0]
+    keep = []
+    keep_scores = []
+    while remain.size > 0:
+        m = np.argmax(scores[remain])
+        i = remain[m]
+        keep.append(i)
+        keep_scores.append(scores[i])
+        remain = np.delete(remain, m)
+        if remain.size == 0:
+            break
+
+        iou = _iou(boxes[i:i+1], boxes[remain], areas[i:i+1], areas[remain], offset)[0]
+        if method == 'linear':
+            decay = np.where(iou > thresh, 1.0 - iou, 1.0)
+        else:
+            decay = np.exp(-(iou * iou) / sigma)
+        if labels is not None:
+            decay[labels[remain] != labels[i]] = 1.0
+        scores[remain] *= decay
+        remain = remain[scores[remain] >= score_thresh]
+    return np.array(keep, dtype=int), np.array(keep_scores)
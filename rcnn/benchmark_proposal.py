@@ -0,0 +1,103 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""
+Latency of the proposal layer on cpu, and of the nms backends it can use.
+
+usage: python benchmark_proposal.py [--sizes 600x800,600x1000] [--batch-size 1]
+"""
+from __future__ import print_function
+import argparse
+import time
+import numpy as np
+import mxnet as mx
+from rcnn.symbol.proposal import ProposalProp
+from rcnn.processing import nms as nms_backend
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Proposal layer benchmark')
+    parser.add_argument('--sizes', help='comma separated image sizes, HxW', default='600x800,600x1000,800x1333', type=str)
+    parser.add_argument('--batch-size', help='images per forward', default=1, type=int)
+    parser.add_argument('--feat-stride', help='feature stride', default=16, type=int)
+    parser.add_argument('--pre-nms', help='rpn_pre_nms_top_n', default=6000, type=int)
+    parser.add_argument('--post-nms', help='rpn_post_nms_top_n', default=300, type=int)
+    parser.add_argument('--thresh', help='nms threshold', default=0.7, type=float)
+    parser.add_argument('--min-time', help='seconds to run each case', default=1.0, type=float)
+    parser.add_argument('--seed', default=0, type=int)
+    return parser.parse_args()
+
+
+def timeit(fn, min_time):
+    fn()
+    n_run = 0
+    tic = time.time()
+    while True:
+        fn()
+        n_run += 1
+        elapsed = time.time() - tic
+        if elapsed > min_time:
+            return elapsed * 1000.0 / n_run
+
+
+def random_inputs(batch_size, height, width, feat_stride, num_anchors, rng):
+    feat_h, feat_w = height // feat_stride, width // feat_stride
+    fg = rng.uniform(0, 1, (batch_size, num_anchors, feat_h, feat_w)).astype(np.float32)
+    cls_prob = np.concatenate((1 - fg, fg), axis=1)
+    bbox_pred = rng.normal(0, 0.2, (batch_size, 4 * num_anchors, feat_h, feat_w)).astype(np.float32)
+    im_info = np.tile(np.array([[height, width, 1.0]], dtype=np.float32), (batch_size, 1))
+    return [mx.nd.array(a, ctx=mx.cpu()) for a in (cls_prob, bbox_pred, im_info)]
+
+
+def main():
+    args = parse_args()
+    rng = np.random.RandomState(args.seed)
+    prop = ProposalProp(feat_stride=str(args.feat_stride), output_score='True',
+                        rpn_pre_nms_top_n=str(args.pre_nms), rpn_post_nms_top_n=str(args.post_nms),
+                        threshold=str(args.thresh))
+
+    backends = [('numpy', nms_backend.py_nms_wrapper(args.thresh))]
+    if nms_backend.cpu_nms is not None:
+        backends.append(('cython', nms_backend.cpu_nms_wrapper(args.thresh)))
+    else:
+        print('cython cpu_nms is not built, run make to compare it')
+
+    print('pre nms {}, post nms {}, batch size {}'.format(args.pre_nms, args.post_nms, args.batch_size))
+    print('{:>12s}{:>12s}'.format('size', 'proposal') +
+          ''.join(['{:>12s}'.format(name + ' nms') for name, _ in backends]) + '   (ms)')
+    for size in args.sizes.split(','):
+        height, width = [int(s) for s in size.split('x')]
+        op = prop.create_operator(mx.cpu(), None, None)
+        in_data = random_inputs(args.batch_size, height, width, args.feat_stride, op._num_anchors, rng)
+        _, out_shapes = prop.infer_shape([a.shape for a in in_data])
+        out_data = [mx.nd.zeros(s, ctx=mx.cpu()) for s in out_shapes]
+        forward = lambda: op.forward(False, ['write', 'write'], in_data, out_data, [])
+        res = [timeit(lambda: (forward(), out_data[0].wait_to_read()), args.min_time)]
+
+        # nms alone on the pre nms proposals of the first image
+        feat_size = (height // args.feat_stride, width // args.feat_stride)
+        proposals, scores = op._top_proposals(in_data[0].asnumpy()[:1, op._num_anchors:],
+                                              in_data[1].asnumpy()[:1], in_data[2].asnumpy()[:1],
+                                              feat_size, args.pre_nms, op._rpn_min_size)
+        det = np.hstack((proposals[0], scores[0][:, np.newaxis])).astype(np.float32)
+        for _, nms in backends:
+            res.append(timeit(lambda: nms(det), args.min_time))
+        print('{:>12s}'.format(size) + ''.join(['{:>12.2f}'.format(r) for r in res]))
+
+
+if __name__ == '__main__':
+    main()
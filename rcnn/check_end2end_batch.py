@@ -0,0 +1,119 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+"""
+End-to-end check of training with several images per device.
+
+Random images and boxes are loaded by AnchorLoader with TRAIN.BATCH_IMAGES images,
+the anchor labels are compared with the ones of each image loaded alone, and one
+forward and backward of the end-to-end training symbol is run on cpu.
+
+usage: python check_end2end_batch.py [--network vgg] [--batch-images 2]
+"""
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import tempfile
+import cv2
+import numpy as np
+import mxnet as mx
+from rcnn.config import config
+from rcnn.symbol import *
+from rcnn.core.loader import AnchorLoader
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='End-to-end check of TRAIN.BATCH_IMAGES > 1')
+    parser.add_argument('--network', help='network name', default='vgg', type=str)
+    parser.add_argument('--batch-images', help='images per device', default=2, type=int)
+    parser.add_argument('--num-batches', help='number of batches to check', default=2, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    return parser.parse_args()
+
+
+def random_roidb(root, num_images, height, width, rng):
+    roidb = []
+    for i in range(num_images):
+        path = os.path.join(root, '{:06d}.jpg'.format(i))
+        cv2.imwrite(path, rng.randint(0, 256, (height, width, 3)).astype(np.uint8))
+        # a different number of boxes per image, so that gt_boxes are padded
+        num_gt = i % 3 + 1
+        xy = rng.uniform(0, 0.5, (num_gt, 2)) * (width, height)
+        wh = rng.uniform(0.2, 0.5, (num_gt, 2)) * (width, height)
+        boxes = np.hstack((xy, np.minimum(xy + wh, (width - 1, height - 1)))).astype(np.uint16)
+        roidb.append({'image': path, 'height': height, 'width': width, 'flipped': False,
+                      'boxes': boxes, 'gt_classes': rng.randint(1, config.NUM_CLASSES, num_gt)})
+    return roidb
+
+
+def main():
+    args = parse_args()
+    rng = np.random.RandomState(args.seed)
+    height, width = 192, 256
+    config.TRAIN.BATCH_IMAGES = args.batch_images
+    config.TRAIN.END2END = True
+    config.SCALES = [(height, width)]
+    # keep every labeled anchor, so that labels do not depend on sampling
+    config.TRAIN.RPN_BATCH_SIZE = 10 ** 9
+    config.TRAIN.RPN_PRE_NMS_TOP_N = 600
+    config.TRAIN.RPN_POST_NMS_TOP_N = 100
+    anchor_args = dict(feat_stride=config.RPN_FEAT_STRIDE, anchor_scales=config.ANCHOR_SCALES,
+                       anchor_ratios=config.ANCHOR_RATIOS)
+
+    sym = eval('get_' + args.network + '_train')(num_classes=config.NUM_CLASSES, num_anchors=config.NUM_ANCHORS)
+    feat_sym = sym.get_internals()['rpn_cls_score_output']
+
+    root = tempfile.mkdtemp()
+    try:
+        roidb = random_roidb(root, args.batch_images * args.num_batches, height, width, rng)
+        loader = AnchorLoader(feat_sym, roidb, batch_size=args.batch_images, ctx=[mx.cpu()], **anchor_args)
+        data_names = [k for k, _ in loader.provide_data]
+        label_names = [k for k, _ in loader.provide_label]
+        mod = mx.mod.Module(sym, data_names=data_names, label_names=label_names, context=mx.cpu())
+        mod.bind(loader.provide_data, loader.provide_label)
+        mod.init_params(initializer=mx.init.Xavier(magnitude=2.34))
+
+        for nbatch, batch in enumerate(loader):
+            data = dict(zip(data_names, batch.data))
+            label = dict(zip(label_names, batch.label))
+            assert data['im_info'].shape == (args.batch_images, 3)
+            for i in range(args.batch_images):
+                index = nbatch * args.batch_images + i
+                single = AnchorLoader(feat_sym, [roidb[index]], batch_size=1, ctx=[mx.cpu()], **anchor_args)
+                gt_boxes = data['gt_boxes'].asnumpy()[i]
+                single_gt_boxes = dict(zip(data_names, single.data))['gt_boxes'].asnumpy()[0]
+                assert np.array_equal(gt_boxes[gt_boxes[:, 4] > 0], single_gt_boxes), \
+                    'gt_boxes of image {}'.format(index)
+                for k, v in zip(label_names, single.label):
+                    assert np.array_equal(label[k].asnumpy()[i], v.asnumpy()[0]), '{} of image {}'.format(k, index)
+
+            mod.forward(batch, is_train=True)
+            mod.backward()
+            # last output is the rcnn label of the sampled rois, (batch_images, rois per image)
+            rcnn_label = mod.get_outputs()[-1].asnumpy()
+            assert rcnn_label.shape == (args.batch_images, config.TRAIN.BATCH_ROIS // args.batch_images)
+            assert np.all((rcnn_label > 0).sum(axis=1) > 0), 'no fg roi in some image'
+            print('batch {}: {} images, rpn labels match single image loading, '
+                  'rcnn fg rois per image {}'.format(nbatch, args.batch_images, (rcnn_label > 0).sum(axis=1)))
+        print('ok')
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -23,6 +23,8 @@ config = edict()
 # network related params
 config.PIXEL_MEANS = np.array([103.939, 116.779, 123.68])
 config.IMAGE_STRIDE = 0
+# decode jpeg at 1/2, 1/4 or 1/8 size when images are shrunk that much
+config.IMAGE_REDUCED_DECODE = False
 config.RPN_FEAT_STRIDE = 16
 config.RCNN_FEAT_STRIDE = 16
 config.FIXED_PARAMS = ['conv1', 'conv2']
@@ -47,6 +49,14 @@ config.TRAIN.BATCH_IMAGES = 2
 config.TRAIN.END2END = False
 # group images with similar aspect ratio
 config.TRAIN.ASPECT_GROUPING = True
+# processes loading batches ahead of training, 0 to load in the training loop
+config.TRAIN.LOADER_WORKERS = 0
+# number of batches loaded ahead by the loader processes
+config.TRAIN.LOADER_PREFETCH = 2
+# directory of an on-disk cache of resized images, empty to decode images every epoch
+config.TRAIN.IMAGE_CACHE_DIR = ''
+# size cap of the image cache in GB
+config.TRAIN.IMAGE_CACHE_GB = 20
 
 # R-CNN
 # rcnn rois batch size
@@ -21,12 +21,27 @@ import mxnet as mx
 
 
 class Speedometer(object):
-    def __init__(self, batch_size, frequent=50):
+    def __init__(self, batch_size, frequent=50, data_iter=None):
+        """
+        :param data_iter: if given, also show the time the training loop waited for
+        data_iter per batch, from its total_wait in seconds
+        """
         self.batch_size = batch_size
         self.frequent = frequent
+        self.data_iter = data_iter
         self.init = False
         self.tic = 0
         self.last_count = 0
+        self.last_wait = 0.0
+
+    def _wait(self):
+        """ loader wait in ms per batch since the last call """
+        total_wait = getattr(self.data_iter, 'total_wait', None)
+        if total_wait is None:
+            return None
+        wait = (total_wait - self.last_wait) * 1000.0 / self.frequent
+        self.last_wait = total_wait
+        return wait
 
     def __call__(self, param):
         """Callback to Show speed."""
@@ -38,19 +53,23 @@ class Speedometer(object):
         if self.init:
             if count % self.frequent == 0:
                 speed = self.frequent * self.batch_size / (time.time() - self.tic)
+                wait = self._wait()
+                speed_s = "Speed: %.2f samples/sec" % speed
+                if wait is not None:
+                    speed_s += "\tLoader wait: %.1f ms/batch" % wait
                 if param.eval_metric is not None:
                     name, value = param.eval_metric.get()
-                    s = "Epoch[%d] Batch [%d]\tSpeed: %.2f samples/sec\tTrain-" % (param.epoch, count, speed)
+                    s = "Epoch[%d] Batch [%d]\t%s\tTrain-" % (param.epoch, count, speed_s)
                     for n, v in zip(name, value):
                         s += "%s=%f,\t" % (n, v)
                     logging.info(s)
                 else:
-                    logging.info("Iter[%d] Batch [%d]\tSpeed: %.2f samples/sec",
-                                 param.epoch, count, speed)
+                    logging.info("Iter[%d] Batch [%d]\t%s", param.epoch, count, speed_s)
                 self.tic = time.time()
         else:
             self.init = True
             self.tic = time.time()
+            self.last_wait = getattr(self.data_iter, 'total_wait', 0.0)
 
 
 def do_checkpoint(prefix, means, stds):
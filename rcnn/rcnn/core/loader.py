@@ -15,6 +15,10 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import multiprocessing as mp
+import os
+import time
+from collections import deque
 import mxnet as mx
 import numpy as np
 from mxnet.executor_manager import _split_input_slice
@@ -23,6 +27,7 @@ from rcnn.config import config
 from rcnn.io.image import tensor_vstack
 from rcnn.io.rpn import get_rpn_testbatch, get_rpn_batch, assign_anchor
 from rcnn.io.rcnn import get_rcnn_testbatch, get_rcnn_batch
+from rcnn.utils.lru_cache import LRUCache, shape_key
 
 
 class TestLoader(mx.io.DataIter):
@@ -106,7 +111,8 @@ class TestLoader(mx.io.DataIter):
 
 
 class ROIIter(mx.io.DataIter):
-    def __init__(self, roidb, batch_size=2, shuffle=False, ctx=None, work_load_list=None, aspect_grouping=False):
+    def __init__(self, roidb, batch_size=2, shuffle=False, ctx=None, work_load_list=None, aspect_grouping=False,
+                 num_workers=0, prefetch_batches=2):
         """
         This Iter will provide roi data to Fast R-CNN network
         :param roidb: must be preprocessed
@@ -115,6 +121,8 @@ class ROIIter(mx.io.DataIter):
         :param ctx: list of contexts
         :param work_load_list: list of work load
         :param aspect_grouping: group images with similar aspects
+        :param num_workers: processes loading batches ahead, 0 to load in next()
+        :param prefetch_batches: number of batches loaded ahead by the processes
         :return: ROIIter
         """
         super(ROIIter, self).__init__()
@@ -143,6 +151,13 @@ class ROIIter(mx.io.DataIter):
         self.data = None
         self.label = None
 
+        # time next() waited for the last batch, and in total, in seconds
+        self.batch_wait = 0.0
+        self.total_wait = 0.0
+        self.prefetcher = None
+        if num_workers > 0:
+            self.prefetcher = BatchPrefetcher(self, num_workers, prefetch_batches)
+
         # get first batch to fill in provide_data and provide_label
         self.reset()
         self.get_batch()
@@ -178,13 +193,22 @@ class ROIIter(mx.io.DataIter):
                 self.index = inds
             else:
                 np.random.shuffle(self.index)
+        if self.prefetcher is not None:
+            self.prefetcher.start([self._batch_indices(cur) for cur in
+                                   range(0, self.size - self.batch_size + 1, self.batch_size)])
 
     def iter_next(self):
         return self.cur + self.batch_size <= self.size
 
     def next(self):
         if self.iter_next():
-            self.get_batch()
+            tic = time.time()
+            if self.prefetcher is not None:
+                self._set_batch(*self.prefetcher.get())
+            else:
+                self.get_batch()
+            self.batch_wait = time.time() - tic
+            self.total_wait += self.batch_wait
             self.cur += self.batch_size
             return mx.io.DataBatch(data=self.data, label=self.label,
                                    pad=self.getpad(), index=self.getindex(),
@@ -202,10 +226,23 @@ class ROIIter(mx.io.DataIter):
             return 0
 
     def get_batch(self):
-        # slice roidb
-        cur_from = self.cur
-        cur_to = min(cur_from + self.batch_size, self.size)
-        roidb = [self.roidb[self.index[i]] for i in range(cur_from, cur_to)]
+        self._set_batch(*self.load_batch(self._batch_indices(self.cur)))
+
+    def close(self):
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+
+    def _batch_indices(self, cur):
+        cur_to = min(cur + self.batch_size, self.size)
+        return [int(self.index[i]) for i in range(cur, cur_to)]
+
+    def load_batch(self, indices):
+        """
+        load the batch of roidb indices, in numpy
+        :return: all_data, all_label
+        """
+        roidb = [self.roidb[i] for i in indices]
 
         # decide multi device slices
         work_load_list = self.work_load_list
@@ -233,6 +270,9 @@ class ROIIter(mx.io.DataIter):
         for key in label_list[0].keys():
             all_label[key] = tensor_vstack([batch[key] for batch in label_list])
 
+        return all_data, all_label
+
+    def _set_batch(self, all_data, all_label):
         self.data = [mx.nd.array(all_data[name]) for name in self.data_name]
         self.label = [mx.nd.array(all_label[name]) for name in self.label_name]
 
@@ -240,7 +280,7 @@ class ROIIter(mx.io.DataIter):
 class AnchorLoader(mx.io.DataIter):
     def __init__(self, feat_sym, roidb, batch_size=1, shuffle=False, ctx=None, work_load_list=None,
                  feat_stride=16, anchor_scales=(8, 16, 32), anchor_ratios=(0.5, 1, 2), allowed_border=0,
-                 aspect_grouping=False):
+                 aspect_grouping=False, num_workers=0, prefetch_batches=2, shape_cache_size=64):
         """
         This Iter will provide roi data to Fast R-CNN network
         :param feat_sym: to infer shape of assign_output
@@ -250,6 +290,10 @@ class AnchorLoader(mx.io.DataIter):
         :param ctx: list of contexts
         :param work_load_list: list of work load
         :param aspect_grouping: group images with similar aspects
+        :param num_workers: processes loading batches ahead, 0 to load in next()
+        :param prefetch_batches: number of batches loaded ahead by the processes
+        :param shape_cache_size: number of input shapes whose feature shape is memoized,
+        each prefetch process keeps its own cache
         :return: AnchorLoader
         """
         super(AnchorLoader, self).__init__()
@@ -269,6 +313,9 @@ class AnchorLoader(mx.io.DataIter):
         self.allowed_border = allowed_border
         self.aspect_grouping = aspect_grouping
 
+        # feature shapes of recent input shapes, see feat_shape()
+        self.shape_cache = LRUCache(shape_cache_size)
+
         # infer properties from roidb
         self.size = len(roidb)
         self.index = np.arange(self.size)
@@ -288,6 +335,13 @@ class AnchorLoader(mx.io.DataIter):
         self.data = None
         self.label = None
 
+        # time next() waited for the last batch, and in total, in seconds
+        self.batch_wait = 0.0
+        self.total_wait = 0.0
+        self.prefetcher = None
+        if num_workers > 0:
+            self.prefetcher = BatchPrefetcher(self, num_workers, prefetch_batches)
+
         # get first batch to fill in provide_data and provide_label
         self.reset()
         self.get_batch()
@@ -318,13 +372,22 @@ class AnchorLoader(mx.io.DataIter):
                 self.index = inds
             else:
                 np.random.shuffle(self.index)
+        if self.prefetcher is not None:
+            self.prefetcher.start([self._batch_indices(cur) for cur in
+                                   range(0, self.size - self.batch_size + 1, self.batch_size)])
 
     def iter_next(self):
         return self.cur + self.batch_size <= self.size
 
     def next(self):
         if self.iter_next():
-            self.get_batch()
+            tic = time.time()
+            if self.prefetcher is not None:
+                self._set_batch(*self.prefetcher.get())
+            else:
+                self.get_batch()
+            self.batch_wait = time.time() - tic
+            self.total_wait += self.batch_wait
             self.cur += self.batch_size
             return mx.io.DataBatch(data=self.data, label=self.label,
                                    pad=self.getpad(), index=self.getindex(),
@@ -350,18 +413,40 @@ class AnchorLoader(mx.io.DataIter):
         max_shapes = dict(max_data_shape + max_label_shape)
         input_batch_size = max_shapes['data'][0]
         im_info = [[max_shapes['data'][2], max_shapes['data'][3], 1.0]]
-        _, feat_shape, _ = self.feat_sym.infer_shape(**max_shapes)
-        label = assign_anchor(feat_shape[0], np.zeros((0, 5)), im_info,
+        feat_shape = self.feat_shape(**max_shapes)
+        label = assign_anchor(feat_shape, np.zeros((0, 5)), im_info,
                               self.feat_stride, self.anchor_scales, self.anchor_ratios, self.allowed_border)
         label = [label[k] for k in self.label_name]
         label_shape = [(k, tuple([input_batch_size] + list(v.shape[1:]))) for k, v in zip(self.label_name, label)]
         return max_data_shape, label_shape
 
+    def feat_shape(self, **shapes):
+        """
+        output shape of feat_sym for the input shapes, memoized since input shapes
+        only take a few values of scales and padding
+        :return: tuple of int
+        """
+        key = shape_key(sorted(shapes.items()))
+        return self.shape_cache.get(key, lambda: tuple(int(i) for i in self.feat_sym.infer_shape(**shapes)[1][0]))
+
     def get_batch(self):
-        # slice roidb
-        cur_from = self.cur
-        cur_to = min(cur_from + self.batch_size, self.size)
-        roidb = [self.roidb[self.index[i]] for i in range(cur_from, cur_to)]
+        self._set_batch(*self.load_batch(self._batch_indices(self.cur)))
+
+    def close(self):
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+
+    def _batch_indices(self, cur):
+        cur_to = min(cur + self.batch_size, self.size)
+        return [int(self.index[i]) for i in range(cur, cur_to)]
+
+    def load_batch(self, indices):
+        """
+        load the batch of roidb indices and assign anchors, in numpy
+        :return: all_data, all_label
+        """
+        roidb = [self.roidb[i] for i in indices]
 
         # decide multi device slice
         work_load_list = self.work_load_list
@@ -383,27 +468,29 @@ class AnchorLoader(mx.io.DataIter):
 
         # pad data first and then assign anchor (read label)
         data_tensor = tensor_vstack([batch['data'] for batch in data_list])
-        for data, data_pad in zip(data_list, data_tensor):
-            data['data'] = data_pad[np.newaxis, :]
+        for data, islice in zip(data_list, slices):
+            data['data'] = data_tensor[islice.start:islice.stop]
 
         new_label_list = []
         for data, label in zip(data_list, label_list):
             # infer label shape
             data_shape = {k: v.shape for k, v in data.items()}
             del data_shape['im_info']
-            _, feat_shape, _ = self.feat_sym.infer_shape(**data_shape)
-            feat_shape = [int(i) for i in feat_shape[0]]
+            feat_shape = list(self.feat_shape(**data_shape))
 
             # add gt_boxes to data for e2e
-            data['gt_boxes'] = label['gt_boxes'][np.newaxis, :, :]
+            data['gt_boxes'] = label['gt_boxes']
             if config.HAS_PART:
-                data['gt_head_boxes'] = label['gt_head_boxes'][np.newaxis, :, :]
-                data['gt_joints'] = label['gt_joints'][np.newaxis, :, :]
-
-            # assign anchor for label
-            label = assign_anchor(feat_shape, label['gt_boxes'], data['im_info'],
-                                  self.feat_stride, self.anchor_scales,
-                                  self.anchor_ratios, self.allowed_border)
+                data['gt_head_boxes'] = label['gt_head_boxes']
+                data['gt_joints'] = label['gt_joints']
+
+            # assign anchor for label, image by image, without the padded gt boxes
+            im_labels = []
+            for gt_boxes, im_info in zip(label['gt_boxes'], data['im_info']):
+                im_labels.append(assign_anchor(feat_shape, gt_boxes[gt_boxes[:, 4] > 0], im_info[np.newaxis, :],
+                                               self.feat_stride, self.anchor_scales,
+                                               self.anchor_ratios, self.allowed_border))
+            label = {k: np.vstack([im_label[k] for im_label in im_labels]) for k in self.label_name}
             new_label_list.append(label)
 
         all_data = dict()
@@ -415,5 +502,67 @@ class AnchorLoader(mx.io.DataIter):
             pad = -1 if key == 'label' else 0
             all_label[key] = tensor_vstack([batch[key] for batch in new_label_list], pad=pad)
 
+        return all_data, all_label
+
+    def _set_batch(self, all_data, all_label):
         self.data = [mx.nd.array(all_data[key]) for key in self.data_name]
         self.label = [mx.nd.array(all_label[key]) for key in self.label_name]
+
+
+class BatchPrefetcher(object):
+    """
+    Loads batches of a loader ahead in a process pool.
+    Batches are loaded with loader.load_batch(indices) and returned in the order
+    of the list given to start(), so the order of aspect grouping is kept.
+    The loader is copied to the worker processes when the pool starts, only the
+    roidb indices of each batch are sent to them.
+    """
+    def __init__(self, loader, num_workers, prefetch_batches=2):
+        seed = np.random.randint(0, 2 ** 31)
+        self._pool = mp.Pool(num_workers, initializer=_prefetch_init, initargs=(loader, seed))
+        self._depth = max(prefetch_batches, 1)
+        self._batches = iter([])
+        self._pending = deque()
+
+    def start(self, batches):
+        """
+        start loading a new list of batches, batches not taken yet are dropped
+        :param batches: list of roidb indices of each batch
+        """
+        self._pending.clear()
+        self._batches = iter(batches)
+        for _ in range(self._depth):
+            self._dispatch()
+
+    def get(self):
+        """
+        wait for the next batch
+        :return: all_data, all_label
+        """
+        result = self._pending.popleft()
+        self._dispatch()
+        return result.get()
+
+    def close(self):
+        self._pending.clear()
+        self._pool.terminate()
+        self._pool.join()
+
+    def _dispatch(self):
+        for indices in self._batches:
+            self._pending.append(self._pool.apply_async(_prefetch_load, (indices,)))
+            break
+
+
+_prefetch_loader = None
+
+
+def _prefetch_init(loader, seed):
+    global _prefetch_loader
+    _prefetch_loader = loader
+    # workers do not share random states for anchor sampling
+    np.random.seed((seed + os.getpid()) % 2 ** 32)
+
+
+def _prefetch_load(indices):
+    return _prefetch_loader.load_batch(indices)
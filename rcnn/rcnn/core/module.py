@@ -27,6 +27,8 @@ from mxnet.initializer import Uniform
 from mxnet.module.base_module import BaseModule
 from mxnet.module.module import Module
 
+from rcnn.utils.lru_cache import LRUCache, shape_key
+
 class MutableModule(BaseModule):
     """A mutable module is a module that supports variable input data.
 
@@ -41,10 +43,13 @@ class MutableModule(BaseModule):
     max_data_shapes : list of (name, shape) tuple, designating inputs whose shape vary
     max_label_shapes : list of (name, shape) tuple, designating inputs whose shape vary
     fixed_param_prefix : list of str, indicating fixed parameters
+    max_cached_modules : int, number of modules bound to recent input shapes kept for reuse,
+        they share memory with the module bound with maximum shape
     """
     def __init__(self, symbol, data_names, label_names,
                  logger=logging, context=ctx.cpu(), work_load_list=None,
-                 max_data_shapes=None, max_label_shapes=None, fixed_param_prefix=None):
+                 max_data_shapes=None, max_label_shapes=None, fixed_param_prefix=None,
+                 max_cached_modules=16):
         super(MutableModule, self).__init__(logger=logger)
         self._symbol = symbol
         self._data_names = data_names
@@ -56,6 +61,9 @@ class MutableModule(BaseModule):
         self._max_data_shapes = max_data_shapes
         self._max_label_shapes = max_label_shapes
         self._fixed_param_prefix = fixed_param_prefix
+        self._max_module = None
+        self._max_shape_key = None
+        self.module_cache = LRUCache(max_cached_modules)
 
         fixed_param_names = list()
         if fixed_param_prefix is not None:
@@ -68,6 +76,9 @@ class MutableModule(BaseModule):
     def _reset_bind(self):
         self.binded = False
         self._curr_module = None
+        self._max_module = None
+        self._max_shape_key = None
+        self.module_cache.clear()
 
     @property
     def data_names(self):
@@ -157,6 +168,8 @@ class MutableModule(BaseModule):
         module.bind(max_data_shapes, max_label_shapes, for_training, inputs_need_grad,
                     force_rebind=False, shared_module=None)
         self._curr_module = module
+        self._max_module = module
+        self._max_shape_key = shape_key(max_data_shapes, max_label_shapes)
 
         # copy back saved params, if already initialized
         if self.params_initialized:
@@ -195,17 +208,25 @@ class MutableModule(BaseModule):
                 shape_changed = True
 
         if shape_changed:
-            module = Module(self._symbol, self._data_names, self._label_names,
-                            logger=self.logger, context=self._context,
-                            work_load_list=self._work_load_list,
-                            fixed_param_names=self._fixed_param_names)
-            module.bind(data_batch.provide_data, data_batch.provide_label, self._curr_module.for_training,
-                        self._curr_module.inputs_need_grad, force_rebind=False,
-                        shared_module=self._curr_module)
-            self._curr_module = module
+            key = shape_key(data_batch.provide_data, data_batch.provide_label)
+            if key == self._max_shape_key:
+                self._curr_module = self._max_module
+            else:
+                self._curr_module = self.module_cache.get(key, lambda: self._bind_module(data_batch))
 
         self._curr_module.forward(data_batch, is_train=is_train)
 
+    def _bind_module(self, data_batch):
+        """ bind a module to the shapes of data_batch, sharing memory with the max shape module """
+        module = Module(self._symbol, self._data_names, self._label_names,
+                        logger=self.logger, context=self._context,
+                        work_load_list=self._work_load_list,
+                        fixed_param_names=self._fixed_param_names)
+        module.bind(data_batch.provide_data, data_batch.provide_label, self._max_module.for_training,
+                    self._max_module.inputs_need_grad, force_rebind=False,
+                    shared_module=self._max_module)
+        return module
+
     def backward(self, out_grads=None):
         assert self.binded and self.params_initialized
         self._curr_module.backward(out_grads=out_grads)
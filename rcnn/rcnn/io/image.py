@@ -20,6 +20,7 @@ import cv2
 import os
 import random
 from ..config import config
+from .image_cache import ImageCache
 
 
 def get_image(roidb, is_test=False):
@@ -38,9 +39,6 @@ def get_image(roidb, is_test=False):
     for i in range(num_images):
         roi_rec = roidb[i]
         assert os.path.exists(roi_rec['image']), '%s does not exist'.format(roi_rec['image'])
-        im = cv2.imread(roi_rec['image'])
-        if roidb[i]['flipped']:
-            im = im[:, ::-1, :]
         new_rec = roi_rec.copy()
         if is_test:
             scale_ind = 0
@@ -48,8 +46,9 @@ def get_image(roidb, is_test=False):
             scale_ind = 0 #random.randrange(len(config.SCALES))
         target_size = config.SCALES[scale_ind][0]
         max_size = config.SCALES[scale_ind][1]
-        im, im_scale = resize(im, target_size, max_size, stride=config.IMAGE_STRIDE)
-        im_tensor = transform(im, config.PIXEL_MEANS)
+        cache = None if is_test else get_image_cache()
+        im, im_scale = imread_resized(roi_rec, target_size, max_size, cache=cache)
+        im_tensor = transform(im, config.PIXEL_MEANS, stride=config.IMAGE_STRIDE)
         processed_ims.append(im_tensor)
         im_info = [im_tensor.shape[2], im_tensor.shape[3], im_scale]
         new_rec['boxes'] = roi_rec['boxes'].copy() * im_scale
@@ -62,6 +61,84 @@ def get_image(roidb, is_test=False):
     return processed_ims, processed_roidb
 
 
+_image_cache = None
+
+
+def get_image_cache():
+    """
+    image cache in config.TRAIN.IMAGE_CACHE_DIR of this process
+    :return: ImageCache, None if config.TRAIN.IMAGE_CACHE_DIR is not set
+    """
+    global _image_cache
+    if not config.TRAIN.IMAGE_CACHE_DIR:
+        return None
+    if _image_cache is None or _image_cache.cache_dir != config.TRAIN.IMAGE_CACHE_DIR:
+        _image_cache = ImageCache(config.TRAIN.IMAGE_CACHE_DIR, int(config.TRAIN.IMAGE_CACHE_GB * (1 << 30)))
+    return _image_cache
+
+
+# names of the imread flags decoding at 1 / factor of the image size, jpeg decodes it at reduced cost
+_REDUCED_FLAGS = [(8, 'IMREAD_REDUCED_COLOR_8'), (4, 'IMREAD_REDUCED_COLOR_4'), (2, 'IMREAD_REDUCED_COLOR_2')]
+
+
+def imread_resized(roi_rec, target_size, max_size, cache=None):
+    """
+    read the image of roi_rec, flipped if roi_rec['flipped'], and resize it to target size.
+    with config.IMAGE_REDUCED_DECODE, images shrunk to 1/2 or less are decoded at reduced size
+    :param roi_rec: roidb record with 'image', 'flipped', 'height' and 'width'
+    :param target_size: one dimensional size (the short side)
+    :param max_size: one dimensional max size (the long side)
+    :param cache: ImageCache of resized images, flipped images are views of the cached ones
+    :return: [height, width, channel] image in BGR, scale
+    """
+    height, width = roi_rec.get('height'), roi_rec.get('width')
+    if cache is not None and height and width:
+        key = (os.path.abspath(roi_rec['image']), target_size, max_size, config.IMAGE_REDUCED_DECODE)
+        unflipped_rec = dict(roi_rec, flipped=False)
+        im = cache.get(key, lambda: imread_resized(unflipped_rec, target_size, max_size)[0])
+        if roi_rec['flipped']:
+            im = im[:, ::-1, :]
+        return im, get_scale(height, width, target_size, max_size)
+    if config.IMAGE_REDUCED_DECODE and height and width:
+        im_scale = get_scale(height, width, target_size, max_size)
+        for factor, flag_name in _REDUCED_FLAGS:
+            # not in every opencv build
+            flag = getattr(cv2, flag_name, None)
+            if im_scale * factor > 1 or flag is None:
+                continue
+            im = cv2.imread(roi_rec['image'], flag)
+            # fall back to full decoding if the file does not match roidb
+            if im is None or abs(im.shape[0] * factor - height) >= factor or \
+                    abs(im.shape[1] * factor - width) >= factor:
+                break
+            if roi_rec['flipped']:
+                im = im[:, ::-1, :]
+            dsize = (int(np.round(width * im_scale)), int(np.round(height * im_scale)))
+            return cv2.resize(im, dsize, interpolation=cv2.INTER_LINEAR), im_scale
+    im = cv2.imread(roi_rec['image'])
+    if roi_rec['flipped']:
+        im = im[:, ::-1, :]
+    return resize(im, target_size, max_size)
+
+
+def get_scale(height, width, target_size, max_size):
+    """
+    scale resizing the short side to target size, unless the long side exceeds max size
+    :param height: image height
+    :param width: image width
+    :param target_size: one dimensional size (the short side)
+    :param max_size: one dimensional max size (the long side)
+    :return: scale
+    """
+    im_size_min = min(height, width)
+    im_size_max = max(height, width)
+    im_scale = float(target_size) / float(im_size_min)
+    # prevent bigger axis from being more than max_size:
+    if np.round(im_scale * im_size_max) > max_size:
+        im_scale = float(max_size) / float(im_size_max)
+    return im_scale
+
+
 def resize(im, target_size, max_size, stride=0):
     """
     only resize input image to target size and return scale
@@ -71,13 +148,7 @@ def resize(im, target_size, max_size, stride=0):
     :param stride: if given, pad the image to designated stride
     :return:
     """
-    im_shape = im.shape
-    im_size_min = np.min(im_shape[0:2])
-    im_size_max = np.max(im_shape[0:2])
-    im_scale = float(target_size) / float(im_size_min)
-    # prevent bigger axis from being more than max_size:
-    if np.round(im_scale * im_size_max) > max_size:
-        im_scale = float(max_size) / float(im_size_max)
+    im_scale = get_scale(im.shape[0], im.shape[1], target_size, max_size)
     im = cv2.resize(im, None, None, fx=im_scale, fy=im_scale, interpolation=cv2.INTER_LINEAR)
 
     if stride == 0:
@@ -87,22 +158,32 @@ def resize(im, target_size, max_size, stride=0):
         im_height = int(np.ceil(im.shape[0] / float(stride)) * stride)
         im_width = int(np.ceil(im.shape[1] / float(stride)) * stride)
         im_channel = im.shape[2]
-        padded_im = np.zeros((im_height, im_width, im_channel))
+        padded_im = np.zeros((im_height, im_width, im_channel), dtype=im.dtype)
         padded_im[:im.shape[0], :im.shape[1], :] = im
         return padded_im, im_scale
 
 
-def transform(im, pixel_means):
+def transform(im, pixel_means, stride=0):
     """
     transform into mxnet tensor,
     subtract pixel size and transform to correct format
     :param im: [height, width, channel] in BGR
     :param pixel_means: [B, G, R pixel means]
-    :return: [batch, channel, height, width]
+    :param stride: if given, pad the tensor to designated stride, as resize with zeros
+    :return: [batch, channel, height, width] in float32
     """
-    im_tensor = np.zeros((1, 3, im.shape[0], im.shape[1]))
-    for i in range(3):
-        im_tensor[0, i, :, :] = im[:, :, 2 - i] - pixel_means[2 - i]
+    height, width = im.shape[:2]
+    if stride:
+        im_height = int(np.ceil(height / float(stride)) * stride)
+        im_width = int(np.ceil(width / float(stride)) * stride)
+    else:
+        im_height, im_width = height, width
+    means = np.asarray(pixel_means, dtype=np.float32)[::-1].reshape((3, 1, 1))
+    im_tensor = np.empty((1, 3, im_height, im_width), dtype=np.float32)
+    # swap to RGB, transpose and subtract means in one pass
+    np.subtract(im[:, :, ::-1].transpose((2, 0, 1)), means, out=im_tensor[0, :, :height, :width])
+    im_tensor[0, :, height:, :] = -means
+    im_tensor[0, :, :height, width:] = -means
     return im_tensor
 
 
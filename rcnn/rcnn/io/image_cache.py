@@ -0,0 +1,120 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+import os
+import time
+import numpy as np
+
+# temporary files older than this are left by killed writers
+_STALE_TMP_SECONDS = 600
+
+
+class ImageCache(object):
+    """
+    On-disk cache of preprocessed images, stored as .npy files and memory-mapped when read.
+    Once the files take more than max_bytes the least recently used ones are removed,
+    processes can share a cache directory.
+    :param cache_dir: directory of the cache files, best on a local disk
+    :param max_bytes: size cap of the cache files
+    """
+    def __init__(self, cache_dir, max_bytes):
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # created by another process meanwhile
+                assert os.path.isdir(cache_dir), 'can not create %s' % cache_dir
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._used = self.evict()
+
+    def get(self, key, create):
+        """
+        cached array of key, or create() and store it on a miss
+        :param key: key with a stable repr, such as a tuple of str and numbers
+        :param create: function returning the array
+        :return: read only memory-mapped array on a hit
+        """
+        path = os.path.join(self.cache_dir, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.npy')
+        try:
+            arr = np.load(path, mmap_mode='r')
+            # access time for lru, atime is often not updated
+            os.utime(path, None)
+            self.hits += 1
+            return arr
+        except (IOError, OSError, ValueError):
+            # missing, or corrupt and written again below
+            pass
+        self.misses += 1
+        arr = create()
+        self._put(path, arr)
+        return arr
+
+    def _put(self, path, arr):
+        # write then rename, so that readers never see a partial file
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(arr))
+        os.rename(tmp_path, path)
+        self._used += os.path.getsize(path)
+        if self._used > self.max_bytes:
+            self._used = self.evict()
+
+    def evict(self):
+        """
+        remove stale temporary files, and least recently used files until the cache
+        takes 90% of max_bytes
+        :return: bytes used by the cache
+        """
+        entries = []
+        used = 0
+        now = time.time()
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npy') and not name.endswith('.tmp'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+                if name.endswith('.tmp') and now - st.st_mtime > _STALE_TMP_SECONDS:
+                    os.remove(path)
+                    continue
+            except OSError:
+                continue
+            used += st.st_size
+            # temporary files being written count, but are not evicted
+            if name.endswith('.npy'):
+                entries.append((st.st_mtime, st.st_size, path))
+        if used <= self.max_bytes:
+            return used
+        entries.sort()
+        for _, size, path in entries:
+            if used <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # removed by another process
+                pass
+            used -= size
+        return used
+
+    def stats(self):
+        """ cache statistics of this process as a dict """
+        return {'hits': self.hits, 'misses': self.misses, 'bytes': self._used}
@@ -200,6 +200,104 @@ def sample_rois(rois, fg_rois_per_image, rois_per_image, num_classes, gt_boxes,
         return rois, labels, bbox_targets, bbox_weights
 
 
+def sample_rois_batch(rois, fg_rois_per_image, rois_per_image, num_classes, gt_boxes):
+    """
+    sample_rois for the rois of all images of a batch in one pass
+    :param rois: [n, 5] (batch_index, x1, y1, x2, y2) of all images
+    :param fg_rois_per_image: foreground roi number of each image
+    :param rois_per_image: total roi number of each image
+    :param num_classes: number of classes
+    :param gt_boxes: [num_images, k, 5] (x1, y1, x2, y2, cls), padded with cls 0
+    :return: (rois, labels, bbox_targets, bbox_weights), rois_per_image of each image in batch order
+    """
+    num_images = gt_boxes.shape[0]
+    batch_inds = rois[:, 0].astype(int)
+    num_rois = rois.shape[0]
+
+    # overlaps of each roi with the gt boxes of its own image, computed once
+    overlaps = _image_overlaps(rois[:, 1:].astype(np.float), gt_boxes[batch_inds, :, :4].astype(np.float))
+    overlaps[gt_boxes[batch_inds, :, 4] <= 0] = -1
+    gt_assignment = overlaps.argmax(axis=1)
+    # rois of images without gt boxes are background
+    overlaps = np.maximum(overlaps[np.arange(num_rois), gt_assignment], 0)
+    labels = gt_boxes[batch_inds, gt_assignment, 4]
+
+    # foreground RoI with FG_THRESH overlap,
+    # background RoIs as those within [BG_THRESH_LO, BG_THRESH_HI)
+    is_fg = overlaps >= config.TRAIN.FG_THRESH
+    is_bg = (overlaps < config.TRAIN.BG_THRESH_HI) & (overlaps >= config.TRAIN.BG_THRESH_LO)
+
+    # sample without replacement: keep the rois of random rank below the quota of the image,
+    # guarding against the case when an image has fewer rois than desired
+    fg_per_image = np.minimum(np.bincount(batch_inds[is_fg], minlength=num_images), fg_rois_per_image)
+    bg_per_image = np.minimum(np.bincount(batch_inds[is_bg], minlength=num_images),
+                              rois_per_image - fg_per_image)
+    fg_indexes = np.where(is_fg & (_random_rank(batch_inds, is_fg) < fg_per_image[batch_inds]))[0]
+    bg_indexes = np.where(is_bg & (_random_rank(batch_inds, is_bg) < bg_per_image[batch_inds]))[0]
+
+    # pad with more negative rois to ensure a fixed minibatch size
+    pad_per_image = rois_per_image - fg_per_image - bg_per_image
+    pad_indexes = [np.zeros((0,), dtype=int)]
+    for i in np.where(pad_per_image > 0)[0]:
+        neg_idx = np.where((batch_inds == i) & (overlaps < config.TRAIN.FG_THRESH))[0]
+        assert neg_idx.size > 0, 'no negative roi to pad image {}'.format(i)
+        pad_indexes.append(np.resize(npr.permutation(neg_idx), pad_per_image[i]))
+    pad_indexes = np.hstack(pad_indexes)
+
+    # indexes selected, ordered by image, then foreground, background and padding
+    keep_indexes = np.hstack((fg_indexes, bg_indexes, pad_indexes))
+    group = np.hstack((np.zeros(fg_indexes.size), np.ones(bg_indexes.size), np.full(pad_indexes.size, 2)))
+    order = np.lexsort((group, batch_inds[keep_indexes]))
+    keep_indexes = keep_indexes[order]
+
+    # select labels, set labels of bg_rois to be 0
+    labels = labels[keep_indexes]
+    labels[group[order] > 0] = 0
+    rois = rois[keep_indexes]
+
+    # compute bbox_target
+    gt_inds = gt_assignment[keep_indexes]
+    targets = bbox_transform(rois[:, 1:], gt_boxes[batch_inds[keep_indexes], gt_inds, :4])
+    if config.TRAIN.BBOX_NORMALIZATION_PRECOMPUTED:
+        targets = ((targets - np.array(config.TRAIN.BBOX_MEANS))
+                   / np.array(config.TRAIN.BBOX_STDS))
+    bbox_target_data = np.hstack((labels[:, np.newaxis], targets))
+
+    bbox_targets, bbox_weights = \
+        expand_bbox_regression_targets(bbox_target_data, num_classes)
+
+    return rois, labels, bbox_targets, bbox_weights
+
+
+def _image_overlaps(boxes, gt_boxes):
+    """
+    overlaps between each box and the gt boxes of its image
+    :param boxes: [n, 4]
+    :param gt_boxes: [n, k, 4], gt boxes of the image of each box
+    :return: overlaps [n, k]
+    """
+    iw = np.minimum(boxes[:, np.newaxis, 2], gt_boxes[:, :, 2]) - \
+        np.maximum(boxes[:, np.newaxis, 0], gt_boxes[:, :, 0]) + 1
+    ih = np.minimum(boxes[:, np.newaxis, 3], gt_boxes[:, :, 3]) - \
+        np.maximum(boxes[:, np.newaxis, 1], gt_boxes[:, :, 1]) + 1
+    box_areas = (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+    gt_areas = (gt_boxes[:, :, 2] - gt_boxes[:, :, 0] + 1) * (gt_boxes[:, :, 3] - gt_boxes[:, :, 1] + 1)
+    inter = np.maximum(iw, 0) * np.maximum(ih, 0)
+    return inter / (box_areas[:, np.newaxis] + gt_areas - inter)
+
+
+def _random_rank(groups, mask):
+    """
+    rank of each element in mask among the ones of the same group, in random order
+    """
+    inds = np.where(mask)[0]
+    order = inds[np.lexsort((npr.rand(inds.size), groups[inds]))]
+    sorted_groups = groups[order]
+    ranks = np.zeros(groups.shape, dtype=int)
+    ranks[order] = np.arange(order.size) - np.searchsorted(sorted_groups, sorted_groups)
+    return ranks
+
+
 def _sample_part_info(rois, fg_indexes, head_bbs, joints, gt_assignment):
     '''
     Required part information (currently MPII only):
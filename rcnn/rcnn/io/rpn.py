@@ -28,6 +28,7 @@ label =
 """
 
 import logging
+from collections import OrderedDict
 import numpy as np
 import numpy.random as npr
 
@@ -59,35 +60,45 @@ def get_rpn_testbatch(roidb):
 def get_rpn_batch(roidb):
     """
     prototype for rpn batch: data, im_info, gt_boxes
-    :param roidb: ['image', 'flipped'] + ['gt_boxes', 'boxes', 'gt_classes']
+    :param roidb: ['image', 'flipped'] + ['gt_boxes', 'boxes', 'gt_classes'], one record per image
     :return: data, label
+    'im_info': one row per image
+    'gt_boxes': (num_images, max gt, 5), padded with rows of class 0
     """
-    assert len(roidb) == 1, 'Single batch only'
+    num_images = len(roidb)
     imgs, roidb = get_image(roidb, is_test=False)
-    im_array = imgs[0]
-    im_info = np.array([roidb[0]['im_info']], dtype=np.float32)
-
-    # gt boxes: (x1, y1, x2, y2, cls)
-    if roidb[0]['gt_classes'].size > 0:
-        gt_inds = np.where(roidb[0]['gt_classes'] != 0)[0]
-        gt_boxes = np.empty((roidb[0]['boxes'].shape[0], 5), dtype=np.float32)
-        gt_boxes[:, 0:4] = roidb[0]['boxes'][gt_inds, :]
-        gt_boxes[:, 4] = roidb[0]['gt_classes'][gt_inds]
-        if config.HAS_PART:
-            gt_head_boxes = roidb[0]['heads'].astype(np.float32)
-            gt_joints = roidb[0]['joints'].astype(np.float32)
-    else:
-        gt_boxes = np.empty((0, 5), dtype=np.float32)
+    im_array = tensor_vstack(imgs)
+    im_info = np.array([roi_rec['im_info'] for roi_rec in roidb], dtype=np.float32)
+
+    gt_boxes_list = []
+    gt_head_boxes_list = []
+    gt_joints_list = []
+    for roi_rec in roidb:
+        # gt boxes: (x1, y1, x2, y2, cls)
+        if roi_rec['gt_classes'].size > 0:
+            gt_inds = np.where(roi_rec['gt_classes'] != 0)[0]
+            gt_boxes = np.empty((roi_rec['boxes'].shape[0], 5), dtype=np.float32)
+            gt_boxes[:, 0:4] = roi_rec['boxes'][gt_inds, :]
+            gt_boxes[:, 4] = roi_rec['gt_classes'][gt_inds]
+            if config.HAS_PART:
+                gt_head_boxes = roi_rec['heads'].astype(np.float32)
+                gt_joints = roi_rec['joints'].astype(np.float32)
+        else:
+            gt_boxes = np.empty((0, 5), dtype=np.float32)
+            if config.HAS_PART:
+                gt_head_boxes = np.empty((0, 4), dtype=np.float32)
+                gt_joints = np.empty((0, 12), dtype=np.float32)
+        gt_boxes_list.append(gt_boxes[np.newaxis, :, :])
         if config.HAS_PART:
-            gt_head_boxes = np.empty((0, 4), dtype=np.float32)
-            gt_joints = np.empty((0, 12), dtype=np.float32)
+            gt_head_boxes_list.append(gt_head_boxes[np.newaxis, :, :])
+            gt_joints_list.append(gt_joints[np.newaxis, :, :])
 
     data = {'data': im_array,
             'im_info': im_info}
-    label = {'gt_boxes': gt_boxes}
+    label = {'gt_boxes': tensor_vstack(gt_boxes_list)}
     if config.HAS_PART:
-        label['gt_head_boxes'] = gt_head_boxes
-        label['gt_joints'] = gt_joints
+        label['gt_head_boxes'] = tensor_vstack(gt_head_boxes_list)
+        label['gt_joints'] = tensor_vstack(gt_joints_list)
 
     return data, label
 
@@ -122,45 +133,17 @@ def assign_anchor(feat_shape, gt_boxes, im_info, feat_stride=16,
         return ret
 
     im_info = im_info[0]
-    scales = np.array(scales, dtype=np.float32)
-    base_anchors = generate_anchors(base_size=feat_stride, ratios=list(ratios), scales=scales)
-    num_anchors = base_anchors.shape[0]
     feat_height, feat_width = feat_shape[-2:]
+    anchors, inds_inside, total_anchors, A = _anchor_template(
+        feat_height, feat_width, im_info[0], im_info[1], feat_stride, scales, ratios, allowed_border)
 
-    logger.debug('anchors: %s' % base_anchors)
-    logger.debug('anchor shapes: %s' % np.hstack((base_anchors[:, 2::4] - base_anchors[:, 0::4],
-                                                 base_anchors[:, 3::4] - base_anchors[:, 1::4])))
-    logger.debug('im_info %s' % im_info)
-    logger.debug('height %d width %d' % (feat_height, feat_width))
-    logger.debug('gt_boxes shape %s' % np.array(gt_boxes.shape))
-    logger.debug('gt_boxes %s' % gt_boxes)
-
-    # 1. generate proposals from bbox deltas and shifted anchors
-    shift_x = np.arange(0, feat_width) * feat_stride
-    shift_y = np.arange(0, feat_height) * feat_stride
-    shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-    shifts = np.vstack((shift_x.ravel(), shift_y.ravel(), shift_x.ravel(), shift_y.ravel())).transpose()
-    # add A anchors (1, A, 4) to
-    # cell K shifts (K, 1, 4) to get
-    # shift anchors (K, A, 4)
-    # reshape to (K*A, 4) shifted anchors
-    A = num_anchors
-    K = shifts.shape[0]
-    all_anchors = base_anchors.reshape((1, A, 4)) + shifts.reshape((1, K, 4)).transpose((1, 0, 2))
-    all_anchors = all_anchors.reshape((K * A, 4))
-    total_anchors = int(K * A)
-
-    # only keep anchors inside the image
-    inds_inside = np.where((all_anchors[:, 0] >= -allowed_border) &
-                           (all_anchors[:, 1] >= -allowed_border) &
-                           (all_anchors[:, 2] < im_info[1] + allowed_border) &
-                           (all_anchors[:, 3] < im_info[0] + allowed_border))[0]
-    logger.debug('total_anchors %d' % total_anchors)
-    logger.debug('inds_inside %d' % len(inds_inside))
-
-    # keep only inside anchors
-    anchors = all_anchors[inds_inside, :]
-    logger.debug('anchors shape %s' % np.array(anchors.shape))
+    logger.debug('im_info %s', im_info)
+    logger.debug('height %d width %d', feat_height, feat_width)
+    logger.debug('gt_boxes shape %s', np.array(gt_boxes.shape))
+    logger.debug('gt_boxes %s', gt_boxes)
+    logger.debug('total_anchors %d', total_anchors)
+    logger.debug('inds_inside %d', len(inds_inside))
+    logger.debug('anchors shape %s', np.array(anchors.shape))
 
     # label: 1 is positive, 0 is negative, -1 is dont care
     labels = np.empty((len(inds_inside),), dtype=np.float32)
@@ -168,13 +151,7 @@ def assign_anchor(feat_shape, gt_boxes, im_info, feat_stride=16,
 
     if gt_boxes.size > 0:
         # overlap between the anchors and the gt boxes
-        # overlaps (ex, gt)
-        overlaps = bbox_overlaps(anchors.astype(np.float), gt_boxes.astype(np.float))
-        argmax_overlaps = overlaps.argmax(axis=1)
-        max_overlaps = overlaps[np.arange(len(inds_inside)), argmax_overlaps]
-        gt_argmax_overlaps = overlaps.argmax(axis=0)
-        gt_max_overlaps = overlaps[gt_argmax_overlaps, np.arange(overlaps.shape[1])]
-        gt_argmax_overlaps = np.where(overlaps == gt_max_overlaps)[0]
+        argmax_overlaps, max_overlaps, gt_argmax_overlaps = _anchor_gt_overlaps(anchors, gt_boxes)
 
         if not config.TRAIN.RPN_CLOBBER_POSITIVES:
             # assign bg labels first so that positive labels can clobber them
@@ -251,3 +228,99 @@ def assign_anchor(feat_shape, gt_boxes, im_info, feat_stride=16,
              'bbox_target': bbox_targets,
              'bbox_weight': bbox_weights}
     return label
+
+
+# anchor templates of recently seen (feature map, image) sizes
+_anchor_templates = OrderedDict()
+_MAX_ANCHOR_TEMPLATES = 32
+
+
+def _anchor_template(feat_height, feat_width, im_height, im_width, feat_stride, scales, ratios, allowed_border):
+    """
+    shifted anchors inside the image, cached since they only depend on the sizes and the anchor settings
+    :return: anchors inside [N, 4], their indexes inds_inside in all anchors, total number of anchors,
+    number of anchors per location
+    """
+    key = (int(feat_height), int(feat_width), float(im_height), float(im_width), feat_stride,
+           tuple(scales), tuple(ratios), allowed_border)
+    template = _anchor_templates.pop(key, None)
+    if template is None:
+        template = _make_anchor_template(feat_height, feat_width, im_height, im_width,
+                                         feat_stride, scales, ratios, allowed_border)
+        while len(_anchor_templates) >= _MAX_ANCHOR_TEMPLATES:
+            _anchor_templates.popitem(last=False)
+    _anchor_templates[key] = template
+    return template
+
+
+def _make_anchor_template(feat_height, feat_width, im_height, im_width, feat_stride, scales, ratios, allowed_border):
+    scales = np.array(scales, dtype=np.float32)
+    base_anchors = generate_anchors(base_size=feat_stride, ratios=list(ratios), scales=scales)
+    num_anchors = base_anchors.shape[0]
+
+    logger.debug('anchors: %s' % base_anchors)
+    logger.debug('anchor shapes: %s' % np.hstack((base_anchors[:, 2::4] - base_anchors[:, 0::4],
+                                                 base_anchors[:, 3::4] - base_anchors[:, 1::4])))
+
+    # 1. generate proposals from bbox deltas and shifted anchors
+    shift_x = np.arange(0, feat_width) * feat_stride
+    shift_y = np.arange(0, feat_height) * feat_stride
+    shift_x, shift_y = np.meshgrid(shift_x, shift_y)
+    shifts = np.vstack((shift_x.ravel(), shift_y.ravel(), shift_x.ravel(), shift_y.ravel())).transpose()
+    # add A anchors (1, A, 4) to
+    # cell K shifts (K, 1, 4) to get
+    # shift anchors (K, A, 4)
+    # reshape to (K*A, 4) shifted anchors
+    A = num_anchors
+    K = shifts.shape[0]
+    all_anchors = base_anchors.reshape((1, A, 4)) + shifts.reshape((1, K, 4)).transpose((1, 0, 2))
+    all_anchors = all_anchors.reshape((K * A, 4))
+    total_anchors = int(K * A)
+
+    # only keep anchors inside the image
+    inds_inside = np.where((all_anchors[:, 0] >= -allowed_border) &
+                           (all_anchors[:, 1] >= -allowed_border) &
+                           (all_anchors[:, 2] < im_width + allowed_border) &
+                           (all_anchors[:, 3] < im_height + allowed_border))[0]
+
+    # keep only inside anchors, shared by all the images of the same size
+    anchors = all_anchors[inds_inside, :].astype(np.float)
+    anchors.flags.writeable = False
+    inds_inside.flags.writeable = False
+    return anchors, inds_inside, total_anchors, A
+
+
+def _anchor_gt_overlaps(anchors, gt_boxes):
+    """
+    overlaps between the anchors and the gt boxes, reduced to what assign_anchor needs.
+    anchors out of the bounding box of all gt boxes have no overlap with any of them,
+    so overlaps are only computed for the anchors near the gt boxes.
+    :param anchors: [N, 4]
+    :param gt_boxes: [K, 5]
+    :return: argmax_overlaps [N], the best gt of each anchor
+    max_overlaps [N], overlap with the best gt
+    gt_argmax_overlaps, anchors having the max overlap of any gt
+    """
+    gt = gt_boxes[:, :4].astype(np.float)
+    # boxes cover x2 - x1 + 1 pixels, so an anchor ending 1 pixel before a gt still overlaps it
+    near = np.where((anchors[:, 2] >= gt[:, 0].min() - 1) & (anchors[:, 0] <= gt[:, 2].max() + 1) &
+                    (anchors[:, 3] >= gt[:, 1].min() - 1) & (anchors[:, 1] <= gt[:, 3].max() + 1))[0]
+
+    argmax_overlaps = np.zeros((anchors.shape[0],), dtype=np.int64)
+    max_overlaps = np.zeros((anchors.shape[0],), dtype=np.float)
+    if near.size == 0:
+        # every anchor has the max overlap (0) of every gt
+        return argmax_overlaps, max_overlaps, np.arange(anchors.shape[0])
+
+    # overlaps (ex, gt)
+    overlaps = bbox_overlaps(anchors[near], gt)
+    argmax_overlaps[near] = overlaps.argmax(axis=1)
+    max_overlaps[near] = overlaps[np.arange(near.size), argmax_overlaps[near]]
+    gt_max_overlaps = overlaps.max(axis=0)
+    gt_argmax_overlaps = near[np.where(overlaps == gt_max_overlaps)[0]]
+    if np.any(gt_max_overlaps == 0):
+        # anchors away from the gt boxes also have the max overlap (0) of some gt
+        far = np.ones((anchors.shape[0],), dtype=bool)
+        far[near] = False
+        gt_argmax_overlaps = np.union1d(gt_argmax_overlaps, np.where(far)[0])
+    return argmax_overlaps, max_overlaps, gt_argmax_overlaps
@@ -127,10 +127,8 @@ def expand_bbox_regression_targets(bbox_targets_data, num_classes, bbox_dim=4):
     bbox_targets = np.zeros((classes.size, bbox_dim * num_classes), dtype=np.float32)
     bbox_weights = np.zeros(bbox_targets.shape, dtype=np.float32)
     indexes = np.where(classes > 0)[0]
-    for index in indexes:
-        cls = classes[index]
-        start = int(bbox_dim * cls)
-        end = start + bbox_dim
-        bbox_targets[index, start:end] = bbox_targets_data[index, 1:]
-        bbox_weights[index, start:end] = config.TRAIN.BBOX_WEIGHTS[:bbox_dim]
+    rows = indexes[:, np.newaxis]
+    cols = (bbox_dim * classes[indexes]).astype(int)[:, np.newaxis] + np.arange(bbox_dim)
+    bbox_targets[rows, cols] = bbox_targets_data[indexes, 1:]
+    bbox_weights[rows, cols] = config.TRAIN.BBOX_WEIGHTS[:bbox_dim]
     return bbox_targets, bbox_weights
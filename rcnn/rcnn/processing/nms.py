@@ -15,8 +15,16 @@
 # specific language governing permissions and limitations
 # under the License.
 
+from __future__ import absolute_import
+import os
+import sys
 import numpy as np
-from ..cython.cpu_nms import cpu_nms
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..'))
+from nms import nms as shared_nms
+try:
+    from ..cython.cpu_nms import cpu_nms
+except ImportError:
+    cpu_nms = None
 try:
     from ..cython.gpu_nms import gpu_nms
 except ImportError:
@@ -32,7 +40,10 @@ def py_nms_wrapper(thresh):
 def cpu_nms_wrapper(thresh):
     def _nms(dets):
         return cpu_nms(dets, thresh)
-    return _nms
+    if cpu_nms is not None:
+        return _nms
+    else:
+        return py_nms_wrapper(thresh)
 
 
 def gpu_nms_wrapper(thresh, device_id):
@@ -44,6 +55,17 @@ def gpu_nms_wrapper(thresh, device_id):
         return cpu_nms_wrapper(thresh)
 
 
+def ctx_nms_wrapper(thresh, ctx):
+    """
+    nms backend for the device of ctx: the gpu kernel for gpu contexts,
+    otherwise cython cpu_nms, or numpy nms if cpu_nms is not built
+    :param ctx: mx.Context
+    """
+    if ctx.device_type == 'gpu':
+        return gpu_nms_wrapper(thresh, ctx.device_id)
+    return cpu_nms_wrapper(thresh)
+
+
 def nms(dets, thresh):
     """
     greedily select boxes with high confidence and overlap with current maximum <= thresh
@@ -52,30 +74,4 @@ def nms(dets, thresh):
     :param thresh: retain overlap < thresh
     :return: indexes to keep
     """
-    x1 = dets[:, 0]
-    y1 = dets[:, 1]
-    x2 = dets[:, 2]
-    y2 = dets[:, 3]
-    scores = dets[:, 4]
-
-    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
-    order = scores.argsort()[::-1]
-
-    keep = []
-    while order.size > 0:
-        i = order[0]
-        keep.append(i)
-        xx1 = np.maximum(x1[i], x1[order[1:]])
-        yy1 = np.maximum(y1[i], y1[order[1:]])
-        xx2 = np.minimum(x2[i], x2[order[1:]])
-        yy2 = np.minimum(y2[i], y2[order[1:]])
-
-        w = np.maximum(0.0, xx2 - xx1 + 1)
-        h = np.maximum(0.0, yy2 - yy1 + 1)
-        inter = w * h
-        ovr = inter / (areas[i] + areas[order[1:]] - inter)
-
-        inds = np.where(ovr <= thresh)[0]
-        order = order[inds + 1]
-
-    return keep
+    return shared_nms(dets[:, :4], dets[:, 4], thresh, offset=1)
@@ -28,7 +28,7 @@ from distutils.util import strtobool
 from rcnn.logger import logger
 from rcnn.processing.bbox_transform import bbox_pred, clip_boxes
 from rcnn.processing.generate_anchor import generate_anchors
-from rcnn.processing.nms import py_nms_wrapper, cpu_nms_wrapper, gpu_nms_wrapper
+from rcnn.processing.nms import py_nms_wrapper, cpu_nms_wrapper, gpu_nms_wrapper, ctx_nms_wrapper
 
 
 class ProposalOperator(mx.operator.CustomOp):
@@ -45,16 +45,17 @@ class ProposalOperator(mx.operator.CustomOp):
         self._rpn_post_nms_top_n = rpn_post_nms_top_n
         self._threshold = threshold
         self._rpn_min_size = rpn_min_size
+        self._anchor_cache = {}
+        self._max_cached_anchors = 64
 
         logger.debug('feat_stride: %s' % self._feat_stride)
         logger.debug('anchors:\n%s' % self._anchors)
 
     def forward(self, is_train, req, in_data, out_data, aux):
-        nms = gpu_nms_wrapper(self._threshold, in_data[0].context.device_id)
+        # gpu kernel on gpu, cython or numpy nms on cpu-only nodes
+        nms = ctx_nms_wrapper(self._threshold, in_data[0].context)
 
         batch_size = in_data[0].shape[0]
-        if batch_size > 1:
-            raise ValueError("Sorry, multiple images each device is not implemented")
 
         # for each (H, W) location i
         #   generate A anchor boxes centered on cell i
@@ -75,95 +76,154 @@ class ProposalOperator(mx.operator.CustomOp):
         # keep the second part
         scores = in_data[0].asnumpy()[:, self._num_anchors:, :, :]
         bbox_deltas = in_data[1].asnumpy()
-        im_info = in_data[2].asnumpy()[0, :]
+        im_info = in_data[2].asnumpy()
 
         logger.debug('im_info: %s' % im_info)
 
-        # 1. Generate proposals from bbox_deltas and shifted anchors
-        # use real image size instead of padded feature map sizes
-        height, width = int(im_info[0] / self._feat_stride), int(im_info[1] / self._feat_stride)
+        # use real image size instead of padded feature map sizes,
+        # images of the same size are processed together
+        sizes = [(int(im_info[i, 0] / self._feat_stride), int(im_info[i, 1] / self._feat_stride))
+                 for i in range(batch_size)]
+        proposals_all = [None] * batch_size
+        scores_all = [None] * batch_size
+        for size in sorted(set(sizes)):
+            idx = [i for i in range(batch_size) if sizes[i] == size]
+            props, scs = self._top_proposals(scores[idx], bbox_deltas[idx], im_info[idx], size,
+                                             pre_nms_topN, min_size)
+            for k, i in enumerate(idx):
+                proposals_all[i] = props[k]
+                scores_all[i] = scs[k]
+
+        blobs = []
+        out_scores = []
+        for i in range(batch_size):
+            proposals = proposals_all[i]
+            scores = scores_all[i][:, np.newaxis]
+
+            # 6. apply nms (e.g. threshold = 0.7)
+            # 7. take after_nms_topN (e.g. 300)
+            # 8. return the top proposals (-> RoIs top)
+            det = np.hstack((proposals, scores)).astype(np.float32)
+            keep = nms(det)
+            if post_nms_topN > 0:
+                keep = keep[:post_nms_topN]
+            # pad to ensure output size remains unchanged
+            if len(keep) < post_nms_topN:
+                pad = npr.choice(keep, size=post_nms_topN - len(keep))
+                keep = np.hstack((keep, pad))
+            proposals = proposals[keep, :]
+            scores = scores[keep]
+
+            # Output rois array, with the batch index of each roi
+            batch_inds = np.full((proposals.shape[0], 1), i, dtype=np.float32)
+            blobs.append(np.hstack((batch_inds, proposals.astype(np.float32, copy=False))))
+            out_scores.append(scores.astype(np.float32, copy=False))
+
+        self.assign(out_data[0], req[0], np.vstack(blobs))
 
-        logger.debug('score map size: (%d, %d)' % (scores.shape[2], scores.shape[3]))
-        logger.debug('resudial: (%d, %d)' % (scores.shape[2] - height, scores.shape[3] - width))
+        if self._output_score:
+            self.assign(out_data[1], req[1], np.vstack(out_scores))
 
-        # Enumerate all shifts
-        shift_x = np.arange(0, width) * self._feat_stride
-        shift_y = np.arange(0, height) * self._feat_stride
-        shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-        shifts = np.vstack((shift_x.ravel(), shift_y.ravel(), shift_x.ravel(), shift_y.ravel())).transpose()
+    def _top_proposals(self, scores, bbox_deltas, im_info, size, pre_nms_topN, min_size):
+        """
+        decode, clip and filter proposals of images with the same feature map size,
+        and take the top pre_nms_topN of each image
+        :param scores: [n, A, H, W] foreground scores
+        :param bbox_deltas: [n, 4 * A, H, W]
+        :param im_info: [n, 3]
+        :param size: (height, width) of the feature map of the images
+        :return: list of proposals [k, 4] and list of scores [k], sorted by score
+        """
+        n = scores.shape[0]
+        height, width = size
 
-        # Enumerate all shifted anchors:
-        #
-        # add A anchors (1, A, 4) to
-        # cell K shifts (K, 1, 4) to get
-        # shift anchors (K, A, 4)
-        # reshape to (K*A, 4) shifted anchors
-        A = self._num_anchors
-        K = shifts.shape[0]
-        anchors = self._anchors.reshape((1, A, 4)) + shifts.reshape((1, K, 4)).transpose((1, 0, 2))
-        anchors = anchors.reshape((K * A, 4))
+        # 1. Generate proposals from bbox_deltas and shifted anchors
+        anchors = self._shifted_anchors(height, width)
 
         # Transpose and reshape predicted bbox transformations to get them
         # into the same order as the anchors:
         #
-        # bbox deltas will be (1, 4 * A, H, W) format
-        # transpose to (1, H, W, 4 * A)
-        # reshape to (1 * H * W * A, 4) where rows are ordered by (h, w, a)
+        # bbox deltas will be (n, 4 * A, H, W) format
+        # transpose to (n, H, W, 4 * A)
+        # reshape to (n * H * W * A, 4) where rows are ordered by (n, h, w, a)
         # in slowest to fastest order
         bbox_deltas = self._clip_pad(bbox_deltas, (height, width))
         bbox_deltas = bbox_deltas.transpose((0, 2, 3, 1)).reshape((-1, 4))
 
         # Same story for the scores:
         #
-        # scores are (1, A, H, W) format
-        # transpose to (1, H, W, A)
-        # reshape to (1 * H * W * A, 1) where rows are ordered by (h, w, a)
+        # scores are (n, A, H, W) format
+        # transpose to (n, H, W, A)
+        # reshape to (n, H * W * A) where columns are ordered by (h, w, a)
         scores = self._clip_pad(scores, (height, width))
-        scores = scores.transpose((0, 2, 3, 1)).reshape((-1, 1))
+        scores = scores.transpose((0, 2, 3, 1)).reshape((n, -1))
 
         # Convert anchors into proposals via bbox transformations
-        proposals = bbox_pred(anchors, bbox_deltas)
+        if n > 1:
+            anchors = np.tile(anchors, (n, 1))
+        proposals = bbox_pred(anchors, bbox_deltas).reshape((n, -1, 4))
 
         # 2. clip predicted boxes to image
-        proposals = clip_boxes(proposals, im_info[:2])
+        max_x = (im_info[:, 1] - 1).reshape((n, 1, 1))
+        max_y = (im_info[:, 0] - 1).reshape((n, 1, 1))
+        proposals[:, :, 0::2] = np.maximum(np.minimum(proposals[:, :, 0::2], max_x), 0)
+        proposals[:, :, 1::2] = np.maximum(np.minimum(proposals[:, :, 1::2], max_y), 0)
 
         # 3. remove predicted boxes with either height or width < threshold
         # (NOTE: convert min_size to input image scale stored in im_info[2])
-        keep = self._filter_boxes(proposals, min_size * im_info[2])
-        proposals = proposals[keep, :]
-        scores = scores[keep]
-
-        # 4. sort all (proposal, score) pairs by score from highest to lowest
-        # 5. take top pre_nms_topN (e.g. 6000)
-        order = scores.ravel().argsort()[::-1]
-        if pre_nms_topN > 0:
-            order = order[:pre_nms_topN]
-        proposals = proposals[order, :]
-        scores = scores[order]
-
-        # 6. apply nms (e.g. threshold = 0.7)
-        # 7. take after_nms_topN (e.g. 300)
-        # 8. return the top proposals (-> RoIs top)
-        det = np.hstack((proposals, scores)).astype(np.float32)
-        keep = nms(det)
-        if post_nms_topN > 0:
-            keep = keep[:post_nms_topN]
-        # pad to ensure output size remains unchanged
-        if len(keep) < post_nms_topN:
-            pad = npr.choice(keep, size=post_nms_topN - len(keep))
-            keep = np.hstack((keep, pad))
-        proposals = proposals[keep, :]
-        scores = scores[keep]
-
-        # Output rois array
-        # Our RPN implementation only supports a single input image, so all
-        # batch inds are 0
-        batch_inds = np.zeros((proposals.shape[0], 1), dtype=np.float32)
-        blob = np.hstack((batch_inds, proposals.astype(np.float32, copy=False)))
-        self.assign(out_data[0], req[0], blob)
+        ws = proposals[:, :, 2] - proposals[:, :, 0] + 1
+        hs = proposals[:, :, 3] - proposals[:, :, 1] + 1
+        min_sizes = (min_size * im_info[:, 2]).reshape((n, 1))
+        valid = (ws >= min_sizes) & (hs >= min_sizes)
+        neg_scores = np.where(valid, -scores, np.inf)
+
+        # 4. take top pre_nms_topN (e.g. 6000) by a partial sort
+        # 5. sort the top (proposal, score) pairs by score from highest to lowest
+        num = neg_scores.shape[1]
+        if 0 < pre_nms_topN < num:
+            top = np.argpartition(neg_scores, pre_nms_topN - 1, axis=1)[:, :pre_nms_topN]
+        else:
+            top = np.tile(np.arange(num), (n, 1))
+        res_proposals = []
+        res_scores = []
+        for i in range(n):
+            order = top[i][valid[i, top[i]]]
+            order = order[np.argsort(neg_scores[i, order], kind='mergesort')]
+            res_proposals.append(proposals[i, order, :])
+            res_scores.append(scores[i, order])
+        return res_proposals, res_scores
+
+    def _shifted_anchors(self, height, width):
+        """
+        anchors shifted to every cell of a (height, width) feature map, [K * A, 4],
+        cached since they only depend on the feature map size
+        """
+        key = (height, width)
+        anchors = self._anchor_cache.get(key)
+        if anchors is not None:
+            return anchors
 
-        if self._output_score:
-            self.assign(out_data[1], req[1], scores.astype(np.float32, copy=False))
+        # Enumerate all shifts
+        shift_x = np.arange(0, width) * self._feat_stride
+        shift_y = np.arange(0, height) * self._feat_stride
+        shift_x, shift_y = np.meshgrid(shift_x, shift_y)
+        shifts = np.vstack((shift_x.ravel(), shift_y.ravel(), shift_x.ravel(), shift_y.ravel())).transpose()
+
+        # Enumerate all shifted anchors:
+        #
+        # add A anchors (1, A, 4) to
+        # cell K shifts (K, 1, 4) to get
+        # shift anchors (K, A, 4)
+        # reshape to (K*A, 4) shifted anchors
+        A = self._num_anchors
+        K = shifts.shape[0]
+        anchors = self._anchors.reshape((1, A, 4)) + shifts.reshape((1, K, 4)).transpose((1, 0, 2))
+        anchors = anchors.reshape((K * A, 4))
+
+        if len(self._anchor_cache) >= self._max_cached_anchors:
+            self._anchor_cache.clear()
+        self._anchor_cache[key] = anchors
+        return anchors
 
     def backward(self, req, out_grad, in_data, out_data, in_grad, aux):
         self.assign(in_grad[0], req[0], 0)
@@ -225,8 +285,8 @@ class ProposalProp(mx.operator.CustomOpProp):
 
         batch_size = cls_prob_shape[0]
         im_info_shape = (batch_size, 3)
-        output_shape = (self._rpn_post_nms_top_n, 5)
-        score_shape = (self._rpn_post_nms_top_n, 1)
+        output_shape = (batch_size * self._rpn_post_nms_top_n, 5)
+        score_shape = (batch_size * self._rpn_post_nms_top_n, 1)
 
         if self._output_score:
             return [cls_prob_shape, bbox_pred_shape, im_info_shape], [output_shape, score_shape]
@@ -25,7 +25,7 @@ import numpy as np
 from distutils.util import strtobool
 
 from ..logger import logger
-from rcnn.io.rcnn import sample_rois
+from rcnn.io.rcnn import sample_rois_batch
 
 
 class ProposalTargetOperator(mx.operator.CustomOp):
@@ -44,20 +44,22 @@ class ProposalTargetOperator(mx.operator.CustomOp):
     def forward(self, is_train, req, in_data, out_data, aux):
         assert self._batch_rois % self._batch_images == 0, \
             'BATCHIMAGES {} must devide BATCH_ROIS {}'.format(self._batch_images, self._batch_rois)
-        rois_per_image = self._batch_rois / self._batch_images
+        rois_per_image = self._batch_rois // self._batch_images
         fg_rois_per_image = np.round(self._fg_fraction * rois_per_image).astype(int)
 
         all_rois = in_data[0].asnumpy()
-        gt_boxes = in_data[1].asnumpy()
+        # gt boxes of each image, padded with class 0
+        gt_boxes = in_data[1].asnumpy().reshape((self._batch_images, -1, 5))
 
         # Include ground-truth boxes in the set of candidate rois
-        zeros = np.zeros((gt_boxes.shape[0], 1), dtype=gt_boxes.dtype)
-        all_rois = np.vstack((all_rois, np.hstack((zeros, gt_boxes[:, :-1]))))
-        # Sanity check: single batch only
-        assert np.all(all_rois[:, 0] == 0), 'Only single item batches are supported'
+        im_inds, gt_inds = np.where(gt_boxes[:, :, 4] > 0)
+        gt_rois = np.hstack((im_inds[:, np.newaxis].astype(all_rois.dtype), gt_boxes[im_inds, gt_inds, :4]))
+        all_rois = np.vstack((all_rois, gt_rois))
+        # Sanity check: rois of the images in this batch only
+        assert np.all(all_rois[:, 0] < self._batch_images), 'roi batch index out of batch_images'
 
         rois, labels, bbox_targets, bbox_weights = \
-            sample_rois(all_rois, fg_rois_per_image, rois_per_image, self._num_classes, gt_boxes=gt_boxes)
+            sample_rois_batch(all_rois, fg_rois_per_image, rois_per_image, self._num_classes, gt_boxes)
 
         if logger.level == logging.DEBUG:
             logger.debug("labels: %s" % labels)
@@ -61,7 +61,8 @@ def train_rcnn(network, dataset, image_set, root_path, dataset_path,
 
     # load training data
     train_data = ROIIter(roidb, batch_size=input_batch_size, shuffle=not no_shuffle,
-                         ctx=ctx, work_load_list=work_load_list, aspect_grouping=config.TRAIN.ASPECT_GROUPING)
+                         ctx=ctx, work_load_list=work_load_list, aspect_grouping=config.TRAIN.ASPECT_GROUPING,
+                         num_workers=config.TRAIN.LOADER_WORKERS, prefetch_batches=config.TRAIN.LOADER_PREFETCH)
 
     # infer max shape
     max_data_shape = [('data', (input_batch_size, 3, max([v[0] for v in config.SCALES]), max([v[1] for v in config.SCALES])))]
@@ -118,7 +119,7 @@ def train_rcnn(network, dataset, image_set, root_path, dataset_path,
     for child_metric in [eval_metric, cls_metric, bbox_metric]:
         eval_metrics.add(child_metric)
     # callback
-    batch_end_callback = callback.Speedometer(train_data.batch_size, frequent=frequent)
+    batch_end_callback = callback.Speedometer(train_data.batch_size, frequent=frequent, data_iter=train_data)
     epoch_end_callback = callback.do_checkpoint(prefix, means, stds)
     # decide learning rate
     base_lr = lr
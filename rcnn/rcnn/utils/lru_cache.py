@@ -0,0 +1,71 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Bounded memo of the most recently used values, with hit and miss counts.
+    :param max_size: max number of cached values, 0 to disable caching
+    """
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._values = OrderedDict()
+
+    def get(self, key, create):
+        """
+        cached value of key, or create() it on a miss
+        :param key: hashable key
+        :param create: function returning the value
+        """
+        value = self._values.pop(key, None)
+        if value is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            value = create()
+            if self.max_size <= 0:
+                return value
+            while len(self._values) >= self.max_size:
+                self._values.popitem(last=False)
+        self._values[key] = value
+        return value
+
+    def clear(self):
+        self._values.clear()
+
+    def __len__(self):
+        return len(self._values)
+
+    def stats(self):
+        """ cache statistics as a dict """
+        return {'hits': self.hits, 'misses': self.misses, 'cached': len(self._values)}
+
+
+def shape_key(*shape_lists):
+    """
+    hashable key of lists of (name, shape), None lists are skipped
+    """
+    key = []
+    for shapes in shape_lists:
+        if shapes is None:
+            continue
+        key.extend((name, tuple(int(i) for i in shape)) for name, shape in shapes)
+    return tuple(key)
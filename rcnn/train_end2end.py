@@ -34,10 +34,14 @@ from rcnn.utils.load_model import load_param
 def train_net(args, ctx, pretrained, epoch, prefix, begin_epoch, end_epoch,
               lr=0.001, lr_step='5'):
     # setup config
-    config.TRAIN.BATCH_IMAGES = 1
+    config.TRAIN.BATCH_IMAGES = args.batch_images
     config.TRAIN.BATCH_ROIS = 128
     config.TRAIN.END2END = True
     config.TRAIN.BBOX_NORMALIZATION_PRECOMPUTED = True
+    config.TRAIN.LOADER_WORKERS = args.loader_workers
+    config.TRAIN.LOADER_PREFETCH = args.loader_prefetch
+    config.TRAIN.IMAGE_CACHE_DIR = args.image_cache_dir
+    config.TRAIN.IMAGE_CACHE_GB = args.image_cache_gb
 
     # load symbol
     sym = eval('get_' + args.network + '_train')(num_classes=config.NUM_CLASSES, num_anchors=config.NUM_ANCHORS)
@@ -62,7 +66,8 @@ def train_net(args, ctx, pretrained, epoch, prefix, begin_epoch, end_epoch,
     train_data = AnchorLoader(feat_sym, roidb, batch_size=input_batch_size, shuffle=not args.no_shuffle,
                               ctx=ctx, work_load_list=args.work_load_list,
                               feat_stride=config.RPN_FEAT_STRIDE, anchor_scales=config.ANCHOR_SCALES,
-                              anchor_ratios=config.ANCHOR_RATIOS, aspect_grouping=config.TRAIN.ASPECT_GROUPING)
+                              anchor_ratios=config.ANCHOR_RATIOS, aspect_grouping=config.TRAIN.ASPECT_GROUPING,
+                              num_workers=config.TRAIN.LOADER_WORKERS, prefetch_batches=config.TRAIN.LOADER_PREFETCH)
 
     # infer max shape
     max_data_shape = [('data', (input_batch_size, 3, max([v[0] for v in config.SCALES]), max([v[1] for v in config.SCALES])))]
@@ -124,7 +129,7 @@ def train_net(args, ctx, pretrained, epoch, prefix, begin_epoch, end_epoch,
                         logger=logger, context=ctx, work_load_list=args.work_load_list,
                         max_data_shapes=max_data_shape, max_label_shapes=max_label_shape,
                         fixed_param_prefix=fixed_param_prefix)
-    max_data_shape.append(('im_info', (1, 3)))
+    max_data_shape.append(('im_info', (input_batch_size, 3)))
     mod.bind(data_shapes=max_data_shape, label_shapes=train_data.provide_label)
     mod.init_params(initializer=mx.init.Xavier(magnitude=2.34), \
             arg_params=arg_params, aux_params=aux_params,
@@ -147,7 +152,7 @@ def train_net(args, ctx, pretrained, epoch, prefix, begin_epoch, end_epoch,
         eval_metrics.add(metric.RCNNJointAccMetric(2))
         eval_metrics.add(metric.RCNNJointL1LossMetric(2))
     # callback
-    batch_end_callback = callback.Speedometer(train_data.batch_size, frequent=args.frequent)
+    batch_end_callback = callback.Speedometer(train_data.batch_size, frequent=args.frequent, data_iter=train_data)
     means = np.tile(np.array(config.TRAIN.BBOX_MEANS), config.NUM_CLASSES)
     stds = np.tile(np.array(config.TRAIN.BBOX_STDS), config.NUM_CLASSES)
     epoch_end_callback = callback.do_checkpoint(prefix, means, stds)
@@ -192,8 +197,17 @@ def parse_args():
     parser.add_argument('--no_flip', help='disable flip images', action='store_true')
     parser.add_argument('--no_shuffle', help='disable random shuffle', action='store_true')
     parser.add_argument('--resume', help='continue training', action='store_true')
+    parser.add_argument('--loader_workers', help='processes loading batches ahead, 0 to load in the training loop',
+                        default=config.TRAIN.LOADER_WORKERS, type=int)
+    parser.add_argument('--loader_prefetch', help='batches loaded ahead by the loader processes',
+                        default=config.TRAIN.LOADER_PREFETCH, type=int)
+    parser.add_argument('--image_cache_dir', help='on-disk cache of resized images, best on a local disk',
+                        default=config.TRAIN.IMAGE_CACHE_DIR, type=str)
+    parser.add_argument('--image_cache_gb', help='size cap of the image cache in GB',
+                        default=config.TRAIN.IMAGE_CACHE_GB, type=float)
     # e2e
     parser.add_argument('--gpus', help='GPU device to train with', default='0', type=str)
+    parser.add_argument('--batch_images', help='images per GPU, must divide 128 rois', default=1, type=int)
     parser.add_argument('--pretrained', help='pretrained model prefix', default=default.pretrained, type=str)
     parser.add_argument('--pretrained_epoch', help='pretrained model epoch', default=default.pretrained_epoch, type=int)
     parser.add_argument('--prefix', help='new model prefix', default=default.e2e_prefix, type=str)
@@ -0,0 +1,91 @@
+import os
+import multiprocessing as mp
+import cPickle
+
+
+def file_stamp(paths):
+    """
+    (mtime, size) of each file, None for missing files
+    """
+    stamp = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+            stamp.append((st.st_mtime, st.st_size))
+        except OSError:
+            stamp.append(None)
+    return tuple(stamp)
+
+
+def _call(job):
+    parse_fn, args = job
+    return parse_fn(*args)
+
+
+def parse_annotations(fn_cache, parse_fn, jobs, version=None, num_workers=None):
+    """
+    Parse annotation files with a process pool, reusing results of files
+    which are not changed since the last call.
+
+    Parameters:
+    ----------
+    fn_cache : str
+        cache file, parsed results keyed by annotation files and their (mtime, size)
+    parse_fn : function
+        module level function, parse_fn(*args) returns the parsed result
+    jobs : list of (files, args)
+        files: tuple of annotation files read by parse_fn(*args)
+    version : picklable
+        other inputs of parse_fn, like class names, the cache is discarded if changed
+    num_workers : int or None
+        number of processes, None for the number of cpus, 0 to parse serially
+
+    Returns:
+    ----------
+    list of parsed results, in the order of jobs
+    """
+    cached = {}
+    if os.path.exists(fn_cache):
+        try:
+            with open(fn_cache, 'rb') as fh:
+                header = cPickle.load(fh)
+                if header['version'] == version:
+                    cached = cPickle.load(fh)
+        except:
+            cached = {}
+
+    results = [None] * len(jobs)
+    stamps = [file_stamp(files) for files, _ in jobs]
+    todo = []
+    for i, (files, args) in enumerate(jobs):
+        entry = cached.get(files)
+        if entry is not None and entry[0] == stamps[i]:
+            results[i] = entry[1]
+        else:
+            todo.append(i)
+
+    if todo:
+        if num_workers is None:
+            num_workers = mp.cpu_count()
+        todo_jobs = [(parse_fn, jobs[i][1]) for i in todo]
+        if num_workers > 1 and len(todo) > 1:
+            pool = mp.Pool(num_workers)
+            try:
+                parsed = pool.map(_call, todo_jobs, chunksize=max(1, len(todo) // (num_workers * 4)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            parsed = [_call(job) for job in todo_jobs]
+        for i, res in zip(todo, parsed):
+            results[i] = res
+            # stamp after parsing, parse_fn may update its files
+            stamps[i] = file_stamp(jobs[i][0])
+
+    # entries of files not in jobs are dropped
+    if todo or len(cached) != len(jobs):
+        cached = dict((files, (stamp, res)) for (files, _), stamp, res in zip(jobs, stamps, results))
+        with open(fn_cache, 'wb') as fh:
+            cPickle.dump({'version': version}, fh, cPickle.HIGHEST_PROTOCOL)
+            cPickle.dump(cached, fh, cPickle.HIGHEST_PROTOCOL)
+    return results
@@ -2,6 +2,8 @@ from __future__ import print_function
 import os
 import numpy as np
 from imdb import Imdb
+from label_store import LabelStore
+from image_size import probe_image_size, image_sizes
 import xml.etree.ElementTree as ET
 from evaluate.eval_voc import voc_eval
 import cv2
@@ -62,7 +64,7 @@ class DSS(Imdb):
         if shuffle:
             ridx = np.random.permutation(np.arange(self.num_images))
             image_set_index = [self.image_set_index[i] for i in ridx]
-            labels = [self.labels[i] for i in ridx]
+            labels = self.labels.take(ridx)
             self.image_set_index, self.labels = image_set_index, labels
         if self.is_train and pad_label:
             self.pad_labels()
@@ -94,8 +96,7 @@ class DSS(Imdb):
                     iidx = cPickle.load(fh)
                     cached['image_set_index'] = iidx['image_set_index']
                     if self.is_train:
-                        labels = cPickle.load(fh)
-                        cached['labels'] = labels['labels']
+                        cached['labels'] = LabelStore.load(fn_cache[:-4] + '_labels')
             except:
                 # print 'Exception in load_from_cache.'
                 return None
@@ -112,10 +113,8 @@ class DSS(Imdb):
             cPickle.dump({
                 'image_set_index': self.image_set_index
             }, fh, cPickle.HIGHEST_PROTOCOL)
-            if self.is_train:
-                cPickle.dump({
-                    'labels': self.labels
-                }, fh, cPickle.HIGHEST_PROTOCOL)
+        if self.is_train:
+            self.labels.save(fn_cache[:-4] + '_labels')
 
     def _load_image_set_index(self, shuffle=False):
         """
@@ -193,7 +192,7 @@ class DSS(Imdb):
 
         Returns:
         ----------
-        labels packed in [num_images x max_num_objects x 6] tensor
+        labels packed in a LabelStore, and max number of objects
         """
         temp = []
         max_objects = 0
@@ -236,17 +235,12 @@ class DSS(Imdb):
 
         self.image_set_index = [self.image_set_index[i] for i in valid_idx]
         assert max_objects > 0, "No objects found for any of the images"
-        return temp, max_objects
+        return LabelStore.from_labels(temp, 6), max_objects
 
     def pad_labels(self, max_objects=0):
-        """ labels: list of ndarrays """
+        """ labels are padded to self.padding rows in padded_label_from_index """
         self.max_objects = max(self.max_objects, max_objects)
         self.padding = self.max_objects
-        for (i, label) in enumerate(self.labels):
-            padded = np.tile(np.full((6, ), -1, dtype=np.float32), (self.padding, 1))
-            padded[:label.shape[0], :] = label
-            self.labels[i] = padded
-            assert self.labels[i].shape[0] == self.max_objects
 
     def evaluate_detections(self, detections):
         """
@@ -298,6 +292,7 @@ class DSS(Imdb):
         ----------
         None
         """
+        imsizes = self._get_imsizes()
         for cls_ind, cls in enumerate(self.classes):
             print('Writing {} DSS results file'.format(cls))
             filename = self.get_result_file_template().format(cls)
@@ -306,7 +301,7 @@ class DSS(Imdb):
                     dets = all_boxes[im_ind]
                     if dets.shape[0] < 1:
                         continue
-                    h, w = self._get_imsize(self.image_path_from_index(im_ind))
+                    h, w = imsizes[im_ind]
                     # the VOCdevkit expects 1-based indices
                     for k in range(dets.shape[0]):
                         if (int(dets[k, 0]) == cls_ind):
@@ -345,6 +340,16 @@ class DSS(Imdb):
         ----------
         tuple of (height, width)
         """
-        img = cv2.imread(im_name)
-        return (img.shape[0], img.shape[1])
+        return probe_image_size(im_name)
+
+    def _get_imsizes(self):
+        """
+        get sizes of all images, cached in the dataset cache
+        Returns:
+        ----------
+        list of (height, width)
+        """
+        fn_size = os.path.join(self.cache_path, self.name + '_' + self.IDX_VER + '_size.pkl')
+        paths = [self.image_path_from_index(i) for i in range(len(self.image_set_index))]
+        return image_sizes(fn_size, paths)
 
@@ -15,13 +15,21 @@ class FaceTestIter(mx.io.DataIter):
         image shape to be resized
     mean_pixels : float or float list
         [R, G, B], mean pixel values
+    indices : list of int or None
+        subset of image indices to iterate, None for all images
+    batch_size : int
+        number of images per batch. With batch_size > 1, images are grouped by
+        aspect ratio and zero padded (after mean subtraction) to the largest
+        image of the batch, im_info['valid_hw'] gives the image region of each one.
+        im_info has a list of each key, one item per image (pad images excluded).
     """
     def __init__(self, imdb, has_label=False, fix_hw=False,
-            min_hw=(384, 384), mean_pixels=[128, 128, 128], img_stride=128):
+            min_hw=(384, 384), mean_pixels=[128, 128, 128], img_stride=128, indices=None,
+            batch_size=1):
         super(FaceTestIter, self).__init__()
 
         self._imdb = imdb
-        self.batch_size = 1 # always 1
+        self.batch_size = batch_size
         self._min_hw = min_hw
         self._fix_hw = fix_hw
         if fix_hw:
@@ -30,8 +38,18 @@ class FaceTestIter(mx.io.DataIter):
         self._img_stride = img_stride
 
         self._current = 0
-        self._size = imdb.num_images
-        self._index = np.arange(self._size)
+        if indices is None:
+            self._index = np.arange(imdb.num_images)
+        else:
+            self._index = np.array(indices, dtype=int)
+        self._size = self._index.size
+        # image indices in the given order, the iteration order may differ
+        self._indices = self._index.copy()
+        if batch_size > 1 and not fix_hw:
+            # group images of similar aspect ratio, so that less padding is needed
+            hws = np.array([imdb.image_size_from_index(i) for i in self._index])
+            aspect = hws[:, 0] / hws[:, 1].astype(float)
+            self._index = self._index[np.argsort(aspect, kind='mergesort')]
 
         self._data = None
         self._label = None
@@ -77,38 +95,42 @@ class FaceTestIter(mx.io.DataIter):
         """
         Load data/label from dataset
         """
-        # batch_data = mx.nd.zeros((self.batch_size, 3, self._data_shape[0], self._data_shape[1]))
-        assert self.batch_size == 1, "Batch size should be 1."
-
-        # meaningless loop, kept just to preserve the original code
+        datas = []
+        labels = []
+        im_info = {'im_path': [], 'im_shape': [], 'im_scale': [], 'index': [], 'valid_hw': []}
         for i in range(self.batch_size):
             if (self._current + i) >= self._size:
-                if not self.is_train:
-                    continue
-                # use padding from middle in each epoch
-                idx = (self._current + i + self._size // 2) % self._size
-                index = self._index[idx]
-            else:
-                index = self._index[self._current + i]
-            # index = self.debug_index
+                # pad images are not loaded
+                continue
+            index = self._index[self._current + i]
             im_path = self._imdb.image_path_from_index(index)
-            with open(im_path, 'rb') as fp:
-                img_content = fp.read()
-            img = mx.img.imdecode(img_content)
-            data, scale = self._data_augmentation(img)
-            im_shape = img.shape
+            img = self._imdb.image_from_index(index)
+            data, scale, valid_hw = self._data_augmentation(img)
+            datas.append(data)
             if self._imdb.labels:
-                label = mx.nd.array(self._imdb.label_from_index(index))
-            else:
-                label = None
-
-        batch_data = mx.nd.expand_dims(data, axis=0)
-        scale = mx.nd.expand_dims(scale, axis=0)
-        self._data = {'data': batch_data}
-        if label is not None:
-            label = mx.nd.expand_dims(label, axis=0)
-        self._label = {'label': label}
-        self._im_info = {'im_scale': scale, 'im_path': im_path, 'im_shape': im_shape}
+                labels.append(self._imdb.padded_label_from_index(index))
+            im_info['im_path'].append(im_path)
+            im_info['im_shape'].append(img.shape)
+            im_info['im_scale'].append(scale)
+            im_info['index'].append(index)
+            im_info['valid_hw'].append(valid_hw)
+
+        # pad to the largest image, the padded region is the mean pixel after subtraction
+        hh = max(d.shape[1] for d in datas)
+        ww = max(d.shape[2] for d in datas)
+        batch_data = np.zeros((self.batch_size, 3, hh, ww), dtype=np.float32)
+        for i, d in enumerate(datas):
+            batch_data[i, :, :d.shape[1], :d.shape[2]] = d
+        self._data = {'data': mx.nd.array(batch_data)}
+        if labels:
+            batch_label = np.full((self.batch_size,) + labels[0].shape, -1, dtype=np.float32)
+            batch_label[:len(labels)] = np.stack(labels)
+            self._label = {'label': mx.nd.array(batch_label)}
+        else:
+            self._label = {'label': None}
+        im_info['im_scale'] = mx.nd.array(np.array(im_info['im_scale']))
+        im_info['valid_hw'] = np.array(im_info['valid_hw'])
+        self._im_info = im_info
 
     def _data_augmentation(self, data):
         """
@@ -125,7 +147,6 @@ class FaceTestIter(mx.io.DataIter):
         # if sy != data.shape[0] or sx != data.shape[1]:
         #     data = mx.img.imresize(data, sx, sy).asnumpy()
         # else:
-        data = data.asnumpy()
         sy, sx = data.shape[:2]
         sf_y, sf_x = 1.0, 1.0
         # pad image w.r.t. image stride
@@ -137,12 +158,13 @@ class FaceTestIter(mx.io.DataIter):
                 data = cv2.resize(data, (sx1, sy1), interpolation=cv2.INTER_LINEAR)
                 sf_x, sf_y = float(sx1) / sx, float(sy1) / sy1
                 sx, sy = sx1, sy1
+        valid_hw = data.shape[:2]
         sy = int(np.maximum(sy, self._min_hw[0]))
         sx = int(np.maximum(sx, self._min_hw[1]))
         padded = np.reshape(self._mean_pixels.asnumpy(), (1, 1, 3))
         padded = np.tile(padded, (sy, sx, 1))
         padded[:(data.shape[0]), :(data.shape[1]), :] = data
         # data = mx.img.imresize(data, int(sx), int(sy)).asnumpy() # ignore slight aspect ratio break
-        data = np.transpose(padded, (2, 0, 1)).astype(float)
+        data = np.transpose(padded, (2, 0, 1)).astype(np.float32)
         data = data - self._mean_pixels.asnumpy()
-        return mx.nd.array(data), mx.nd.array((sf_y, sf_x))
+        return data, (sf_y, sf_x), (valid_hw[0], valid_hw[1])
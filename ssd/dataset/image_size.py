@@ -0,0 +1,130 @@
+import io
+import struct
+import numpy as np
+import cv2
+from anno_cache import parse_annotations
+
+# jpeg start of frame markers, except DHT (0xC4), JPG (0xC8) and DAC (0xCC)
+_JPEG_SOF = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+
+
+def probe_image_size(path):
+    """
+    get image size from the file header, without decoding the image.
+    jpeg (SOF segment), png (IHDR), gif and bmp are parsed,
+    other formats and jpegs rotated by exif orientation fall back to cv2.imread.
+
+    Returns:
+    ----------
+    tuple of (height, width)
+    """
+    with open(path, 'rb') as fh:
+        size = _probe_header(fh)
+    if size is not None:
+        return size
+    img = cv2.imread(path)
+    return (img.shape[0], img.shape[1])
+
+
+def probe_image_bytes(content):
+    """
+    same as probe_image_size, for the content of an image file
+    """
+    size = _probe_header(io.BytesIO(content))
+    if size is not None:
+        return size
+    img = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_COLOR)
+    return (img.shape[0], img.shape[1])
+
+
+def image_sizes(fn_cache, paths, num_workers=None):
+    """
+    (height, width) of images, probed with a process pool,
+    and cached by file (mtime, size) in fn_cache
+    """
+    jobs = [((p,), (p,)) for p in paths]
+    return parse_annotations(fn_cache, probe_image_size, jobs, num_workers=num_workers)
+
+
+def _probe_header(fh):
+    """
+    (height, width) from the header of an image file object, None if unknown
+    """
+    head = fh.read(26)
+    if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+        w, h = struct.unpack('>II', head[16:24])
+        return (h, w)
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        w, h = struct.unpack('<HH', head[6:10])
+        return (h, w)
+    if head[:2] == b'BM' and len(head) >= 26:
+        w, h = struct.unpack('<ii', head[18:26])
+        return (abs(h), w)
+    if head[:2] == b'\xff\xd8':
+        fh.seek(2)
+        return _probe_jpeg(fh)
+    return None
+
+
+def _probe_jpeg(fh):
+    """
+    scan jpeg markers until the start of frame, None if not found
+    """
+    while True:
+        b = fh.read(1)
+        while b and b != b'\xff':
+            b = fh.read(1)
+        while b == b'\xff':
+            b = fh.read(1)
+        if not b:
+            return None
+        marker = struct.unpack('B', b)[0]
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            # markers without payload
+            continue
+        if marker in (0xD9, 0xDA):
+            # end of image or start of scan before any frame header
+            return None
+        seg = fh.read(2)
+        if len(seg) < 2:
+            return None
+        length = struct.unpack('>H', seg)[0]
+        if marker in _JPEG_SOF:
+            data = fh.read(5)
+            if len(data) < 5:
+                return None
+            _, h, w = struct.unpack('>BHH', data)
+            return (h, w)
+        if marker == 0xE1:
+            data = fh.read(length - 2)
+            # cv2.imread applies exif orientation, 5 to 8 swap width and height
+            if _exif_orientation(data) >= 5:
+                return None
+            continue
+        fh.seek(length - 2, 1)
+
+
+def _exif_orientation(data):
+    """
+    orientation tag in IFD0 of an APP1 exif segment, 0 if not found
+    """
+    if data[:6] != b'Exif\x00\x00' or len(data) < 14:
+        return 0
+    tiff = data[6:]
+    if tiff[:2] == b'II':
+        endian = '<'
+    elif tiff[:2] == b'MM':
+        endian = '>'
+    else:
+        return 0
+    try:
+        offset = struct.unpack(endian + 'I', tiff[4:8])[0]
+        n_entry = struct.unpack(endian + 'H', tiff[offset:offset+2])[0]
+        for i in range(n_entry):
+            entry = tiff[offset+2+i*12:offset+14+i*12]
+            tag, _, _, value = struct.unpack(endian + 'HHIH', entry[:10])
+            if tag == 0x0112:
+                return value
+    except struct.error:
+        return 0
+    return 0
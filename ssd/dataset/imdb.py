@@ -1,5 +1,8 @@
 import numpy as np
 import os.path as osp
+import cv2
+from label_store import pad_label
+from image_size import probe_image_size
 
 class Imdb(object):
     """
@@ -34,6 +37,31 @@ class Imdb(object):
         """
         raise NotImplementedError
 
+    def image_from_index(self, index):
+        """
+        load image given specified index
+
+        Parameters:
+        ----------
+        index : int
+            index of image requested in dataset
+
+        Returns:
+        ----------
+        (height, width, 3) uint8 numpy.array in rgb order
+        """
+        with open(self.image_path_from_index(index), 'rb') as fp:
+            img_content = fp.read()
+        img = cv2.imdecode(np.frombuffer(img_content, dtype=np.uint8), cv2.IMREAD_COLOR)
+        cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=img)
+        return img
+
+    def image_size_from_index(self, index):
+        """
+        (height, width) of image given specified index, without decoding it if possible
+        """
+        return probe_image_size(self.image_path_from_index(index))
+
     def label_from_index(self, index):
         """
         load ground-truth of image given specified index
@@ -50,6 +78,22 @@ class Imdb(object):
         """
         raise NotImplementedError
 
+    def padded_label_from_index(self, index):
+        """
+        ground-truth of image given specified index, padded with -1 to
+        self.padding rows, so that labels of a batch have the same shape
+
+        Parameters:
+        ----------
+        index : int
+            index of image requested in dataset
+
+        Returns:
+        ----------
+        new float32 array of object ground-truths
+        """
+        return pad_label(self.label_from_index(index), self.padding)
+
     def save_imglist(self, fname=None, root=None, shuffle=False):
         """
         save imglist to disk
@@ -1,6 +1,12 @@
 import mxnet as mx
 import numpy as np
 import cv2
+import ctypes
+import multiprocessing as mp
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 from tools.rand_sampler import RandSampler, RandEraser
 from tools.crop_roi_patch import crop_roi_patch
 
@@ -138,12 +144,18 @@ class DetIter(mx.io.DataIter):
     is_train : bool
         whether in training phase, default True, if False, labels might
         be ignored
+    num_workers : int
+        number of processes for loading and augmentation, default 0,
+        if 0 batches are loaded in the calling thread
+    prefetch_batches : int
+        number of batches loaded ahead by the workers, default 2
     """
     def __init__(self, imdb, batch_size, data_shape, rand_sampler, \
                  rand_eraser=None, \
                  mean_pixels=[128, 128, 128], \
                  rand_mirror=False, shuffle=False, rand_seed=None, \
-                 is_train=True, max_crop_trial=50):
+                 is_train=True, max_crop_trial=50, \
+                 num_workers=0, prefetch_batches=2):
         super(DetIter, self).__init__()
 
         self._imdb = imdb
@@ -151,7 +163,7 @@ class DetIter(mx.io.DataIter):
         if isinstance(data_shape, int):
             data_shape = (data_shape, data_shape)
         self._data_shape = data_shape
-        self._mean_pixels = mx.nd.array(mean_pixels).reshape((3,1,1))
+        self._mean_np = np.reshape(np.array(mean_pixels, dtype=np.float32), (3,1,1))
         self._rand_sampler = rand_sampler
         self._rand_eraser = rand_eraser
         self.is_train = is_train
@@ -170,8 +182,15 @@ class DetIter(mx.io.DataIter):
 
         self._data = None
         self._label = None
+        self._batch_buf = None
         self._get_batch()
 
+        self._num_workers = num_workers
+        self._workers = []
+        if num_workers > 0:
+            self._start_workers(max(prefetch_batches, 1), rand_seed)
+            self.reset()
+
     @property
     def provide_data(self):
         return [(k, v.shape) for k, v in self._data.items()]
@@ -184,16 +203,27 @@ class DetIter(mx.io.DataIter):
             return []
 
     def reset(self):
+        if self._workers:
+            self._drain()
         self._current = 0
         if self._shuffle:
             np.random.shuffle(self._index)
+        if self._workers:
+            # batches are dispatched in order, and collected in the same order
+            self._n_sent = 0
+            for _ in range(self._n_slot):
+                self._dispatch()
 
     def iter_next(self):
         return self._current < self._size
 
     def next(self):
         if self.iter_next():
-            self._get_batch()
+            if self._workers:
+                self._collect()
+                self._dispatch()
+            else:
+                self._get_batch()
             data_batch = mx.io.DataBatch(data=self._data.values(),
                                    label=self._label.values(),
                                    pad=self.getpad(), index=self.getindex())
@@ -209,47 +239,149 @@ class DetIter(mx.io.DataIter):
         pad = self._current + self.batch_size - self._size
         return 0 if pad < 0 else pad
 
-    def _get_batch(self):
+    def _batch_indices(self, current):
         """
-        Load data/label from dataset
+        Image indices of the batch starting at current, -1 for empty entries
         """
-        batch_data = mx.nd.zeros((self.batch_size, 3, self._data_shape[0], self._data_shape[1]))
-        batch_label = []
+        indices = []
         for i in range(self.batch_size):
-            if (self._current + i) >= self._size:
+            if (current + i) >= self._size:
                 if not self.is_train:
+                    indices.append(-1)
                     continue
                 # use padding from middle in each epoch
-                idx = (self._current + i + self._size // 2) % self._size
-                index = self._index[idx]
+                idx = (current + i + self._size // 2) % self._size
+                indices.append(self._index[idx])
             else:
-                index = self._index[self._current + i]
-            # index = self.debug_index
-            im_path = self._imdb.image_path_from_index(index)
-            with open(im_path, 'rb') as fp:
-                img_content = fp.read()
-            img = mx.img.imdecode(img_content)
-            gt = self._imdb.label_from_index(index).copy() if self.is_train else None
-            data, label = self._data_augmentation(img, gt)
-            batch_data[i] = data
+                indices.append(self._index[current + i])
+        return indices
+
+    def _load_image(self, index, out):
+        """
+        Read, decode and augment an image into out, (3, h, w) float32 array,
+        and return its label
+        """
+        img = self._imdb.image_from_index(index)
+        gt = self._imdb.padded_label_from_index(index) if self.is_train else None
+        return self._augment(img, gt, out)
+
+    def _get_batch(self):
+        """
+        Load data/label from dataset
+        """
+        if self._batch_buf is None:
+            self._batch_buf = np.zeros((self.batch_size, 3, self._data_shape[0], self._data_shape[1]),
+                                       dtype=np.float32)
+        batch_label = []
+        for i, index in enumerate(self._batch_indices(self._current)):
+            if index < 0:
+                self._batch_buf[i] = 0
+                continue
+            label = self._load_image(index, self._batch_buf[i])
             if self.is_train:
                 batch_label.append(label)
-        self._data = {'data': batch_data}
+        self._data = {'data': mx.nd.array(self._batch_buf)}
+        if self.is_train:
+            self._label = {'label': mx.nd.array(np.array(batch_label))}
+        else:
+            self._label = {'label': None}
+
+    def _start_workers(self, n_slot, rand_seed):
+        """
+        Start worker processes, and shared memory buffers for n_slot batches
+        """
+        self._n_slot = n_slot
+        shape = (n_slot, self.batch_size, 3, self._data_shape[0], self._data_shape[1])
+        self._shm = mp.RawArray(ctypes.c_float, int(np.prod(shape)))
+        self._shm_data = np.frombuffer(self._shm, dtype=np.float32).reshape(shape)
+        self._job_queue = mp.Queue()
+        self._result_queue = mp.Queue()
+        self._results = {}
+        self._n_sent = 0
+        # one seed per worker, so that workers do not share random states
+        base_seed = rand_seed if rand_seed else np.random.randint(0, 2**31)
+        for i in range(self._num_workers):
+            worker = mp.Process(target=_det_worker, args=(self, (base_seed + i) % 2**32))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _dispatch(self):
+        """
+        Send jobs of the next batch to workers, if any
+        """
+        current = self._n_sent * self.batch_size
+        if current >= self._size:
+            return
+        slot = self._n_sent % self._n_slot
+        for i, index in enumerate(self._batch_indices(current)):
+            self._job_queue.put((self._n_sent, slot, i, index))
+        self._n_sent += 1
+
+    def _wait_batch(self, bid):
+        """
+        Wait for all images of batch bid, and return its labels
+        """
+        while len(self._results.get(bid, [])) < self.batch_size:
+            rbid, i, label = self._result_queue.get()
+            if isinstance(label, Exception):
+                raise label
+            self._results.setdefault(rbid, []).append((i, label))
+        return [l for _, l in sorted(self._results.pop(bid), key=lambda x: x[0])]
+
+    def _collect(self):
+        """
+        Collect the current batch from the shared memory buffer
+        """
+        bid = self._current // self.batch_size
+        batch_label = self._wait_batch(bid)
+        self._data = {'data': mx.nd.array(self._shm_data[bid % self._n_slot])}
         if self.is_train:
             self._label = {'label': mx.nd.array(np.array(batch_label))}
         else:
             self._label = {'label': None}
 
-    def _data_augmentation(self, data, label):
+    def _drain(self):
+        """
+        Wait for dispatched batches which are not collected yet
+        """
+        for bid in range(self._current // self.batch_size, self._n_sent):
+            self._wait_batch(bid)
+
+    def close(self):
+        """
+        Stop worker processes
+        """
+        for _ in self._workers:
+            self._job_queue.put(None)
+        # results of batches in flight are discarded, a worker only exits once
+        # its results are read from the pipe
+        while any(worker.is_alive() for worker in self._workers):
+            try:
+                self._result_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        self._results = {}
+
+    def __del__(self):
+        if getattr(self, '_workers', None):
+            self.close()
+
+    def _augment(self, data, label, out):
         """
         perform data augmentations: crop, mirror, resize, sub mean, swap channels...
+        on numpy arrays, crop and mirror are views,
+        and the result is written into out, (3, h, w) float32 array
         """
         if self.is_train and self._rand_sampler:
             width = data.shape[1]
             height = data.shape[0]
             rand_crop = self._rand_sampler.sample(label, (height, width))
             xmin, ymin, xmax, ymax = np.array(rand_crop[0]).astype(int)
-            data = crop_roi_patch(data.asnumpy(), (xmin, ymin, xmax, ymax))
+            data = crop_roi_patch(data, (xmin, ymin, xmax, ymax), as_ndarray=False)
             label = rand_crop[1]
         if self.is_train:
             interp_methods = [cv2.INTER_LINEAR, cv2.INTER_CUBIC, cv2.INTER_AREA, \
@@ -257,23 +389,41 @@ class DetIter(mx.io.DataIter):
         else:
             interp_methods = [cv2.INTER_LINEAR]
         interp_method = interp_methods[int(np.random.uniform(0, 1) * len(interp_methods))]
-        data = mx.img.imresize(data, self._data_shape[1], self._data_shape[0], interp_method)
+        data = cv2.resize(data, (self._data_shape[1], self._data_shape[0]), interpolation=interp_method)
         if self._rand_eraser and self.is_train:
             label_scaler = np.array((self._data_shape[0], self._data_shape[1]))
             label_scaler = np.tile(np.reshape(label_scaler, (1, -1)), (1, 2))
-            data = mx.nd.array(self._rand_eraser.sample(data.asnumpy(), label[:, 1:] * label_scaler))
+            data = self._rand_eraser.sample(data, label[:, 1:] * label_scaler)
         if self.is_train:
             valid_mask = np.where(np.any(label != -1, axis=1))[0]
             if self._rand_mirror:
                 rr = rand_crop[2]
                 if np.random.uniform(0, 1) > 0.5:
-                    data = mx.nd.flip(data, axis=1)
+                    data = data[:, ::-1, :]
                     tmp = rr - label[valid_mask, 1]
                     label[valid_mask, 1] = rr - label[valid_mask, 3]
                     label[valid_mask, 3] = tmp
-            # label[valid_mask, 1::2] *= data.shape[1]
-            # label[valid_mask, 2::2] *= data.shape[0]
-        data = mx.nd.transpose(data, (2,0,1))
-        data = data.astype('float32')
-        data = data - self._mean_pixels
-        return data, label
+        # swap channels, cast and sub mean in one pass
+        np.subtract(np.transpose(data, (2,0,1)), self._mean_np, out=out)
+        return label
+
+
+def _det_worker(det_iter, seed):
+    """
+    Worker process of DetIter, loads images into the shared memory buffer
+    """
+    np.random.seed(seed)
+    while True:
+        job = det_iter._job_queue.get()
+        if job is None:
+            break
+        bid, slot, i, index = job
+        label = None
+        try:
+            if index < 0:
+                det_iter._shm_data[slot, i] = 0
+            else:
+                label = det_iter._load_image(index, det_iter._shm_data[slot, i])
+        except Exception as e:
+            label = e
+        det_iter._result_queue.put((bid, i, label))
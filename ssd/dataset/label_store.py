@@ -0,0 +1,90 @@
+import os
+import numpy as np
+
+
+class LabelStore(object):
+    """
+    Packed ground-truths of an image set.
+    All boxes are stored in one (n_box, label_width) float32 array, and boxes of
+    image i are boxes[offsets[i]:offsets[i+1]], so a label is an O(1) slice.
+    Saved stores are opened with np.memmap, so forked loader processes share
+    the pages instead of copying the labels.
+
+    Parameters:
+    ----------
+    boxes : numpy.array
+        (n_box, label_width) float32 array
+    offsets : numpy.array
+        (n_image + 1,) int64 array
+    order : numpy.array or None
+        image order, for shuffled views of the same arrays
+    """
+    def __init__(self, boxes, offsets, order=None):
+        self.boxes = boxes
+        self.offsets = offsets
+        self.order = order
+        counts = np.diff(offsets)
+        self.max_objects = int(np.max(counts)) if counts.size else 0
+
+    @staticmethod
+    def from_labels(labels, label_width):
+        """
+        pack a list of (n_obj, label_width) arrays
+        """
+        labels = [np.reshape(l, (-1, label_width)) for l in labels]
+        offsets = np.zeros((len(labels) + 1,), dtype=np.int64)
+        offsets[1:] = np.cumsum([l.shape[0] for l in labels])
+        boxes = np.zeros((offsets[-1], label_width), dtype=np.float32)
+        for i, l in enumerate(labels):
+            boxes[offsets[i]:offsets[i+1]] = l
+        return LabelStore(boxes, offsets)
+
+    @staticmethod
+    def load(prefix):
+        """
+        open a store saved with save(prefix), boxes are memory-mapped
+        """
+        boxes = np.load(prefix + '_boxes.npy', mmap_mode='r')
+        offsets = np.load(prefix + '_offsets.npy')
+        return LabelStore(boxes, offsets)
+
+    @staticmethod
+    def exists(prefix):
+        return os.path.exists(prefix + '_boxes.npy') and os.path.exists(prefix + '_offsets.npy')
+
+    def save(self, prefix):
+        """
+        save to prefix_boxes.npy and prefix_offsets.npy, in the current image order
+        """
+        store = self if self.order is None else LabelStore.from_labels(list(self), self.boxes.shape[1])
+        np.save(prefix + '_boxes.npy', store.boxes)
+        np.save(prefix + '_offsets.npy', store.offsets)
+
+    def take(self, indices):
+        """
+        a view of the store in a new image order, labels are not copied
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        order = indices if self.order is None else self.order[indices]
+        return LabelStore(self.boxes, self.offsets, order)
+
+    def __len__(self):
+        return self.offsets.size - 1 if self.order is None else self.order.size
+
+    def __getitem__(self, index):
+        if self.order is not None:
+            index = self.order[index]
+        return self.boxes[self.offsets[index]:self.offsets[index+1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def pad_label(label, n_pad, pad_value=-1):
+    """
+    pad label to n_pad rows with pad_value, returns a new float32 array
+    """
+    padded = np.full((max(n_pad, label.shape[0]), label.shape[1]), pad_value, dtype=np.float32)
+    padded[:label.shape[0], :] = label
+    return padded
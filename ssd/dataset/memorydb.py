@@ -0,0 +1,50 @@
+import numpy as np
+import cv2
+from imdb import Imdb
+from image_size import probe_image_bytes
+
+
+class MemoryDB(Imdb):
+    """
+    A simple wrapper class for converting in-memory images to Imdb during testing,
+    images are decoded from memory instead of being read from files
+
+    Parameters:
+    ----------
+    images : bytes or numpy.array or list of them
+        encoded image files, or decoded (height, width, 3) uint8 images in rgb order
+    """
+    def __init__(self, images):
+        if not isinstance(images, list):
+            images = [images]
+        num_images = len(images)
+        super(MemoryDB, self).__init__("memory" + str(num_images))
+        self.images = images
+        self.num_images = num_images
+
+    def image_path_from_index(self, index):
+        """
+        in-memory images have no path, returns a name to identify the image
+        """
+        return '<memory {}>'.format(index)
+
+    def image_from_index(self, index):
+        img = self.images[index]
+        if isinstance(img, np.ndarray):
+            if img.ndim == 2:
+                img = np.tile(img[:, :, np.newaxis], (1, 1, 3))
+            assert img.ndim == 3 and img.shape[2] == 3, "images should be (height, width, 3)"
+            return img
+        img = cv2.imdecode(np.frombuffer(img, dtype=np.uint8), cv2.IMREAD_COLOR)
+        assert img is not None, 'Failed to decode image {}'.format(index)
+        cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=img)
+        return img
+
+    def image_size_from_index(self, index):
+        img = self.images[index]
+        if isinstance(img, np.ndarray):
+            return img.shape[:2]
+        return probe_image_bytes(img)
+
+    def label_from_index(self, index):
+        raise RuntimeError("MemoryDB does not support label loading")
@@ -1,6 +1,8 @@
 import os
 import numpy as np
 from imdb import Imdb
+from label_store import LabelStore
+from anno_cache import file_stamp
 from pycocotools.coco import COCO
 import cPickle
 
@@ -25,6 +27,7 @@ class Coco(Imdb):
         basename = os.path.splitext(os.path.basename(anno_file))[0]
         super(Coco, self).__init__('coco_' + basename)
         self.image_dir = image_dir
+        self.anno_file = anno_file
 
         self.is_train = is_train
         self.classes = self._load_class_names(names,
@@ -94,16 +97,16 @@ class Coco(Imdb):
         coco = COCO(anno_file)
         img_ids = coco.getImgIds()
         max_objects = 0
+        # annotations grouped by image in one pass, instead of a query per image
         for img_id in img_ids:
             # filename
-            image_info = coco.loadImgs(img_id)[0]
+            image_info = coco.imgs[img_id]
             filename = image_info["file_name"]
             subdir = filename.split('_')[1]
             height = image_info["height"]
             width = image_info["width"]
             # label
-            anno_ids = coco.getAnnIds(imgIds=img_id)
-            annos = coco.loadAnns(anno_ids)
+            annos = coco.imgToAnns.get(img_id, [])
             label = []
             for anno in annos:
                 cat_id = int(anno["category_id"])
@@ -129,7 +132,7 @@ class Coco(Imdb):
             labels = [labels[i] for i in indices]
         # store the results
         self.image_set_index = image_set_index
-        self.labels = labels
+        self.labels = LabelStore.from_labels(labels, 6)
         self.max_objects = max_objects
 
     @property
@@ -154,12 +157,13 @@ class Coco(Imdb):
                 with open(fn_cache, 'rb') as fh:
                     header = cPickle.load(fh)
                     assert header['ver'] == self.IDX_VER, "Version mismatch, re-index DB."
+                    assert header.get('anno_stamp') == file_stamp((self.anno_file,)), \
+                            "Annotation changed, re-index DB."
                     self.max_objects = header['max_objects']
                     iidx = cPickle.load(fh)
                     cached['image_set_index'] = iidx['image_set_index']
                     if self.is_train:
-                        labels = cPickle.load(fh)
-                        cached['labels'] = labels['labels']
+                        cached['labels'] = LabelStore.load(fn_cache[:-4] + '_labels')
             except:
                 # print 'Exception in load_from_cache.'
                 return None
@@ -168,11 +172,12 @@ class Coco(Imdb):
     def _save_to_cache(self):
         fn_cache = os.path.join(self.cache_path, self.name + '_' + self.IDX_VER + '.pkl')
         with open(fn_cache, 'wb') as fh:
-            header = {'ver': self.IDX_VER, 'max_objects': self.max_objects}
+            header = {'ver': self.IDX_VER, 'max_objects': self.max_objects,
+                      'anno_stamp': file_stamp((self.anno_file,))}
             cPickle.dump(header, fh, cPickle.HIGHEST_PROTOCOL)
             cPickle.dump({'image_set_index': self.image_set_index}, fh, cPickle.HIGHEST_PROTOCOL)
-            if self.is_train:
-                cPickle.dump({'labels': self.labels}, fh, cPickle.HIGHEST_PROTOCOL)
+        if self.is_train:
+            self.labels.save(fn_cache[:-4] + '_labels')
 
     def pad_labels(self, max_objects=0):
         """ labels: list of ndarrays """
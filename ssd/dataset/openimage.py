@@ -1,6 +1,7 @@
 import os
 import numpy as np
 from imdb import Imdb
+from label_store import LabelStore
 
 
 class OpenImage(Imdb):
@@ -95,7 +96,8 @@ class OpenImage(Imdb):
             labels = [labels[i] for i in indices]
         # store the results
         self.image_set_index = image_set_index
-        self.labels = labels
+        self.labels = LabelStore.from_labels(labels, 5)
+        self.max_objects = self.labels.max_objects
 
 
 if __name__ == '__main__':
@@ -2,6 +2,9 @@ from __future__ import print_function
 import os
 import numpy as np
 from imdb import Imdb
+from label_store import LabelStore
+from image_size import probe_image_size, image_sizes
+from anno_cache import parse_annotations, file_stamp
 import xml.etree.ElementTree as ET
 from evaluate.eval_voc import voc_eval
 import cv2
@@ -24,11 +27,13 @@ class PascalVoc(Imdb):
         whether to initial shuffle the image list
     is_train : boolean
         if true, will load annotations
+    num_workers : int or None
+        number of processes for parsing annotations, None for the number of cpus
     """
     IDX_VER = '170811_1'
 
     def __init__(self, image_set, year, devkit_path, shuffle=False, is_train=False,
-            names='pascal_voc.names'):
+            names='pascal_voc.names', num_workers=None):
         super(PascalVoc, self).__init__('voc_' + year + '_' + image_set)
         self.image_set = image_set
         self.year = year
@@ -36,6 +41,7 @@ class PascalVoc(Imdb):
         self.data_path = os.path.join(devkit_path, 'VOC' + year)
         self.extension = '.jpg'
         self.is_train = is_train
+        self.num_workers = num_workers
 
         self.classes = self._load_class_names(names,
             os.path.join(os.path.dirname(__file__), 'names'))
@@ -67,7 +73,7 @@ class PascalVoc(Imdb):
         if shuffle:
             ridx = np.random.permutation(np.arange(self.num_images))
             image_set_index = [self.image_set_index[i] for i in ridx]
-            labels = [self.labels[i] for i in ridx]
+            labels = self.labels.take(ridx)
             self.image_set_index, self.labels = image_set_index, labels
         if self.is_train:
             self.pad_labels()
@@ -95,12 +101,13 @@ class PascalVoc(Imdb):
                 with open(fn_cache, 'rb') as fh:
                     header = cPickle.load(fh)
                     assert header['ver'] == self.IDX_VER, "Version mismatch, re-index DB."
+                    assert header.get('set_stamp') == file_stamp((self._image_set_index_file(),)), \
+                            "Image set changed, re-index DB."
                     self.max_objects = header['max_objects']
                     iidx = cPickle.load(fh)
                     cached['image_set_index'] = iidx['image_set_index']
                     if self.is_train:
-                        labels = cPickle.load(fh)
-                        cached['labels'] = labels['labels']
+                        cached['labels'] = LabelStore.load(fn_cache[:-4] + '_labels')
             except:
                 # print 'Exception in load_from_cache.'
                 return None
@@ -112,15 +119,18 @@ class PascalVoc(Imdb):
         with open(fn_cache, 'wb') as fh:
             cPickle.dump({
                 'ver': self.IDX_VER,
-                'max_objects': self.max_objects
+                'max_objects': self.max_objects,
+                'set_stamp': file_stamp((self._image_set_index_file(),))
             }, fh, cPickle.HIGHEST_PROTOCOL)
             cPickle.dump({
                 'image_set_index': self.image_set_index
             }, fh, cPickle.HIGHEST_PROTOCOL)
-            if self.is_train:
-                cPickle.dump({
-                    'labels': self.labels
-                }, fh, cPickle.HIGHEST_PROTOCOL)
+        if self.is_train:
+            self.labels.save(fn_cache[:-4] + '_labels')
+
+    def _image_set_index_file(self):
+        """ text file listing images of the image set """
+        return os.path.join(self.data_path, 'ImageSets', 'Main', self.image_set + '.txt')
 
     def _load_image_set_index(self, shuffle=False):
         """
@@ -134,7 +144,7 @@ class PascalVoc(Imdb):
         ----------
         entire list of images specified in the setting
         """
-        image_set_index_file = os.path.join(self.data_path, 'ImageSets', 'Main', self.image_set + '.txt')
+        image_set_index_file = self._image_set_index_file()
         assert os.path.exists(image_set_index_file), 'Path does not exist: {}'.format(image_set_index_file)
         with open(image_set_index_file) as f:
             image_set_index = [x.strip() for x in f.readlines()]
@@ -198,51 +208,25 @@ class PascalVoc(Imdb):
 
         Returns:
         ----------
-        labels packed in [num_images x max_num_objects x 6] tensor
+        labels packed in a LabelStore, and max number of objects
         """
-        temp = []
-        max_objects = 0
-
         # load ground-truth from xml annotations
+        jobs = []
         for idx in self.image_set_index:
             label_file = self._label_path_from_index(idx)
-            tree = ET.parse(label_file)
-            root = tree.getroot()
-            size = root.find('size')
-            width = float(size.find('width').text)
-            height = float(size.find('height').text)
-            label = []
-
-            for obj in root.iter('object'):
-                difficult = int(obj.find('difficult').text)
-                # if not self.config['use_difficult'] and difficult == 1:
-                #     continue
-                cls_name = obj.find('name').text
-                if cls_name not in self.classes:
-                    continue
-                cls_id = self.classes.index(cls_name)
-                xml_box = obj.find('bndbox')
-                xmin = float(xml_box.find('xmin').text) / width
-                ymin = float(xml_box.find('ymin').text) / height
-                xmax = float(xml_box.find('xmax').text) / width
-                ymax = float(xml_box.find('ymax').text) / height
-                label.append([cls_id, xmin, ymin, xmax, ymax, difficult])
-            if len(label) > max_objects:
-                max_objects = len(label)
-            temp.append(np.array(label))
+            jobs.append(((label_file,), (label_file, self.classes)))
+        fn_anno = os.path.join(self.cache_path, self.name + '_' + self.IDX_VER + '_anno.pkl')
+        temp = parse_annotations(fn_anno, _parse_annotation, jobs,
+                version=self.classes, num_workers=self.num_workers)
+        max_objects = max([len(l) for l in temp] + [0])
 
         assert max_objects > 0, "No objects found for any of the images"
-        return temp, max_objects
+        return LabelStore.from_labels(temp, 6), max_objects
 
     def pad_labels(self, max_objects=0):
-        """ labels: list of ndarrays """
+        """ labels are padded to self.padding rows in padded_label_from_index """
         self.max_objects = max(self.max_objects, max_objects)
         self.padding = self.max_objects
-        for (i, label) in enumerate(self.labels):
-            padded = np.tile(np.full((6, ), -1, dtype=np.float32), (self.padding, 1))
-            padded[:label.shape[0], :] = label
-            self.labels[i] = padded
-            assert self.labels[i].shape[0] == self.max_objects
 
     def evaluate_detections(self, detections):
         """
@@ -295,6 +279,7 @@ class PascalVoc(Imdb):
         ----------
         None
         """
+        imsizes = self._get_imsizes()
         for cls_ind, cls in enumerate(self.classes):
             print('Writing {} VOC results file'.format(cls))
             filename = self.get_result_file_template().format(cls)
@@ -303,7 +288,7 @@ class PascalVoc(Imdb):
                     dets = all_boxes[im_ind]
                     if dets.shape[0] < 1:
                         continue
-                    h, w = self._get_imsize(self.image_path_from_index(im_ind))
+                    h, w = imsizes[im_ind]
                     # the VOCdevkit expects 1-based indices
                     for k in range(dets.shape[0]):
                         if (int(dets[k, 0]) == cls_ind):
@@ -342,5 +327,45 @@ class PascalVoc(Imdb):
         ----------
         tuple of (height, width)
         """
-        img = cv2.imread(im_name)
-        return (img.shape[0], img.shape[1])
+        return probe_image_size(im_name)
+
+    def _get_imsizes(self):
+        """
+        get sizes of all images, cached in the dataset cache
+        Returns:
+        ----------
+        list of (height, width)
+        """
+        fn_size = os.path.join(self.cache_path, self.name + '_' + self.IDX_VER + '_size.pkl')
+        paths = [self.image_path_from_index(i) for i in range(len(self.image_set_index))]
+        return image_sizes(fn_size, paths)
+
+
+def _parse_annotation(label_file, classes):
+    """
+    parse ground-truths of an image from its xml annotation
+
+    Returns:
+    ----------
+    array of [cls_id, xmin, ymin, xmax, ymax, difficult], normalized to [0, 1]
+    """
+    tree = ET.parse(label_file)
+    root = tree.getroot()
+    size = root.find('size')
+    width = float(size.find('width').text)
+    height = float(size.find('height').text)
+    label = []
+
+    for obj in root.iter('object'):
+        difficult = int(obj.find('difficult').text)
+        cls_name = obj.find('name').text
+        if cls_name not in classes:
+            continue
+        cls_id = classes.index(cls_name)
+        xml_box = obj.find('bndbox')
+        xmin = float(xml_box.find('xmin').text) / width
+        ymin = float(xml_box.find('ymin').text) / height
+        xmax = float(xml_box.find('xmax').text) / width
+        ymax = float(xml_box.find('ymax').text) / height
+        label.append([cls_id, xmin, ymin, xmax, ymax, difficult])
+    return np.array(label)
@@ -2,6 +2,9 @@ from __future__ import print_function
 import os
 import numpy as np
 from imdb import Imdb
+from label_store import LabelStore
+from anno_cache import parse_annotations, file_stamp
+from image_size import probe_image_size
 import cv2
 import cPickle
 
@@ -20,10 +23,12 @@ class Wider(Imdb):
         whether to initial shuffle the image list
     is_train : boolean
         if true, will load annotations
+    num_workers : int or None
+        number of processes for parsing annotations, None for the number of cpus
     """
     IDX_VER = '170819_1'  # for caching
 
-    def __init__(self, image_set, devkit_path, shuffle=False, is_train=False):
+    def __init__(self, image_set, devkit_path, shuffle=False, is_train=False, num_workers=None):
         super(Wider,
               self).__init__('wider_' + image_set)  # e.g. wider_trainval
         self.image_set = image_set
@@ -32,6 +37,7 @@ class Wider(Imdb):
         self.data_path = devkit_path  # os.path.join(devkit_path, 'wider')
         self.extension = '.jpg'
         self.is_train = is_train
+        self.num_workers = num_workers
 
         self.classes = ['face',]
 
@@ -61,7 +67,7 @@ class Wider(Imdb):
         if shuffle:
             ridx = np.random.permutation(np.arange(self.num_images))
             image_set_index = [self.image_set_index[i] for i in ridx]
-            labels = [self.labels[i] for i in ridx]
+            labels = self.labels.take(ridx)
             self.image_set_index, self.labels = image_set_index, labels
         if self.is_train:
             self._pad_labels()
@@ -89,12 +95,13 @@ class Wider(Imdb):
                 with open(fn_cache, 'rb') as fh:
                     header = cPickle.load(fh)
                     assert header['ver'] == self.IDX_VER, "Version mismatch, re-index DB."
+                    assert header.get('set_stamp') == file_stamp((self._image_set_index_file(),)), \
+                            "Image set changed, re-index DB."
                     self.max_objects = header['max_objects']
                     iidx = cPickle.load(fh)
                     cached['image_set_index'] = iidx['image_set_index']
                     if self.is_train:
-                        labels = cPickle.load(fh)
-                        cached['labels'] = labels['labels']
+                        cached['labels'] = LabelStore.load(fn_cache[:-4] + '_labels')
             except:
                 # print 'Exception in load_from_cache.'
                 return None
@@ -106,15 +113,18 @@ class Wider(Imdb):
         with open(fn_cache, 'wb') as fh:
             cPickle.dump({
                 'ver': self.IDX_VER,
-                'max_objects': self.max_objects
+                'max_objects': self.max_objects,
+                'set_stamp': file_stamp((self._image_set_index_file(),))
             }, fh, cPickle.HIGHEST_PROTOCOL)
             cPickle.dump({
                 'image_set_index': self.image_set_index
             }, fh, cPickle.HIGHEST_PROTOCOL)
-            if self.is_train:
-                cPickle.dump({
-                    'labels': self.labels
-                }, fh, cPickle.HIGHEST_PROTOCOL)
+        if self.is_train:
+            self.labels.save(fn_cache[:-4] + '_labels')
+
+    def _image_set_index_file(self):
+        """ text file listing images of the image set """
+        return os.path.join(self.data_path, 'img', self.image_set + '.txt')
 
     def _load_image_set_index(self, shuffle):
         """
@@ -128,7 +138,7 @@ class Wider(Imdb):
         ----------
         entire list of images specified in the setting
         """
-        image_set_index_file = os.path.join(self.data_path, 'img', self.image_set + '.txt')
+        image_set_index_file = self._image_set_index_file()
         assert os.path.exists(image_set_index_file), \
                 'Path does not exist: {}'.format(image_set_index_file)
         with open(image_set_index_file) as f:
@@ -196,87 +206,83 @@ class Wider(Imdb):
 
         Returns:
         ----------
-        labels packed in [num_images x max_num_objects x 5] tensor
+        labels packed in a LabelStore, and max number of objects
         """
-        temp = []
-        max_objects = 0
-        max_label = np.empty((0, 5))
-        max_fn = ''
-
-        # load ground-truth from xml annotations
+        cls_id = self.classes.index('face')
+        jobs = []
         for idx in range(len(self.image_set_index)):
             bb_file, prop_file = self._label_path_from_index(idx)
-            cls_id = self.classes.index('face')
-            bbs = np.reshape(np.loadtxt(bb_file).astype(float), (-1, 4))
-            if bbs.size == 0:
-                temp.append(np.empty((0, 6)))
-                continue
-            ww_img = 0
-            hh_img = 0
-            small_mask = np.maximum(bbs[:, 2], bbs[:, 3]) < self.config['th_small']
-            # remove bbs that are 1) invalid or 2) too small and occluded.
-            with open(prop_file, 'r') as fh:
-                prop_data = fh.read().splitlines()
-            for pdata in prop_data:
-                prop_bb = pdata.split(' ')
-                if prop_bb[0] == 'invalid_label_list':
-                    invalid_mask = np.array(prop_bb[1:]).astype(int) == 1
-                if prop_bb[0] == 'occlusion_label_list':
-                    occ_mask = np.array(prop_bb[1:]).astype(int) == 2
-                if prop_bb[0] == 'blur_label_list':
-                    blur_mask = np.array(prop_bb[1:]).astype(int) == 2
-                # also get image size
-                if prop_bb[0] == 'image_size':
-                    ww_img = int(prop_bb[1])
-                    hh_img = int(prop_bb[2])
-            if self.config['use_difficult'] is not True:
-                # import ipdb
-                # ipdb.set_trace()
-                hard_mask = np.logical_or(blur_mask, occ_mask)
-                hard_mask = np.logical_and(hard_mask, small_mask)
-                invalid_mask = np.logical_or(invalid_mask, hard_mask)
-            # FOR DEBUG, save image size to .prop_label
-            if ww_img == 0:
-                fn_img = self.image_path_from_index(idx)
-                img = cv2.imread(fn_img)
-                prop_data.append('image_size %d %d' % (img.shape[1], img.shape[0]))
-                with open(prop_file, 'w') as fh:
-                    for pdata in prop_data:
-                        fh.write(pdata + '\n')
-                ww_img = img.shape[1]
-                hh_img = img.shape[0]
-
-            invalid_idx = np.where(invalid_mask == True)[0]
-            # bbs = bbs[valid_idx, :]
-            if bbs.size == 0:
-                temp.append(np.empty((0, 6)))
-                continue
-
-            # we need [xmin, ymin, xmax, ymax], but wider DB has [xmin, ymin, width, height]
-            bbs[:, 2] += bbs[:, 0]
-            bbs[:, 3] += bbs[:, 1]
-            # normalize to [0, 1]
-            bbs[:, 0::2] /= ww_img
-            bbs[:, 1::2] /= hh_img
-
-            bbs = np.minimum(np.maximum(bbs, 0.0), 1.0)
-
-            label = np.zeros((bbs.shape[0], 6))
-            label[:, 0] = cls_id
-            label[invalid_idx, 0] = -1
-            label[:, 1:5] = bbs
-            temp.append(label)
-            if label.shape[0] > max_objects:
-                max_objects = label.shape[0]
+            img_file = os.path.join(self.data_path, 'img', self.image_set_index[idx] + self.extension)
+            jobs.append(((bb_file, prop_file), (bb_file, prop_file, img_file, cls_id,
+                self.config['th_small'], self.config['use_difficult'])))
+        fn_anno = os.path.join(self.cache_path, self.name + '_' + self.IDX_VER + '_anno.pkl')
+        temp = parse_annotations(fn_anno, _parse_annotation, jobs,
+                version=self.config, num_workers=self.num_workers)
+        max_objects = max([l.shape[0] for l in temp] + [0])
 
         assert max_objects > 0, "No objects found for any of the images"
-        return temp, max_objects
+        return LabelStore.from_labels(temp, 6), max_objects
 
     def _pad_labels(self):
-        """ labels: list of ndarrays """
+        """ labels are padded to self.padding rows in padded_label_from_index """
         self.padding = np.maximum(self.max_objects, self.config['padding'])
-        for (i, label) in enumerate(self.labels):
-            padded = np.tile(np.full((6, ), -1, dtype=np.float32), (self.padding, 1))
-            padded[:label.shape[0], :] = label
-            self.labels[i] = padded
-            assert self.labels[i].shape[0] == self.max_objects
+
+
+def _parse_annotation(bb_file, prop_file, img_file, cls_id, th_small, use_difficult):
+    """
+    parse ground-truths of an image from its .bb and .prop_label files
+
+    Returns:
+    ----------
+    (n_object, 6) array of [cls_id, xmin, ymin, xmax, ymax, 0], normalized to [0, 1],
+    cls_id is -1 for invalid objects
+    """
+    bbs = np.reshape(np.loadtxt(bb_file).astype(float), (-1, 4))
+    if bbs.size == 0:
+        return np.empty((0, 6))
+    ww_img = 0
+    hh_img = 0
+    small_mask = np.maximum(bbs[:, 2], bbs[:, 3]) < th_small
+    # remove bbs that are 1) invalid or 2) too small and occluded.
+    with open(prop_file, 'r') as fh:
+        prop_data = fh.read().splitlines()
+    for pdata in prop_data:
+        prop_bb = pdata.split(' ')
+        if prop_bb[0] == 'invalid_label_list':
+            invalid_mask = np.array(prop_bb[1:]).astype(int) == 1
+        if prop_bb[0] == 'occlusion_label_list':
+            occ_mask = np.array(prop_bb[1:]).astype(int) == 2
+        if prop_bb[0] == 'blur_label_list':
+            blur_mask = np.array(prop_bb[1:]).astype(int) == 2
+        # also get image size
+        if prop_bb[0] == 'image_size':
+            ww_img = int(prop_bb[1])
+            hh_img = int(prop_bb[2])
+    if use_difficult is not True:
+        hard_mask = np.logical_or(blur_mask, occ_mask)
+        hard_mask = np.logical_and(hard_mask, small_mask)
+        invalid_mask = np.logical_or(invalid_mask, hard_mask)
+    # FOR DEBUG, save image size to .prop_label
+    if ww_img == 0:
+        hh_img, ww_img = probe_image_size(img_file)
+        prop_data.append('image_size %d %d' % (ww_img, hh_img))
+        with open(prop_file, 'w') as fh:
+            for pdata in prop_data:
+                fh.write(pdata + '\n')
+
+    invalid_idx = np.where(invalid_mask == True)[0]
+
+    # we need [xmin, ymin, xmax, ymax], but wider DB has [xmin, ymin, width, height]
+    bbs[:, 2] += bbs[:, 0]
+    bbs[:, 3] += bbs[:, 1]
+    # normalize to [0, 1]
+    bbs[:, 0::2] /= ww_img
+    bbs[:, 1::2] /= hh_img
+
+    bbs = np.minimum(np.maximum(bbs, 0.0), 1.0)
+
+    label = np.zeros((bbs.shape[0], 6))
+    label[:, 0] = cls_id
+    label[invalid_idx, 0] = -1
+    label[:, 1:5] = bbs
+    return label
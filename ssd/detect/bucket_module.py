@@ -0,0 +1,155 @@
+from collections import OrderedDict
+import logging
+import mxnet as mx
+
+
+class BucketedModule(object):
+    """
+    Inference module for variable size images.
+    Input height and width are rounded up to a small set of bucket sizes and the
+    data is zero padded at the bottom and right, so detections in pixels are not
+    changed except the ones on the padding. Modules of recently used buckets are
+    kept bound in an LRU cache, instead of reshaping one module for every image.
+    All the modules share parameters and memory with the module of the largest
+    bucket and batch size.
+
+    Parameters:
+    ----------
+    symbol : mx.Symbol
+        network symbol
+    buckets : list of int
+        bucket sizes of height and width, sizes larger than the largest bucket are
+        rounded up to a multiple of img_stride
+    context : mx.ctx or list of mx.ctx
+        device to use
+    label_names : list of str or None
+        label names of the symbol, labels are not padded
+    max_cached : int
+        max number of bound modules, including the largest bucket one
+    img_stride : int
+        stride of input sizes out of buckets
+    """
+    def __init__(self, symbol, buckets, context=mx.cpu(), label_names=None,
+                 max_cached=8, img_stride=32, logger=logging):
+        assert buckets, "no bucket size"
+        assert max_cached >= 1
+        self._symbol = symbol
+        self._buckets = sorted(set(int(b) for b in buckets))
+        self._context = context
+        self._label_names = label_names
+        self._max_cached = max_cached
+        self._img_stride = img_stride
+        self._logger = logger
+
+        self._shared = None
+        self._batch_size = 0
+        self._modules = OrderedDict()
+        self._curr = None
+        self.hits = 0
+        self.misses = 0
+
+    def bucket_size(self, size):
+        """
+        the smallest bucket not less than size
+        """
+        for b in self._buckets:
+            if b >= size:
+                return b
+        return int((size + self._img_stride - 1) // self._img_stride * self._img_stride)
+
+    def bind(self, batch_size=1, label_shapes=None):
+        """
+        bind the module of the largest bucket, memory of other modules is shared from it
+
+        Parameters:
+        ----------
+        batch_size : int
+            max number of images per forward, a larger batch binds again
+        label_shapes : list of (name, shape) or None
+            label shapes of the max batch size
+        """
+        max_b = self._buckets[-1]
+        data_shapes = [('data', (batch_size, 3, max_b, max_b))]
+        shared = mx.mod.Module(self._symbol, label_names=self._label_names,
+                context=self._context, logger=self._logger)
+        shared.bind(data_shapes=data_shapes, label_shapes=label_shapes, for_training=False)
+        # keep parameters when binding again for a larger batch
+        if self._shared is not None and self._shared.params_initialized:
+            arg_params, aux_params = self._shared.get_params()
+            shared.set_params(arg_params, aux_params)
+        self._shared = shared
+        self._batch_size = batch_size
+        self._modules = OrderedDict()
+        key = (tuple(data_shapes[0][1]), _shape_key(label_shapes))
+        self._modules[key] = self._shared
+
+    @property
+    def batch_size(self):
+        """
+        max batch size of the bound modules
+        """
+        return self._batch_size
+
+    def set_params(self, arg_params, aux_params, **kwargs):
+        self._shared.set_params(arg_params, aux_params, **kwargs)
+
+    def forward(self, data_batch):
+        """
+        pad data to its bucket and forward with the module of the bucket
+        """
+        data = data_batch.data[0]
+        n, c, h, w = data.shape
+        bh, bw = self.bucket_size(h), self.bucket_size(w)
+        if bh != h or bw != w:
+            data = mx.nd.pad(data, mode='constant', constant_value=0,
+                    pad_width=(0, 0, 0, 0, 0, bh - h, 0, bw - w))
+        label_shapes = None
+        if self._label_names and data_batch.label:
+            label_shapes = [(k, l.shape) for k, l in zip(self._label_names, data_batch.label)]
+        if self._shared is not None and n > self._batch_size:
+            self._logger.warning('batch size %d is larger than the bound %d, binding again', n, self._batch_size)
+            self.bind(n, label_shapes)
+
+        self._curr = self._get_module((n, c, bh, bw), label_shapes)
+        batch = mx.io.DataBatch(data=[data], label=data_batch.label,
+                provide_data=[('data', (n, c, bh, bw))], provide_label=label_shapes)
+        self._curr.forward(batch, is_train=False)
+
+    def get_outputs(self):
+        return self._curr.get_outputs()
+
+    def stats(self):
+        """
+        cache statistics as a dict
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'cached': len(self._modules)}
+
+    def _get_module(self, data_shape, label_shapes):
+        if self._shared is None:
+            raise RuntimeError("bind() and set_params() before forward")
+        key = (tuple(data_shape), _shape_key(label_shapes))
+        mod = self._modules.pop(key, None)
+        if mod is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            mod = mx.mod.Module(self._symbol, label_names=self._label_names,
+                    context=self._context, logger=self._logger)
+            mod.bind(data_shapes=[('data', data_shape)], label_shapes=label_shapes,
+                    for_training=False, shared_module=self._shared)
+            # evict the least recently used module, except the shared one
+            while len(self._modules) >= self._max_cached:
+                for k, m in self._modules.items():
+                    if m is not self._shared:
+                        del self._modules[k]
+                        break
+                else:
+                    break
+        self._modules[key] = mod
+        return mod
+
+
+def _shape_key(shapes):
+    if not shapes:
+        return None
+    return tuple((k, tuple(s)) for k, s in shapes)
@@ -4,7 +4,9 @@ import numpy as np
 from timeit import default_timer as timer
 from config.config import cfg
 from dataset.testdb import TestDB
+from dataset.memorydb import MemoryDB
 from dataset.iterator import DetIter
+from tools.do_nms import nms
 
 class Detector(object):
     """
@@ -41,6 +43,7 @@ class Detector(object):
         self.mod.set_params(args, auxs)
         self.data_shape = data_shape
         self.mean_pixels = mean_pixels
+        self.batch_size = batch_size
         self.th_nms = cfg.valid['th_nms']
 
     def detect(self, det_iter, show_timer=False):
@@ -69,17 +72,26 @@ class Detector(object):
                 num_images, time_elapsed))
         result = []
         for i in range(detections.shape[0]):
-            det = detections[i, :, :]
-            pidx = np.where(det[:, 0] >= 0)[0]
-            det = det[pidx, :]
-            sidx = np.argsort(det[:, 1])[::-1]
-            det = det[sidx, :]
-            vidx = self._do_nms(det)
-            det = det[vidx, :]
-            res = det[np.where(det[:, 0] >= 0)[0]]
-            result.append(res)
+            result.append(self.postprocess(detections[i, :, :]))
         return result
 
+    def postprocess(self, det):
+        """
+        valid detections of one image sorted by score, after nms
+
+        Parameters:
+        ----------
+        det : numpy.array
+            network output of one image, (n_anchor, 6)
+        """
+        pidx = np.where(det[:, 0] >= 0)[0]
+        det = det[pidx, :]
+        sidx = np.argsort(det[:, 1])[::-1]
+        det = det[sidx, :]
+        vidx = self._do_nms(det)
+        det = det[vidx, :]
+        return det[np.where(det[:, 0] >= 0)[0]]
+
     def im_detect(self, im_list, root_dir=None, extension=None, show_timer=False):
         """
         wrapper for detecting multiple images
@@ -100,6 +112,25 @@ class Detector(object):
         format np.array([id, score, xmin, ymin, xmax, ymax]...)
         """
         test_db = TestDB(im_list, root_dir=root_dir, extension=extension)
+        return self._detect_db(test_db, show_timer)
+
+    def detect_images(self, images, show_timer=False):
+        """
+        detect in-memory images, without reading files
+
+        Parameters:
+        ----------
+        images : bytes or numpy.array or list of them
+            encoded image files, or decoded (height, width, 3) uint8 images in rgb order
+
+        Returns:
+        ----------
+        list of detection results in format [det0, det1...], det is in
+        format np.array([id, score, xmin, ymin, xmax, ymax]...)
+        """
+        return self._detect_db(MemoryDB(images), show_timer)
+
+    def _detect_db(self, test_db, show_timer):
         test_iter = DetIter(test_db, 1, self.data_shape, self.mean_pixels,
                             is_train=False)
         return self.detect(test_iter, show_timer)
@@ -182,17 +213,5 @@ class Detector(object):
 
     def _do_nms(self, dets):
         #
-        areas = (dets[:, 4] - dets[:, 2]) * (dets[:, 5] - dets[:, 3])
-        vmask = np.ones((dets.shape[0],), dtype=int)
-        vidx = []
-        for i, d in enumerate(dets):
-            if vmask[i] == 0:
-                continue
-            iw = np.minimum(d[4], dets[i:, 4]) - np.maximum(d[2], dets[i:, 2])
-            ih = np.minimum(d[5], dets[i:, 5]) - np.maximum(d[3], dets[i:, 3])
-            I = np.maximum(iw, 0) * np.maximum(ih, 0)
-            iou = I / np.maximum(areas[i:] + areas[i] - I, 1e-08)
-            nidx = np.where(iou > self.th_nms)[0] + i
-            vmask[nidx] = 0
-            vidx.append(i)
-        return vidx
+        # dets are sorted by score, classes are not considered
+        return nms(dets[:, 2:6], None, self.th_nms)
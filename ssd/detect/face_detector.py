@@ -2,11 +2,14 @@ from __future__ import print_function
 import os
 from timeit import default_timer as timer
 from dataset.testdb import TestDB
+from dataset.memorydb import MemoryDB
 from dataset.face_test_iter import FaceTestIter
+from detect.bucket_module import BucketedModule
 # from mutable_module import MutableModule
 import mxnet as mx
 import numpy as np
-from tools.do_nms import do_nms
+import cv2
+from tools.do_nms import do_nms, nms
 
 class FaceDetector(object):
     """
@@ -28,10 +31,18 @@ class FaceDetector(object):
         run detection with batch size
     ctx : mx.ctx
         device to use, if None, use mx.cpu() as default context
+    buckets : list of int or None
+        if set, input sizes are padded to these bucket sizes, and bound modules
+        of max_cached buckets are reused instead of reshaping for every image
+    max_cached : int
+        max number of bound modules with buckets
+    batch_size : int
+        number of images per forward in im_detect
     """
 
     def __init__(self, symbol, model_prefix, epoch, data_hw, mean_pixels,
-                 img_stride=32, th_nms=0.3333, ctx=None):
+                 img_stride=32, th_nms=0.3333, ctx=None, buckets=None, max_cached=8,
+                 batch_size=1):
         '''
         '''
         self.ctx = mx.cpu() if not ctx else ctx
@@ -43,13 +54,21 @@ class FaceDetector(object):
 
         _, arg_params, aux_params = mx.model.load_checkpoint(model_prefix, epoch)
 
-        self.mod = mx.mod.Module(symbol, label_names=None, context=ctx)
-        self.mod.bind(data_shapes=[('data', (1, 3, data_hw[0], data_hw[1]))])
+        if buckets:
+            self.mod = BucketedModule(symbol, buckets, context=self.ctx,
+                    max_cached=max_cached, img_stride=img_stride)
+            self.mod.bind(batch_size)
+        else:
+            self.mod = mx.mod.Module(symbol, label_names=None, context=ctx)
+            self.mod.bind(data_shapes=[('data', (batch_size, 3, data_hw[0], data_hw[1]))])
         self.mod.set_params(arg_params, aux_params)
+        self.bucketed = bool(buckets)
+        self.symbol = symbol
 
         self.mean_pixels = mean_pixels
         self.img_stride = img_stride
         self.th_nms = th_nms
+        self.batch_size = batch_size
 
     def detect(self, det_iter, show_timer=False):
         """
@@ -64,40 +83,49 @@ class FaceDetector(object):
 
         Returns:
         ----------
-        list of detection results
+        list of detection results and list of image paths, in the image order
+        of the iterator
         """
         num_images = det_iter._size
 
-        result = []
-        im_paths = []
-        detections = []
+        result = {}
+        im_paths = {}
+        n_done = 0
         time_elapsed = 0
         for i, (datum, im_info) in enumerate(det_iter):
-            im_paths.append(im_info['im_path'])
-            self.mod.reshape(data_shapes=datum.provide_data)
+            if not self.bucketed:
+                self.mod.reshape(data_shapes=datum.provide_data)
 
             start = timer()
             self.mod.forward(datum)
             out = self.mod.get_outputs()
-            det = out[0][0].asnumpy()
-            det = do_nms(det, 1, self.th_nms)
-            pidx = np.where(det[:, 0] >= 0)[0]
-            det = det[pidx, :]
-            # sidx = np.argsort(det[:, 1])[::-1]
-            # det = det[sidx, :]
-            # vidx = self._do_nms(det)
-            # det = det[vidx, :]
+            dets = out[0].asnumpy()
+            for j, index in enumerate(im_info['index']):
+                det = do_nms(dets[j], 1, self.th_nms)
+                pidx = np.where(det[:, 0] >= 0)[0]
+                det = det[pidx, :]
+                # sidx = np.argsort(det[:, 1])[::-1]
+                # det = det[sidx, :]
+                # vidx = self._do_nms(det)
+                # det = det[vidx, :]
+                # remove detections on the padding of the batch
+                valid_h, valid_w = im_info['valid_hw'][j]
+                det = det[np.logical_and(det[:, 2] < valid_w, det[:, 3] < valid_h)]
+                result[index] = det
+                im_paths[index] = im_info['im_path'][j]
             time_elapsed += timer() - start
 
-            result.append(det)
-
             if i % 10 == 0:
                 n_dets = det.shape[0]
-                print('Processing image {}/{}, {} faces detected.'.format(i+1, num_images, n_dets))
+                print('Processing image {}/{}, {} faces detected.'.format(n_done+1, num_images, n_dets))
+            n_done += len(im_info['index'])
         # time_elapsed = timer() - start
         if show_timer:
             print("Detection time for {} images: {:.4f} sec".format(num_images, time_elapsed))
-        return result, im_paths
+            if self.bucketed:
+                print("Bucket cache: {}".format(self.mod.stats()))
+        indices = det_iter._indices
+        return [result[i] for i in indices], [im_paths[i] for i in indices]
 
     def im_detect(self,
                   im_list,
@@ -123,10 +151,161 @@ class FaceDetector(object):
         format np.array([id, score, xmin, ymin, xmax, ymax]...)
         """
         test_db = TestDB(im_list, root_dir=root_dir, extension=extension)
+        return self._detect_db(test_db, show_timer)
+
+    def detect_images(self, images, show_timer=False):
+        """
+        detect in-memory images, without reading files
+
+        Parameters:
+        ----------
+        images : bytes or numpy.array or list of them
+            encoded image files, or decoded (height, width, 3) uint8 images in rgb order
+
+        Returns:
+        ----------
+        list of detection results in format [det0, det1...], det is in
+        format np.array([id, score, xmin, ymin, xmax, ymax]...), and the list of
+        image names
+        """
+        return self._detect_db(MemoryDB(images), show_timer)
+
+    def _detect_db(self, test_db, show_timer):
         test_iter = FaceTestIter(test_db,
-                mean_pixels=self.mean_pixels, img_stride=self.img_stride)
+                mean_pixels=self.mean_pixels, img_stride=self.img_stride,
+                batch_size=self.batch_size)
         return self.detect(test_iter, show_timer)
 
+    def im_detect_tiled(self,
+                        im_list,
+                        root_dir=None,
+                        extension=None,
+                        scales=(1.0,),
+                        tile_size=768,
+                        overlap=128,
+                        max_memory_mb=1024,
+                        show_timer=False):
+        """
+        detect large images by tiles, at multiple scales
+
+        Parameters:
+        ----------
+        im_list : list of str
+            image path or list of image paths
+        root_dir : str
+            directory of input images, optional if image path already
+            has full directory information
+        extension : str
+            image extension, eg. ".jpg", optional
+        scales : list of float
+            image scales, e.g. (2.0, 1.0, 0.5) to find both tiny and large faces
+        tile_size : int
+            tile height and width, multiple of img_stride
+        overlap : int
+            overlap of neighbouring tiles in pixels of the scaled image,
+            faces smaller than overlap are fully inside at least one tile
+        max_memory_mb : float
+            memory ceiling of activations in MB, the number of tiles in a batch
+            is chosen so that the estimated activation memory fits in it
+
+        Returns:
+        ----------
+        list of detection results in format [det0, det1...], det is in
+        format np.array([id, score, xmin, ymin, xmax, ymax]...) in original image pixels,
+        and the list of image paths
+        """
+        test_db = TestDB(im_list, root_dir=root_dir, extension=extension)
+        tile_batch = self.tile_batch_size(tile_size, max_memory_mb)
+        if self.bucketed and tile_batch > self.mod.batch_size:
+            # share memory with a module bound for batches of tiles
+            self.mod.bind(tile_batch)
+
+        result = []
+        im_paths = []
+        start = timer()
+        for i in range(test_db.num_images):
+            im_path = test_db.image_path_from_index(i)
+            img = cv2.cvtColor(cv2.imread(im_path), cv2.COLOR_BGR2RGB)
+            det = self.detect_tiled(img, scales, tile_size, overlap, tile_batch)
+            result.append(det)
+            im_paths.append(im_path)
+            if i % 10 == 0:
+                print('Processing image {}/{}, {} faces detected.'.format( \
+                        i+1, test_db.num_images, det.shape[0]))
+        if show_timer:
+            print("Detection time for {} images: {:.4f} sec, {} tiles per batch".format( \
+                    test_db.num_images, timer() - start, tile_batch))
+        return result, im_paths
+
+    def detect_tiled(self, img, scales=(1.0,), tile_size=768, overlap=128, tile_batch=4):
+        """
+        detect faces in an image with overlapping tiles of each scale, run as batches
+
+        Parameters:
+        ----------
+        img : numpy.array
+            (height, width, 3) image, in rgb format
+        others : see im_detect_tiled, tile_batch is the number of tiles per forward
+
+        Returns:
+        ----------
+        numpy.array([id, score, xmin, ymin, xmax, ymax]...) in image pixels,
+        merged by nms across tiles and scales, sorted by score
+        """
+        assert tile_size % self.img_stride == 0, "tile size should be a multiple of img_stride"
+        assert 0 <= overlap < tile_size
+        mean_pixels = np.reshape(np.array(self.mean_pixels, dtype=np.float32), (1, 1, 3))
+
+        # tiles as (scale, scaled image, x0, y0)
+        tiles = []
+        for sc in scales:
+            if sc == 1.0:
+                simg = img
+            else:
+                simg = cv2.resize(img, (int(round(img.shape[1] * sc)), int(round(img.shape[0] * sc))),
+                        interpolation=cv2.INTER_LINEAR)
+            for y0 in _tile_starts(simg.shape[0], tile_size, overlap):
+                for x0 in _tile_starts(simg.shape[1], tile_size, overlap):
+                    tiles.append((sc, simg, x0, y0))
+
+        dets = []
+        for b in range(0, len(tiles), tile_batch):
+            batch_tiles = tiles[b:b+tile_batch]
+            data = np.zeros((len(batch_tiles), 3, tile_size, tile_size), dtype=np.float32)
+            for k, (_, simg, x0, y0) in enumerate(batch_tiles):
+                crop = simg[y0:y0+tile_size, x0:x0+tile_size]
+                data[k, :, :crop.shape[0], :crop.shape[1]] = np.transpose(crop - mean_pixels, (2, 0, 1))
+            datum = mx.io.DataBatch(data=[mx.nd.array(data)], label=None,
+                    provide_data=[('data', data.shape)])
+            if not self.bucketed:
+                self.mod.reshape(data_shapes=datum.provide_data)
+            self.mod.forward(datum)
+            out = self.mod.get_outputs()[0].asnumpy()
+
+            for k, (sc, simg, x0, y0) in enumerate(batch_tiles):
+                det = do_nms(out[k], 1, self.th_nms)
+                det = det[det[:, 0] >= 0]
+                det = det[_in_tile(det, simg.shape, x0, y0, tile_size, overlap)]
+                det[:, (2, 4)] = (det[:, (2, 4)] + x0) / sc
+                det[:, (3, 5)] = (det[:, (3, 5)] + y0) / sc
+                dets.append(det)
+
+        # cross tile and cross scale nms
+        dets = np.vstack(dets) if dets else np.zeros((0, 6), dtype=np.float32)
+        dets = do_nms(dets, 1, self.th_nms)
+        dets = dets[dets[:, 0] >= 0]
+        return dets[np.argsort(dets[:, 1])[::-1]]
+
+    def tile_batch_size(self, tile_size, max_memory_mb):
+        """
+        number of tiles per forward, such that the activation memory estimated from
+        the output shapes of all layers does not exceed max_memory_mb
+        """
+        internals = self.symbol.get_internals()
+        _, out_shapes, _ = internals.infer_shape(data=(1, 3, tile_size, tile_size))
+        per_tile = 4.0 * sum(np.prod(s) for s in out_shapes if s)
+        return max(1, int(max_memory_mb * 1024 * 1024 // per_tile))
+
     def visualize_detection(self, img, dets, classes=[], thresh=0.6):
         """
         visualize detections in one image
@@ -243,20 +422,8 @@ class FaceDetector(object):
 
     def _do_nms(self, dets):
         #
-        areas = (dets[:, 4] - dets[:, 2]) * (dets[:, 5] - dets[:, 3])
-        vmask = np.ones((dets.shape[0],), dtype=int)
-        vidx = []
-        for i, d in enumerate(dets):
-            if vmask[i] == 0:
-                continue
-            iw = np.minimum(d[4], dets[i:, 4]) - np.maximum(d[2], dets[i:, 2])
-            ih = np.minimum(d[5], dets[i:, 5]) - np.maximum(d[3], dets[i:, 3])
-            I = np.maximum(iw, 0) * np.maximum(ih, 0)
-            iou = I / np.maximum(areas[i:] + areas[i] - I, 1e-08)
-            nidx = np.where(iou > self.th_nms)[0] + i
-            vmask[nidx] = 0
-            vidx.append(i)
-        return vidx
+        # dets are sorted by score, classes are not considered
+        return nms(dets[:, 2:6], None, self.th_nms)
 
 
     def _comp_overlap(self, dets, im_shape):
@@ -270,3 +437,36 @@ class FaceDetector(object):
 
         overlap = (iw * ih) / (area_dets + 1e-04)
         return overlap
+
+
+def _tile_starts(length, tile_size, overlap):
+    """
+    start positions of tiles covering [0, length), the last tile is aligned to the end
+    """
+    if length <= tile_size:
+        return [0]
+    starts = list(range(0, length - tile_size, tile_size - overlap))
+    starts.append(length - tile_size)
+    return starts
+
+
+def _in_tile(dets, im_shape, x0, y0, tile_size, overlap, margin=2.0):
+    """
+    mask of detections to keep from a tile: detections starting on the padding are
+    removed, and so are small ones touching an edge shared with another tile,
+    since the neighbouring tile covers them entirely
+    """
+    h = min(tile_size, im_shape[0] - y0)
+    w = min(tile_size, im_shape[1] - x0)
+    keep = np.logical_and(dets[:, 2] < w, dets[:, 3] < h)
+    small = np.logical_and(dets[:, 4] - dets[:, 2] <= overlap, dets[:, 5] - dets[:, 3] <= overlap)
+    cut = np.zeros(dets.shape[0], dtype=bool)
+    if x0 > 0:
+        cut |= dets[:, 2] <= margin
+    if y0 > 0:
+        cut |= dets[:, 3] <= margin
+    if x0 + w < im_shape[1]:
+        cut |= dets[:, 4] >= w - margin
+    if y0 + h < im_shape[0]:
+        cut |= dets[:, 5] >= h - margin
+    return np.logical_and(keep, np.logical_not(np.logical_and(small, cut)))
@@ -0,0 +1,286 @@
+from __future__ import print_function
+import json
+import threading
+import time
+from collections import deque
+import numpy as np
+import cv2
+import mxnet as mx
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+class DetectionServer(object):
+    """
+    Long-lived inference service around a Detector.
+    Requests from concurrent callers are queued, a worker thread batches them up to
+    the bound batch size of the detector, or until the oldest request has waited
+    max_latency_ms, and runs one forward for the batch.
+    Images are preprocessed in the calling threads.
+
+    Parameters:
+    ----------
+    detector : Detector
+        detector with a module bound to (batch_size, 3, data_shape, data_shape)
+    max_latency_ms : float
+        max time a request waits for the batch to be filled
+    max_queue : int
+        max number of pending requests, submit() blocks when the queue is full
+    num_latencies : int
+        number of recent requests used for latency percentiles
+    """
+    def __init__(self, detector, max_latency_ms=10.0, max_queue=1024, num_latencies=10000):
+        self.detector = detector
+        self.batch_size = detector.batch_size
+        self.data_shape = detector.data_shape
+        self._mean = np.reshape(np.array(detector.mean_pixels, dtype=np.float32), (3, 1, 1))
+        self._max_latency = max_latency_ms / 1000.0
+        self._queue = queue.Queue(max_queue)
+        self._batch_buf = np.zeros((self.batch_size, 3, self.data_shape, self.data_shape),
+                                   dtype=np.float32)
+
+        self._lock = threading.Lock()
+        # no request is queued after the stop sentinel
+        self._submit_lock = threading.Lock()
+        self._stopped = True
+        self._latencies = deque(maxlen=num_latencies)
+        self._num_requests = 0
+        self._num_batches = 0
+        self._num_errors = 0
+        self._start_time = None
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        self._start_time = time.time()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        self._stopped = False
+        return self
+
+    def stop(self):
+        """
+        stop the worker thread after the pending requests are served
+        """
+        with self._submit_lock:
+            if self._thread is None or self._stopped:
+                return
+            self._stopped = True
+            self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def submit(self, img):
+        """
+        queue an image for detection
+
+        Parameters:
+        ----------
+        img : numpy.array or bytes
+            (height, width, 3) rgb image, or content of an image file
+
+        Returns:
+        ----------
+        DetectionRequest, its result() gives the detections in format
+        np.array([id, score, xmin, ymin, xmax, ymax]...), coordinates in [0, 1]
+        """
+        req = DetectionRequest(self._preprocess(img))
+        with self._submit_lock:
+            if self._stopped:
+                raise RuntimeError("server is not started")
+            self._queue.put(req)
+        return req
+
+    def detect(self, img, timeout=None):
+        """
+        blocking detection of one image, see submit()
+        """
+        return self.submit(img).result(timeout)
+
+    def stats(self):
+        """
+        request counters, throughput and latency percentiles in ms
+        """
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000.0
+            num_requests = self._num_requests
+            num_batches = self._num_batches
+            num_errors = self._num_errors
+        elapsed = time.time() - self._start_time if self._start_time else 0.0
+        res = {'requests': num_requests,
+               'batches': num_batches,
+               'errors': num_errors,
+               'pending': self._queue.qsize(),
+               'avg_batch': float(num_requests) / num_batches if num_batches else 0.0,
+               'images_per_sec': num_requests / elapsed if elapsed > 0 else 0.0}
+        for p in (50, 90, 99):
+            res['p{}_ms'.format(p)] = float(np.percentile(latencies, p)) if latencies.size else 0.0
+        return res
+
+    def _preprocess(self, img):
+        """
+        decode if needed, resize, swap channels and sub mean, as DetIter for testing
+        """
+        if not isinstance(img, np.ndarray):
+            img = cv2.imdecode(np.frombuffer(img, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if img is None:
+                raise ValueError("failed to decode image")
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        img = cv2.resize(img, (self.data_shape, self.data_shape), interpolation=cv2.INTER_LINEAR)
+        return np.transpose(img, (2, 0, 1)).astype(np.float32) - self._mean
+
+    def _next_batch(self):
+        """
+        block for the first request, then take requests until the batch is full
+        or the first one has waited max_latency
+        """
+        first = self._queue.get()
+        if first is None:
+            return None, True
+        batch = [first]
+        deadline = first.arrival + self._max_latency
+        stop = False
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            try:
+                req = self._queue.get(remaining > 0, max(remaining, 0))
+            except queue.Empty:
+                break
+            if req is None:
+                stop = True
+                break
+            batch.append(req)
+        return batch, stop
+
+    def _run(self):
+        while True:
+            batch, stop = self._next_batch()
+            if batch:
+                self._forward(batch)
+            if stop:
+                break
+
+    def _forward(self, batch):
+        try:
+            for i, req in enumerate(batch):
+                self._batch_buf[i] = req.data
+            self._batch_buf[len(batch):] = 0
+            datum = mx.io.DataBatch(data=[mx.nd.array(self._batch_buf)], label=None,
+                                    provide_data=[('data', self._batch_buf.shape)])
+            self.detector.mod.forward(datum, is_train=False)
+            out = self.detector.mod.get_outputs()[0].asnumpy()
+            results = [self.detector.postprocess(out[i]) for i in range(len(batch))]
+        except Exception as e:
+            for req in batch:
+                req.set_error(e)
+            with self._lock:
+                self._num_errors += len(batch)
+            return
+        done = time.time()
+        for req, res in zip(batch, results):
+            req.set_result(res)
+        with self._lock:
+            self._num_requests += len(batch)
+            self._num_batches += 1
+            self._latencies.extend(done - req.arrival for req in batch)
+
+
+class DetectionRequest(object):
+    """
+    pending detection of one image
+    """
+    def __init__(self, data):
+        self.data = data
+        self.arrival = time.time()
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def set_result(self, result):
+        self._result = result
+        self.data = None
+        self._done.set()
+
+    def set_error(self, error):
+        self._error = error
+        self.data = None
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError("detection timeout")
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_http(server, host='127.0.0.1', port=8080):
+    """
+    simple http front end for testing, blocks until interrupted.
+    POST /detect with an encoded image as body returns the detections as json,
+    GET /stats returns server.stats()
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != '/detect':
+                self.send_error(404)
+                return
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            try:
+                det = server.detect(bytes(body))
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+            except Exception as e:
+                self.send_error(500, str(e))
+                return
+            self._send_json({'detections': det.tolist()})
+
+        def do_GET(self):
+            if self.path != '/stats':
+                self.send_error(404)
+                return
+            self._send_json(server.stats())
+
+        def _send_json(self, obj):
+            data = json.dumps(obj).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = _ThreadingHTTPServer((host, port), Handler)
+    print('serving detection on http://{}:{}'.format(host, port))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
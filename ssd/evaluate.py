@@ -48,6 +48,8 @@ def parse_args():
                         help='use difficult ground-truths in evaluation')
     parser.add_argument('--voc07', dest='use_voc07_metric', type=bool, default=True,
                         help='use PASCAL VOC 07 metric')
+    parser.add_argument('--num-bins', dest='num_bins', type=int, default=0,
+                        help='streaming mAP with this many score bins per class, 0 for exact mAP')
     parser.add_argument('--deploy', dest='deploy_net', help='Load network from model',
                         action='store_true', default=False)
     args = parser.parse_args()
@@ -86,4 +88,4 @@ if __name__ == '__main__':
                  path_imglist=args.list_path, nms_thresh=args.nms_thresh,
                  force_nms=args.force_nms, ovp_thresh=args.overlap_thresh,
                  use_difficult=args.use_difficult, class_names=class_names,
-                 voc07_metric=args.use_voc07_metric)
+                 voc07_metric=args.use_voc07_metric, num_bins=args.num_bins)
@@ -15,8 +15,17 @@ class MApMetric(mx.metric.EvalMetric):
         optional, if provided, will print out AP for each class
     pred_idx : int
         prediction index in network output list
+    num_bins : int or None
+        None to keep all (score, tp/fp) records and compute the exact AP.
+        Otherwise streaming mode: scores in [0, 1] are counted in num_bins histogram
+        bins per class, memory is O(num_bins) and get() is O(num_bins).
+        Only the order of detections within a bin is lost, so AP is exact if no bin
+        has both tp and fp, and in general differs from the exact AP by at most
+        sum(tp in such bins) / (gt count) per class (for the 11-point VOC07 AP, only
+        the recall points falling in such bins may differ).
     """
-    def __init__(self, ovp_thresh=0.5, use_difficult=False, class_names=None, pred_idx=0):
+    def __init__(self, ovp_thresh=0.5, use_difficult=False, class_names=None, pred_idx=0,
+                 num_bins=None):
         super(MApMetric, self).__init__('mAP')
         if class_names is None:
             self.num = None
@@ -32,6 +41,7 @@ class MApMetric(mx.metric.EvalMetric):
         self.use_difficult = use_difficult
         self.class_names = class_names
         self.pred_idx = int(pred_idx)
+        self.num_bins = None if not num_bins else int(num_bins)
 
     def reset(self):
         """Clear the internal statistics to initial state."""
@@ -79,34 +89,6 @@ class MApMetric(mx.metric.EvalMetric):
         preds: mx.nd.array (m * 6)
             2-d array of detections, m objects(id-score-xmin-ymin-xmax-ymax)
         """
-        def iou(x, ys):
-            """
-            Calculate intersection-over-union overlap
-            Params:
-            ----------
-            x : numpy.array
-                single box [xmin, ymin ,xmax, ymax]
-            ys : numpy.array
-                multiple box [[xmin, ymin, xmax, ymax], [...], ]
-            Returns:
-            -----------
-            numpy.array
-                [iou1, iou2, ...], size == ys.shape[0]
-            """
-            ixmin = np.maximum(ys[:, 0], x[0])
-            iymin = np.maximum(ys[:, 1], x[1])
-            ixmax = np.minimum(ys[:, 2], x[2])
-            iymax = np.minimum(ys[:, 3], x[3])
-            iw = np.maximum(ixmax - ixmin, 0.)
-            ih = np.maximum(iymax - iymin, 0.)
-            inters = iw * ih
-            uni = (x[2] - x[0]) * (x[3] - x[1]) + (ys[:, 2] - ys[:, 0]) * \
-                (ys[:, 3] - ys[:, 1]) - inters
-            ious = inters / uni
-            ious[uni < 1e-12] = 0  # in case bad boxes
-            return ious
-
-
         # independant execution for each image
         for i in range(labels[0].shape[0]):
             # get as numpy arrays
@@ -114,75 +96,75 @@ class MApMetric(mx.metric.EvalMetric):
             if np.sum(label[:, 0] >= 0) < 1:
                 continue
             pred = preds[self.pred_idx][i].asnumpy()
-            # calculate for each class
-            while (pred.shape[0] > 0):
-                cid = int(pred[0, 0])
-                indices = np.where(pred[:, 0].astype(int) == cid)[0]
-                if cid < 0:
-                    pred = np.delete(pred, indices, axis=0)
-                    continue
-                dets = pred[indices]
-                pred = np.delete(pred, indices, axis=0)
-                # sort by score, desceding
-                dets[dets[:,1].argsort()[::-1]]
-                records = np.hstack((dets[:, 1][:, np.newaxis], np.zeros((dets.shape[0], 1))))
-                # ground-truths
-                label_indices = np.where(label[:, 0].astype(int) == cid)[0]
-                gts = label[label_indices, :]
-                label = np.delete(label, label_indices, axis=0)
-                if gts.size > 0:
-                    found = [False] * gts.shape[0]
-                    for j in range(dets.shape[0]):
-                        # compute overlaps
-                        ious = iou(dets[j, 2:], gts[:, 1:5])
-                        ovargmax = np.argmax(ious)
-                        ovmax = ious[ovargmax]
-                        if ovmax > self.ovp_thresh:
-                            if (not self.use_difficult and
-                                gts.shape[1] >= 6 and
-                                gts[ovargmax, 5] > 0):
-                                pass
-                            else:
-                                if not found[ovargmax]:
-                                    records[j, -1] = 1  # tp
-                                    found[ovargmax] = True
-                                else:
-                                    # duplicate
-                                    records[j, -1] = 2  # fp
-                        else:
-                            records[j, -1] = 2 # fp
-                else:
-                    # no gt, mark all fp
-                    records[:, -1] = 2
-
-                # ground truth count
-                if (not self.use_difficult and gts.shape[1] >= 6):
-                    gt_count = np.sum(gts[:, 5] < 1)
-                else:
-                    gt_count = gts.shape[0]
+            label_cids = label[:, 0].astype(int)
+            pred_cids = pred[:, 0].astype(int)
+            dets = pred[pred_cids >= 0]
+            det_cids = pred_cids[pred_cids >= 0]
+            # first column: score, second column: tp/fp
+            # 0: not set(matched to difficult or something), 1: tp, 2: fp
+            records = np.hstack((dets[:, 1][:, np.newaxis], np.full((dets.shape[0], 1), 2.0)))
+
+            # one iou matrix for all classes, detections are matched only to gts of
+            # the same class: each detection to its max overlap gt, in the given order,
+            # the first detection of a gt is tp and the others are duplicates (fp)
+            ious = _iou_matrix(dets[:, 2:6], label[:, 1:5])
+            ious[det_cids[:, np.newaxis] != label_cids[np.newaxis, :]] = -np.inf
+            ovargmax = np.argmax(ious, axis=1)
+            ovmax = ious[np.arange(dets.shape[0]), ovargmax]
+            matched = ovmax > self.ovp_thresh
+            if not self.use_difficult and label.shape[1] >= 6:
+                difficult = np.logical_and(matched, label[ovargmax, 5] > 0)
+                records[difficult, -1] = 0
+                matched = np.logical_and(matched, np.logical_not(difficult))
+            matched_idx = np.where(matched)[0]
+            _, first = np.unique(ovargmax[matched_idx], return_index=True)
+            records[matched_idx[first], -1] = 1
+
+            # ground truth count
+            if (not self.use_difficult and label.shape[1] >= 6):
+                gt_valid = label[:, 5] < 1
+            else:
+                gt_valid = np.ones(label_cids.shape, dtype=bool)
 
-                # now we push records to buffer
-                # first column: score, second column: tp/fp
-                # 0: not set(matched to difficult or something), 1: tp, 2: fp
-                records = records[np.where(records[:, -1] > 0)[0], :]
-                if records.size > 0:
-                    self._insert(cid, records, gt_count)
+            # now we push records to buffer, for each class in the order of appearance
+            for cid in _unique_in_order(det_cids):
+                gt_count = np.sum(np.logical_and(label_cids == cid, gt_valid))
+                cls_records = records[det_cids == cid]
+                cls_records = cls_records[np.where(cls_records[:, -1] > 0)[0], :]
+                if cls_records.size > 0:
+                    self._insert(cid, cls_records, gt_count)
 
             # add missing class if not present in prediction
-            while (label.shape[0] > 0):
-                cid = int(label[0, 0])
-                label_indices = np.where(label[:, 0].astype(int) == cid)[0]
-                label = np.delete(label, label_indices, axis=0)
-                if cid < 0:
+            for cid in _unique_in_order(label_cids):
+                if cid < 0 or np.any(det_cids == cid):
                     continue
-                gt_count = label_indices.size
-                self._insert(cid, np.array([[0, 0]]), gt_count)
+                gt_count = np.sum(label_cids == cid)
+                self._insert(cid, np.zeros((0, 2)), gt_count)
+
+    def merge(self, other):
+        """
+        Merge records of another metric, e.g. a shard evaluated on another device
+        or process. Both metrics must use the same setting.
+        """
+        assert type(other) is type(self)
+        assert other.num_bins == self.num_bins and other.ovp_thresh == self.ovp_thresh \
+            and other.use_difficult == self.use_difficult
+        for k, v in other.records.items():
+            if k not in self.records:
+                self.records[k] = self._new_records()
+                self.counts[k] = 0
+            self.records[k].merge(v)
+            self.counts[k] += other.counts[k]
+        return self
 
     def _update(self):
         """ update num_inst and sum_metric """
         aps = []
         for k, v in self.records.items():
-            recall, prec = self._recall_prec(v, self.counts[k])
+            if self.num_bins is None:
+                recall, prec = self._recall_prec(v.data, self.counts[k])
+            else:
+                recall, prec = self._hist_recall_prec(v, self.counts[k])
             ap = self._average_precision(recall, prec)
             aps.append(ap)
             if self.num is not None and k < (self.num - 1):
@@ -208,6 +190,18 @@ class MApMetric(mx.metric.EvalMetric):
         prec = tp.astype(float) / (tp + fp)
         return recall, prec
 
+    def _hist_recall_prec(self, hist, count):
+        """ get recall and precision at each non-empty bin, from high to low score """
+        valid = (hist.tp + hist.fp)[::-1] > 0
+        tp = np.cumsum(hist.tp[::-1])[valid]
+        fp = np.cumsum(hist.fp[::-1])[valid]
+        if count <= 0:
+            recall = tp * 0.0
+        else:
+            recall = tp / float(count)
+        prec = tp.astype(float) / (tp + fp)
+        return recall, prec
+
     def _average_precision(self, rec, prec):
         """
         calculate average precision
@@ -241,12 +235,15 @@ class MApMetric(mx.metric.EvalMetric):
         """ Insert records according to key """
         if key not in self.records:
             assert key not in self.counts
-            self.records[key] = records
-            self.counts[key] = count
-        else:
-            self.records[key] = np.vstack((self.records[key], records))
-            assert key in self.counts
-            self.counts[key] += count
+            self.records[key] = self._new_records()
+            self.counts[key] = 0
+        self.records[key].append(records)
+        self.counts[key] += count
+
+    def _new_records(self):
+        if self.num_bins is None:
+            return _RecordBuffer((2,), np.float64)
+        return _ScoreHistogram(self.num_bins)
 
 
 class VOC07MApMetric(MApMetric):
@@ -349,34 +346,6 @@ class RecallMetric(mx.metric.EvalMetric):
         preds: mx.nd.array (m * 6)
             2-d array of detections, m objects(id-score-xmin-ymin-xmax-ymax)
         """
-        def iou(x, ys):
-            """
-            Calculate intersection-over-union overlap
-            Params:
-            ----------
-            x : numpy.array
-                single box [xmin, ymin ,xmax, ymax]
-            ys : numpy.array
-                multiple box [[xmin, ymin, xmax, ymax], [...], ]
-            Returns:
-            -----------
-            numpy.array
-                [iou1, iou2, ...], size == ys.shape[0]
-            """
-            ixmin = np.maximum(ys[:, 0], x[0])
-            iymin = np.maximum(ys[:, 1], x[1])
-            ixmax = np.minimum(ys[:, 2], x[2])
-            iymax = np.minimum(ys[:, 3], x[3])
-            iw = np.maximum(ixmax - ixmin, 0.)
-            ih = np.maximum(iymax - iymin, 0.)
-            inters = iw * ih
-            uni = (x[2] - x[0]) * (x[3] - x[1]) + (ys[:, 2] - ys[:, 0]) * \
-                (ys[:, 3] - ys[:, 1]) - inters
-            ious = inters / uni
-            ious[uni < 1e-12] = 0  # in case bad boxes
-            return ious
-
-
         # independant execution for each image
         for i in range(labels[0].shape[0]):
             # get as numpy arrays
@@ -386,32 +355,23 @@ class RecallMetric(mx.metric.EvalMetric):
                 continue
             pred = preds[self.pred_idx][i].asnumpy()
             pred[:, 0] = np.minimum(pred[:, 0], 0) # we only need objectness
+            label_cids = label[:, 0].astype(int)
+            pred_cids = pred[:, 0].astype(int)
             # calculate for each class
-            while (pred.shape[0] > 0):
-                cid = int(pred[0, 0])
-                indices = np.where(pred[:, 0].astype(int) == cid)[0]
+            for cid in _unique_in_order(pred_cids):
                 if cid < 0:
-                    pred = np.delete(pred, indices, axis=0)
                     continue
-                dets = pred[indices]
-                pred = np.delete(pred, indices, axis=0)
-                # sort by score, desceding
-                dets[dets[:,1].argsort()[::-1]]
+                dets = pred[pred_cids == cid]
                 # ground-truths
-                label_indices = np.where(label[:, 0].astype(int) == cid)[0]
-                gts = label[label_indices, :]
-                label = np.delete(label, label_indices, axis=0)
-                records = np.zeros(label_indices.shape, dtype=np.float32)
+                gts = label[label_cids == cid]
+                records = np.zeros((gts.shape[0],), dtype=np.float32)
                 if gts.size > 0:
-                    found = [False for _ in gts]
-                    for j, gt in enumerate(gts):
-                        if (not self.use_difficult and gt.size >= 6 and gt[5] > 0):
-                            continue
-                        ious = iou(gt[1:5], dets[:, 2:])
-                        ovmax = np.max(ious)
-                        if ovmax > self.ovp_thresh:
-                            found[j] = True
-                    records = np.array(found).astype(np.float32)
+                    # a gt is found if any detection overlaps it
+                    ious = _iou_matrix(gts[:, 1:5], dets[:, 2:6])
+                    found = np.max(ious, axis=1) > self.ovp_thresh
+                    if not self.use_difficult and gts.shape[1] >= 6:
+                        found = np.logical_and(found, np.logical_not(gts[:, 5] > 0))
+                    records = found.astype(np.float32)
 
                 # ground truth count
                 if (not self.use_difficult and gts.shape[1] >= 6):
@@ -420,9 +380,7 @@ class RecallMetric(mx.metric.EvalMetric):
                     gt_count = gts.shape[0]
 
                 # now we push records to buffer
-                # first column: score, second column: tp/fp
-                # 0: not set(matched to difficult or something), 1: tp, 2: fp
-                # records = records[np.where(records[:, -1] > 0)[0], :]
+                # 1: found, 0: not found or difficult
                 if records.size > 0:
                     self._insert(cid, records, gt_count)
 
@@ -430,7 +388,7 @@ class RecallMetric(mx.metric.EvalMetric):
         """ update num_inst and sum_metric """
         recalls = []
         for k, v in self.records.items():
-            recall = np.sum(v) / self.counts[k]
+            recall = np.sum(v.data) / self.counts[k]
             self.sum_metric[k] = recall
             self.num_inst[k] = 1
 
@@ -447,9 +405,93 @@ class RecallMetric(mx.metric.EvalMetric):
         """ Insert records according to key """
         if key not in self.records:
             assert key not in self.counts
-            self.records[key] = records
-            self.counts[key] = count
-        else:
-            self.records[key] = np.hstack((self.records[key], records))
-            assert key in self.counts
-            self.counts[key] += count
+            self.records[key] = _RecordBuffer((), np.float32)
+            self.counts[key] = 0
+        self.records[key].append(records)
+        self.counts[key] += count
+
+
+class _RecordBuffer(object):
+    """
+    Growable buffer of records, rows are appended in amortized O(1)
+    instead of stacking all the records at each insert.
+    """
+    def __init__(self, row_shape, dtype, capacity=256):
+        self._buf = np.zeros((capacity,) + tuple(row_shape), dtype=dtype)
+        self.size = 0
+
+    def append(self, rows):
+        n = rows.shape[0]
+        if self.size + n > self._buf.shape[0]:
+            capacity = max(self._buf.shape[0] * 2, self.size + n)
+            buf = np.zeros((capacity,) + self._buf.shape[1:], dtype=self._buf.dtype)
+            buf[:self.size] = self._buf[:self.size]
+            self._buf = buf
+        self._buf[self.size:self.size+n] = rows
+        self.size += n
+
+    def merge(self, other):
+        self.append(other.data)
+
+    @property
+    def data(self):
+        """ records as a numpy array, a view of the buffer """
+        return self._buf[:self.size]
+
+
+class _ScoreHistogram(object):
+    """
+    Counts of tp and fp records in num_bins uniform score bins over [0, 1],
+    scores out of the range are clipped to the first or last bin.
+    """
+    def __init__(self, num_bins):
+        self.tp = np.zeros((num_bins,), dtype=np.int64)
+        self.fp = np.zeros((num_bins,), dtype=np.int64)
+
+    def append(self, rows):
+        """ rows of (score, tp/fp), 1: tp, 2: fp, other rows are ignored """
+        num_bins = self.tp.size
+        bins = np.clip((rows[:, 0] * num_bins).astype(int), 0, num_bins - 1)
+        flags = rows[:, 1].astype(int)
+        self.tp += np.bincount(bins[flags == 1], minlength=num_bins)
+        self.fp += np.bincount(bins[flags == 2], minlength=num_bins)
+
+    def merge(self, other):
+        assert other.tp.size == self.tp.size
+        self.tp += other.tp
+        self.fp += other.fp
+
+
+def _unique_in_order(values):
+    """ unique values, in the order of their first appearance """
+    uniq, first = np.unique(values, return_index=True)
+    return uniq[np.argsort(first)]
+
+
+def _iou_matrix(xs, ys):
+    """
+    Calculate intersection-over-union overlap
+    Params:
+    ----------
+    xs : numpy.array
+        multiple box [[xmin, ymin, xmax, ymax], [...], ]
+    ys : numpy.array
+        multiple box [[xmin, ymin, xmax, ymax], [...], ]
+    Returns:
+    -----------
+    numpy.array
+        (xs.shape[0], ys.shape[0]) ious
+    """
+    ixmin = np.maximum(ys[np.newaxis, :, 0], xs[:, np.newaxis, 0])
+    iymin = np.maximum(ys[np.newaxis, :, 1], xs[:, np.newaxis, 1])
+    ixmax = np.minimum(ys[np.newaxis, :, 2], xs[:, np.newaxis, 2])
+    iymax = np.minimum(ys[np.newaxis, :, 3], xs[:, np.newaxis, 3])
+    iw = np.maximum(ixmax - ixmin, 0.)
+    ih = np.maximum(iymax - iymin, 0.)
+    inters = iw * ih
+    uni = ((xs[:, 2] - xs[:, 0]) * (xs[:, 3] - xs[:, 1]))[:, np.newaxis] + \
+        ((ys[:, 2] - ys[:, 0]) * (ys[:, 3] - ys[:, 1]))[np.newaxis, :] - inters
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ious = inters / uni
+    ious[uni < 1e-12] = 0  # in case bad boxes
+    return ious
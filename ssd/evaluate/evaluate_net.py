@@ -14,7 +14,7 @@ def evaluate_net(net, path_imgrec, num_classes, mean_pixels, data_shape,
                  model_prefix, epoch, ctx=mx.cpu(), batch_size=1,
                  path_imglist="", nms_thresh=0.45, force_nms=False,
                  ovp_thresh=0.5, use_difficult=False, class_names=None,
-                 voc07_metric=False):
+                 voc07_metric=False, num_bins=None):
     """
     evalute network given validation record file
 
@@ -52,6 +52,8 @@ def evaluate_net(net, path_imgrec, num_classes, mean_pixels, data_shape,
         class names in string, must correspond to num_classes if set
     voc07_metric : boolean
         whether to use 11-point evluation as in VOC07 competition
+    num_bins : int or None
+        score histogram bins of streaming mAP, None to keep all records, see MApMetric
     """
     # set up logger
     logging.basicConfig()
@@ -87,9 +89,9 @@ def evaluate_net(net, path_imgrec, num_classes, mean_pixels, data_shape,
 
     # run evaluation
     if voc07_metric:
-        metric = VOC07MApMetric(ovp_thresh, use_difficult, class_names)
+        metric = VOC07MApMetric(ovp_thresh, use_difficult, class_names, num_bins=num_bins)
     else:
-        metric = MApMetric(ovp_thresh, use_difficult, class_names)
+        metric = MApMetric(ovp_thresh, use_difficult, class_names, num_bins=num_bins)
 
     for i, datum in enumerate(eval_iter):
         # mod.reshape(data_shapes=datum.provide_data, label_shapes=datum.provide_label)
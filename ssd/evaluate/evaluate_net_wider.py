@@ -1,13 +1,12 @@
 from __future__ import print_function
-import os
-import sys
-import importlib
+import multiprocessing as mp
+import cPickle
 import mxnet as mx
 import numpy as np
 from collections import OrderedDict
 from dataset.face_test_iter import FaceTestIter
-from config.config import cfg
 from evaluate.eval_metric import MApMetric, VOC07MApMetric
+from detect.bucket_module import BucketedModule
 import logging
 from symbol.symbol_factory import get_symbol
 from tools.do_nms import do_nms
@@ -16,7 +15,8 @@ def evaluate_net(net, imdb, mean_pixels, data_shape,
                  model_prefix, epoch, ctx=mx.cpu(), batch_size=1,
                  nms_thresh=0.45, force_nms=False,
                  ovp_thresh=0.5, use_difficult=False,
-                 voc07_metric=False):
+                 voc07_metric=False, num_bins=None,
+                 num_shards=1, results_file=None, buckets=None):
     """
     evalute network given validation record file
 
@@ -24,12 +24,8 @@ def evaluate_net(net, imdb, mean_pixels, data_shape,
     ----------
     net : str or None
         Network name or use None to load from json without modifying
-    path_imgrec : str
-        path to the record validation file
-    path_imglist : str
-        path to the list file to replace labels in record file, optional
-    num_classes : int
-        number of classes, not including background
+    imdb : Imdb
+        image database to evaluate
     mean_pixels : tuple
         (mean_r, mean_g, mean_b)
     data_shape : tuple or int
@@ -38,10 +34,10 @@ def evaluate_net(net, imdb, mean_pixels, data_shape,
         model prefix of saved checkpoint
     epoch : int
         load model epoch
-    ctx : mx.ctx
-        mx.gpu() or mx.cpu()
+    ctx : mx.ctx or list of mx.ctx
+        mx.gpu() or mx.cpu(), shards are assigned to contexts in turn
     batch_size : int
-        validation batch size
+        number of images per forward
     nms_thresh : float
         non-maximum suppression threshold
     force_nms : boolean
@@ -50,27 +46,146 @@ def evaluate_net(net, imdb, mean_pixels, data_shape,
         AP overlap threshold for true/false postives
     use_difficult : boolean
         whether to use difficult objects in evaluation if applicable
-    class_names : comma separated str
-        class names in string, must correspond to num_classes if set
     voc07_metric : boolean
         whether to use 11-point evluation as in VOC07 competition
+    num_bins : int or None
+        score histogram bins of streaming mAP, None to keep all records, see MApMetric
+    num_shards : int
+        number of worker processes, each one evaluates every num_shards-th image
+        with its own module, and the metrics are merged at the end
+    results_file : str or None
+        if set, per-image detections are saved to this file,
+        AP can be recomputed from it with evaluate_results()
+    buckets : list of int or None
+        if set, input sizes are padded to these bucket sizes, and bound modules
+        are reused for each bucket instead of reshaping for every image
     """
     # set up logger
     logging.basicConfig()
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
 
-    num_classes = imdb.num_classes
-    class_names = imdb.classes
-
     # args
     if isinstance(data_shape, int):
         data_shape = (3, data_shape, data_shape)
     assert len(data_shape) == 3 and data_shape[0] == 3
     model_prefix += '_' + str(data_shape[1])
 
+    metric = _create_metric(imdb, ovp_thresh, use_difficult, voc07_metric, num_bins)
+    num_shards = max(1, min(num_shards, imdb.num_images))
+    ctxs = ctx if isinstance(ctx, (list, tuple)) else [ctx]
+    shard_args = (net, imdb, mean_pixels, data_shape, model_prefix, epoch, nms_thresh, force_nms,
+                  buckets, batch_size)
+
+    if num_shards == 1:
+        detections = _evaluate_shard(metric, np.arange(imdb.num_images), ctx, logger, *shard_args)
+    else:
+        # workers are forked before this process runs any mxnet operation
+        queue = mp.Queue()
+        workers = []
+        for s in range(num_shards):
+            shard_ctx = ctxs[s % len(ctxs)]
+            shard_metric = _create_metric(imdb, ovp_thresh, use_difficult, voc07_metric, num_bins)
+            indices = np.arange(s, imdb.num_images, num_shards)
+            w = mp.Process(target=_shard_worker,
+                    args=(queue, s, shard_metric, indices, shard_ctx) + shard_args)
+            w.daemon = True
+            w.start()
+            workers.append(w)
+        shard_results = {}
+        for _ in range(num_shards):
+            s, shard_metric, shard_dets = queue.get()
+            if shard_metric is None:
+                raise RuntimeError('evaluation shard {} failed:\n{}'.format(s, shard_dets))
+            shard_results[s] = (shard_metric, shard_dets)
+        for w in workers:
+            w.join()
+        # merge in shard order, so results do not depend on which shard finished first
+        detections = OrderedDict()
+        for s in range(num_shards):
+            metric.merge(shard_results[s][0])
+            detections.update(shard_results[s][1])
+
+    if results_file:
+        _save_results(results_file, imdb, detections)
+        print('detections saved to {}'.format(results_file))
+
+    results = metric.get_name_value()
+    for k, v in results:
+        print("{}: {}".format(k, v))
+    return results
+
+
+def evaluate_results(results_file, imdb, ovp_thresh=0.5, use_difficult=False,
+                     voc07_metric=False, num_bins=None):
+    """
+    recompute AP from detections saved by evaluate_net, without running the network
+
+    Parameters:
+    ----------
+    results_file : str
+        results file written by evaluate_net
+    imdb : Imdb
+        image database the results are evaluated on
+    others : see evaluate_net
+    """
+    with open(results_file, 'rb') as fh:
+        saved = cPickle.load(fh)
+    assert len(saved['im_paths']) == imdb.num_images, \
+        'results file has {} images, imdb has {}'.format(len(saved['im_paths']), imdb.num_images)
+
+    metric = _create_metric(imdb, ovp_thresh, use_difficult, voc07_metric, num_bins)
+    for index, (dets, im_shape) in enumerate(zip(saved['detections'], saved['im_shapes'])):
+        label = _scaled_label(imdb, index, im_shape)
+        if dets.shape[0] == 0:
+            dets = np.full((1, 6), -1, dtype=np.float32)
+        metric.update([mx.nd.array(label[np.newaxis])], [mx.nd.array(dets[np.newaxis])])
+
+    results = metric.get_name_value()
+    for k, v in results:
+        print("{}: {}".format(k, v))
+    return results
+
+
+def _create_metric(imdb, ovp_thresh, use_difficult, voc07_metric, num_bins):
+    if voc07_metric:
+        return VOC07MApMetric(ovp_thresh, use_difficult, imdb.classes, num_bins=num_bins)
+    return MApMetric(ovp_thresh, use_difficult, imdb.classes, num_bins=num_bins)
+
+
+def _scaled_label(imdb, index, im_shape):
+    """ padded label of an image in pixels, as used by the metric """
+    sy, sx = im_shape[:2]
+    label = imdb.padded_label_from_index(index)
+    label[:, 1:5] *= np.array((sx, sy, sx, sy), dtype=np.float32)
+    return label
+
+
+def _shard_worker(queue, shard_id, metric, indices, ctx, *shard_args):
+    """ evaluate a shard in a worker process, and send its metric and detections back """
+    try:
+        logger = logging.getLogger()
+        detections = _evaluate_shard(metric, indices, ctx, logger, *shard_args)
+        queue.put((shard_id, metric, detections))
+    except Exception:
+        import traceback
+        queue.put((shard_id, None, traceback.format_exc()))
+
+
+def _evaluate_shard(metric, indices, ctx, logger, net, imdb, mean_pixels, data_shape,
+                    model_prefix, epoch, nms_thresh, force_nms, buckets, batch_size):
+    """
+    run forward and nms on images of indices, update metric
+
+    Returns:
+    ----------
+    OrderedDict of image index: (detections after nms in pixels (n, 6), im_shape)
+    """
+    num_classes = imdb.num_classes
+
     # iterator
-    eval_iter = FaceTestIter(imdb, mean_pixels, img_stride=128, fix_hw=True)
+    eval_iter = FaceTestIter(imdb, mean_pixels, img_stride=128, fix_hw=True, indices=indices,
+        batch_size=batch_size)
     # model params
     load_net, args, auxs = mx.model.load_checkpoint(model_prefix, epoch)
     # network
@@ -84,58 +199,51 @@ def evaluate_net(net, imdb, mean_pixels, data_shape,
         net = mx.sym.Group([net, label])
 
     # init module
-    mod = mx.mod.Module(net, label_names=('label',), logger=logger, context=ctx,
-        fixed_param_names=net.list_arguments())
-    mod.bind(data_shapes=eval_iter.provide_data, label_shapes=eval_iter.provide_label)
-    mod.set_params(args, auxs, allow_missing=False, force_init=True)
-
-    # run evaluation
-    if voc07_metric:
-        metric = VOC07MApMetric(ovp_thresh, use_difficult, class_names)
+    if buckets:
+        mod = BucketedModule(net, buckets, context=ctx, label_names=('label',),
+            img_stride=128, logger=logger)
+        mod.bind(batch_size, label_shapes=eval_iter.provide_label)
     else:
-        metric = MApMetric(ovp_thresh, use_difficult, class_names)
+        mod = mx.mod.Module(net, label_names=('label',), logger=logger, context=ctx,
+            fixed_param_names=net.list_arguments())
+        mod.bind(data_shapes=eval_iter.provide_data, label_shapes=eval_iter.provide_label)
+    mod.set_params(args, auxs, allow_missing=False, force_init=True)
 
-    results = []
+    detections = OrderedDict()
     for i, (datum, im_info) in enumerate(eval_iter):
-        mod.reshape(data_shapes=datum.provide_data, label_shapes=datum.provide_label)
+        if not buckets:
+            mod.reshape(data_shapes=datum.provide_data, label_shapes=datum.provide_label)
         mod.forward(datum)
 
         preds = mod.get_outputs()
+        dets = preds[0].asnumpy() # (batch_size, n_anchor, 6)
 
-        det0 = preds[0][0].asnumpy() # (n_anchor, 6)
-        det0 = do_nms(det0, 1, nms_thresh)
-        preds[0][0] = mx.nd.array(det0, ctx=preds[0].context)
-
-        sy, sx, _ = im_info['im_shape']
-        scaler = mx.nd.array((1.0, sx, sy, sx, sy, 1.0))
-        scaler = mx.nd.reshape(scaler, (1, 1, -1))
-
-        datum.label[0] *= scaler
-        metric.update(datum.label, preds)
+        for j, index in enumerate(im_info['index']):
+            det0 = do_nms(dets[j], 1, nms_thresh)
+            label = _scaled_label(imdb, index, im_info['im_shape'][j])
+            metric.update([mx.nd.array(label[np.newaxis])], [mx.nd.array(det0[np.newaxis])])
+            detections[index] = (det0[det0[:, 0] >= 0], im_info['im_shape'][j])
 
         if i % 10 == 0:
-            print('processed {} images.'.format(i))
+            print('processed {} batches.'.format(i))
         # if i == 10:
         #     break
+    if buckets:
+        logger.info('bucket cache: {}'.format(mod.stats()))
+    return detections
 
-    results = metric.get_name_value()
-    for k, v in results:
-        print("{}: {}".format(k, v))
 
+def _save_results(results_file, imdb, detections):
+    """
+    save detections of all images in imdb order, (n, 6) arrays of
+    [cls_id, score, xmin, ymin, xmax, ymax] in pixels of the original image
+    """
+    saved = {'im_paths': [], 'im_shapes': [], 'detections': []}
+    for index in range(imdb.num_images):
+        dets, im_shape = detections[index]
+        saved['im_paths'].append(imdb.image_path_from_index(index))
+        saved['im_shapes'].append(im_shape)
+        saved['detections'].append(dets)
+    with open(results_file, 'wb') as fh:
+        cPickle.dump(saved, fh, cPickle.HIGHEST_PROTOCOL)
 
-def _do_nms(dets, th_nms):
-    #
-    areas = (dets[:, 4] - dets[:, 2]) * (dets[:, 5] - dets[:, 3])
-    vmask = np.ones((dets.shape[0],), dtype=int)
-    vidx = []
-    for i, d in enumerate(dets):
-        if vmask[i] == 0:
-            continue
-        iw = np.minimum(d[4], dets[i:, 4]) - np.maximum(d[2], dets[i:, 2])
-        ih = np.minimum(d[5], dets[i:, 5]) - np.maximum(d[3], dets[i:, 3])
-        I = np.maximum(iw, 0) * np.maximum(ih, 0)
-        iou = I / np.maximum(areas[i:] + areas[i] - I, 1e-08)
-        nidx = np.where(iou > th_nms)[0] + i
-        vmask[nidx] = 0
-        vidx.append(i)
-    return vidx
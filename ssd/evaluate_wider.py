@@ -3,7 +3,7 @@ import tools.find_mxnet
 import mxnet as mx
 import os
 import sys
-from evaluate.evaluate_net_wider import evaluate_net
+from evaluate.evaluate_net_wider import evaluate_net, evaluate_results
 from dataset.dataset_loader import load_pascal, load_wider #, load_pascal_patch
 
 def parse_args():
@@ -42,6 +42,18 @@ def parse_args():
                         help='use difficult ground-truths in evaluation')
     parser.add_argument('--voc07', dest='use_voc07_metric', type=bool, default=True,
                         help='use PASCAL VOC 07 metric')
+    parser.add_argument('--num-bins', dest='num_bins', type=int, default=0,
+                        help='streaming mAP with this many score bins per class, 0 for exact mAP')
+    parser.add_argument('--num-shards', dest='num_shards', type=int, default=1,
+                        help='number of evaluation worker processes')
+    parser.add_argument('--results-file', dest='results_file', type=str, default='',
+                        help='save per-image detections to this file')
+    parser.add_argument('--from-results', dest='from_results', type=str, default='',
+                        help='recompute AP from a saved results file, without running the network')
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=1,
+                        help='number of images per forward')
+    parser.add_argument('--buckets', dest='buckets', type=str, default='',
+                        help='comma separated input size buckets, e.g. 384,512,768,1024,1536,2048')
     args = parser.parse_args()
     return args
 
@@ -58,6 +70,11 @@ if __name__ == '__main__':
     assert args.dataset == 'wider'
 
     imdb = load_wider(args.image_set, args.devkit_path, False)
+    if args.from_results:
+        evaluate_results(args.from_results, imdb, ovp_thresh=args.overlap_thresh,
+                         use_difficult=args.use_difficult,
+                         voc07_metric=args.use_voc07_metric, num_bins=args.num_bins)
+        sys.exit(0)
 
     network = args.network
     if args.prefix.endswith('_'):
@@ -66,8 +83,10 @@ if __name__ == '__main__':
         prefix = args.prefix
     evaluate_net(network, imdb,
                  (args.mean_r, args.mean_g, args.mean_b), args.data_shape,
-                 prefix, args.epoch, ctx,
+                 prefix, args.epoch, ctx, batch_size=args.batch_size,
                  nms_thresh=args.nms_thresh,
                  force_nms=args.force_nms, ovp_thresh=args.overlap_thresh,
                  use_difficult=args.use_difficult,
-                 voc07_metric=args.use_voc07_metric)
+                 voc07_metric=args.use_voc07_metric, num_bins=args.num_bins,
+                 num_shards=args.num_shards, results_file=args.results_file,
+                 buckets=[int(b) for b in args.buckets.split(',') if b.strip()])
@@ -0,0 +1,119 @@
+import numpy as np
+
+
+class AnchorIndex(object):
+    '''
+    Grid index over fixed anchor boxes, for sparse IoU computation.
+
+    Anchors are grouped into size bands (by log2 of sqrt(area)), and each band
+    is bucketed into a uniform grid over anchor centers.
+    A query returns every anchor that can overlap the query box, so IoUs of the
+    anchors not returned are exactly 0.
+    With th_area > 0, bands whose anchors can not reach IoU >= th_area
+    (IoU <= min(area) / max(area)) are also skipped.
+    '''
+    def __init__(self, anchors, n_band_per_octave=2):
+        '''
+        anchors: (n_anchor, 4) array of (x0, y0, x1, y1)
+        '''
+        anchors = np.reshape(anchors, (-1, 4)).astype(np.float64)
+        self.n_anchors = anchors.shape[0]
+
+        cx = (anchors[:, 0] + anchors[:, 2]) * 0.5
+        cy = (anchors[:, 1] + anchors[:, 3]) * 0.5
+        hw = (anchors[:, 2] - anchors[:, 0]) * 0.5
+        hh = (anchors[:, 3] - anchors[:, 1]) * 0.5
+        area = np.maximum(hw * hh * 4.0, np.finfo(np.float32).tiny)
+
+        bids = np.floor(np.log2(area) * 0.5 * n_band_per_octave).astype(int)
+        self.bands = []
+        for b in np.unique(bids):
+            idx = np.where(bids == b)[0]
+            self.bands.append(_AnchorBand(idx, cx[idx], cy[idx], hw[idx], hh[idx], area[idx]))
+
+    def query(self, box, th_area=0.0, scale=1.0):
+        '''
+        Candidate anchors for a box, as a sorted index array.
+
+        box: (x0, y0, x1, y1)
+        th_area: skip anchors with area ratio to the box smaller than this.
+        scale: anchors are scaled by this factor around their centers before the test.
+        '''
+        qcx = (float(box[0]) + float(box[2])) * 0.5
+        qcy = (float(box[1]) + float(box[3])) * 0.5
+        qhw = abs(float(box[2]) - float(box[0])) * 0.5
+        qhh = abs(float(box[3]) - float(box[1])) * 0.5
+        qarea = qhw * qhh * 4.0
+        # margin for rounding errors of float32 boxes
+        th_area *= (1.0 - 1e-04)
+        scale2 = scale * scale
+
+        cands = []
+        for band in self.bands:
+            if th_area > 0:
+                if band.area_max * scale2 < th_area * qarea or \
+                        band.area_min * scale2 * th_area > qarea:
+                    continue
+            cands.append(band.query(qcx, qcy, qhw, qhh, scale))
+        if not cands:
+            return np.zeros((0,), dtype=int)
+        return np.sort(np.concatenate(cands))
+
+    def query_pairs(self, boxes, th_area=0.0):
+        '''
+        Candidates for many boxes.
+        Returns (box index, anchor index) pairs, as two flat arrays.
+        '''
+        rows = []
+        cols = []
+        for i, box in enumerate(boxes):
+            cand = self.query(box, th_area)
+            rows.append(np.full(cand.shape, i, dtype=int))
+            cols.append(cand)
+        if not cols:
+            return np.zeros((0,), dtype=int), np.zeros((0,), dtype=int)
+        return np.concatenate(rows), np.concatenate(cols)
+
+
+class _AnchorBand(object):
+    '''
+    Anchors of similar sizes, bucketed in a grid of their centers.
+    Cell id is iy * nx + ix, and anchors are sorted by cell id,
+    so cells in a grid row are contiguous.
+    '''
+    def __init__(self, idx, cx, cy, hw, hh, area):
+        self.hw_max = np.max(hw)
+        self.hh_max = np.max(hh)
+        self.area_min = np.min(area)
+        self.area_max = np.max(area)
+
+        self.ox = np.min(cx)
+        self.oy = np.min(cy)
+        # at most 1024 cells per axis, for degenerate anchors
+        span = max(np.max(cx) - self.ox, np.max(cy) - self.oy)
+        self.cell = max(2.0 * max(self.hw_max, self.hh_max), span / 1024.0, 1e-06)
+        ix = np.floor((cx - self.ox) / self.cell).astype(int)
+        iy = np.floor((cy - self.oy) / self.cell).astype(int)
+        self.nx = np.max(ix) + 1
+        self.ny = np.max(iy) + 1
+
+        cids = iy * self.nx + ix
+        order = np.argsort(cids, kind='mergesort')
+        self.idx = idx[order]
+        self.starts = np.searchsorted(cids[order], np.arange(self.nx * self.ny + 1))
+
+    def query(self, qcx, qcy, qhw, qhh, scale):
+        # anchors overlap the query iff |dcx| < qhw + hw and |dcy| < qhh + hh
+        rx = (qhw + self.hw_max * scale) * (1.0 + 1e-04) + 1e-08
+        ry = (qhh + self.hh_max * scale) * (1.0 + 1e-04) + 1e-08
+        ix0 = max(int(np.floor((qcx - rx - self.ox) / self.cell)), 0)
+        ix1 = min(int(np.floor((qcx + rx - self.ox) / self.cell)), self.nx - 1)
+        iy0 = max(int(np.floor((qcy - ry - self.oy) / self.cell)), 0)
+        iy1 = min(int(np.floor((qcy + ry - self.oy) / self.cell)), self.ny - 1)
+        if ix0 > ix1 or iy0 > iy1:
+            return np.zeros((0,), dtype=int)
+        cands = []
+        for iy in range(iy0, iy1 + 1):
+            c0 = iy * self.nx
+            cands.append(self.idx[self.starts[c0 + ix0]:self.starts[c0 + ix1 + 1]])
+        return np.concatenate(cands)
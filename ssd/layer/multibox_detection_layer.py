@@ -1,6 +1,9 @@
 import os
+import sys
 import mxnet as mx
 import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from nms import nms
 # MXNET_CPU_WORKER_NTHREADS must be greater than 1 for custom op to work on CPU
 os.environ["MXNET_CPU_WORKER_NTHREADS"] = "4"
 from ast import literal_eval as make_tuple
@@ -11,7 +14,7 @@ class MultiBoxDetection(mx.operator.CustomOp):
     python implementation of MultiBoxDetection layer.
     '''
 
-    def __init__(self, max_detection, th_pos, th_nms, per_cls_reg, variances):
+    def __init__(self, max_detection, th_pos, th_nms, per_cls_reg, variances, decode_mode='legacy'):
         #
         super(MultiBoxDetection, self).__init__()
         self.th_pos = th_pos
@@ -19,11 +22,16 @@ class MultiBoxDetection(mx.operator.CustomOp):
         self.per_cls_reg = per_cls_reg
         self.variances = variances
         self.max_detection = max_detection
+        self.decode_mode = decode_mode
 
     def forward(self, is_train, req, in_data, out_data, aux):
         '''
         pick positives, transform bbs, apply nms
         '''
+        if self.decode_mode == 'batch':
+            self.assign(out_data[0], req[0], self._forward_batch(in_data))
+            return
+
         n_batch, n_class, n_anchor = in_data[0].shape
 
         probs_cls = in_data[0]
@@ -61,26 +69,121 @@ class MultiBoxDetection(mx.operator.CustomOp):
     def backward(self, req, out_grad, in_data, out_data, in_grad, aux):
         pass
 
+    def _forward_batch(self, in_data):
+        '''
+        Decode all anchors of all images at once, keep top max_detection positives
+        and apply class-wise nms, without copying anything to the host.
+
+        Output rows are sorted by score, and discarded rows are filled with -1.
+        '''
+        n_batch, n_class, n_anchor = in_data[0].shape
+
+        probs_cls = in_data[0]
+        if n_class == 1:
+            scores = mx.nd.reshape(probs_cls, (n_batch, n_anchor))
+            cids = mx.nd.zeros_like(scores)
+        else:
+            scores = mx.nd.max(probs_cls, axis=1)
+            cids = mx.nd.argmax(probs_cls, axis=1)
+
+        if self.per_cls_reg:
+            # (n_batch, n_anchor, n_class+1, 4), with background regression at 0
+            preds_reg = mx.nd.reshape(in_data[1], (n_batch, n_anchor, -1, 4))
+            preds_reg = mx.nd.transpose(preds_reg, (0, 1, 3, 2))
+            ridx = mx.nd.broadcast_to(mx.nd.reshape(cids + 1, (n_batch, n_anchor, 1)), \
+                    (n_batch, n_anchor, 4))
+            preds_reg = mx.nd.pick(preds_reg, ridx, axis=3)
+        else:
+            preds_reg = mx.nd.reshape(in_data[1], (n_batch, n_anchor, 4))
+        anchors = mx.nd.reshape(in_data[2], (1, n_anchor, 4))
+        boxes = _transform_roi_batch(preds_reg, anchors, self.variances, 1.0)
+
+        pmask = scores > self.th_pos
+        cids = pmask * (cids + 1) - 1
+        dets = mx.nd.concat(mx.nd.expand_dims(cids, axis=2), mx.nd.expand_dims(scores, axis=2), \
+                boxes, dim=2)  # (n_batch, n_anchor, 6)
+
+        topk = min(self.max_detection, n_anchor) if self.max_detection > 0 else n_anchor
+        if hasattr(mx.nd.contrib, 'box_nms'):
+            return mx.nd.contrib.box_nms(dets, overlap_thresh=self.th_nms, valid_thresh=self.th_pos, \
+                    topk=topk, coord_start=2, score_index=1, id_index=0, force_suppress=False)
+        return _nms_batch(dets, scores * pmask, topk, self.th_nms)
+
 
 def _nms(out_t, th_nms):
-    ''' GPU nms '''
-    n_detection = out_t.shape[1]
-    nms_mask = np.zeros((n_detection,), dtype=np.bool)
-    out = mx.nd.transpose(out_t)
-    area_out_t = (out_t[2] - out_t[0]) * (out_t[3] - out_t[1])
-    for i in range(n_detection-1):
-        if nms_mask[i]:
-            continue
-        iw = mx.nd.minimum(out_t[2][i], out_t[2]) - \
-                mx.nd.maximum(out_t[0][i], out_t[0])
-        ih = mx.nd.minimum(out_t[3][i], out_t[3]) - \
-                mx.nd.maximum(out_t[1][i], out_t[1])
-        I = mx.nd.maximum(iw, 0) * mx.nd.maximum(ih, 0)
-        iou_mask = (I / mx.nd.maximum(area_out_t + area_out_t[i] - I, 1e-06)) > th_nms
-        nidx = np.where(iou_mask.asnumpy())[0]
-        nms_mask[nidx] = True
-        nms_mask[i] = False
-    return np.where(nms_mask == False)[0]
+    ''' nms of (4, n_detection) boxes, in the given order '''
+    return nms(np.transpose(out_t[:4].asnumpy()), None, th_nms)
+
+
+def _nms_batch(dets, scores, topk, th_nms):
+    '''
+    Greedy class-wise nms for all images at once, for mxnet without contrib.box_nms.
+    dets: (n_batch, n_anchor, 6), scores: (n_batch, n_anchor), 0 for negatives.
+    Same output layout as box_nms.
+    '''
+    n_batch, n_anchor, _ = dets.shape
+    # gather top-k detections of each image
+    sidx = mx.nd.topk(scores, axis=1, k=topk, ret_typ='indices')  # (n_batch, topk)
+    offset = mx.nd.reshape(mx.nd.arange(0, n_batch, ctx=dets.context) * n_anchor, (n_batch, 1))
+    sidx = mx.nd.broadcast_add(sidx, offset)
+    top = mx.nd.take(mx.nd.reshape(dets, (-1, 6)), mx.nd.reshape(sidx, (-1,)))
+    top = mx.nd.reshape(top, (n_batch, topk, 6))
+
+    cids = mx.nd.slice_axis(top, axis=2, begin=0, end=1)  # (n_batch, topk, 1)
+    box_t = mx.nd.transpose(mx.nd.slice_axis(top, axis=2, begin=2, end=6), (2, 0, 1))
+    bb_i = [mx.nd.expand_dims(box_t[i], axis=2) for i in range(4)]  # (n_batch, topk, 1)
+    bb_j = [mx.nd.expand_dims(box_t[i], axis=1) for i in range(4)]  # (n_batch, 1, topk)
+    iw = mx.nd.broadcast_minimum(bb_i[2], bb_j[2]) - mx.nd.broadcast_maximum(bb_i[0], bb_j[0])
+    ih = mx.nd.broadcast_minimum(bb_i[3], bb_j[3]) - mx.nd.broadcast_maximum(bb_i[1], bb_j[1])
+    I = mx.nd.maximum(iw, 0) * mx.nd.maximum(ih, 0)
+    area = (box_t[2] - box_t[0]) * (box_t[3] - box_t[1])
+    U = mx.nd.broadcast_add(mx.nd.expand_dims(area, axis=2), mx.nd.expand_dims(area, axis=1)) - I
+    iou = I / mx.nd.maximum(U, 1e-08)
+
+    # sup[b, i, j]: i suppresses j, if j comes after i and has the same class
+    same_cls = mx.nd.broadcast_equal(cids, mx.nd.transpose(cids, (0, 2, 1)))
+    order = mx.nd.arange(0, topk, ctx=dets.context)
+    later = mx.nd.broadcast_greater(mx.nd.reshape(order, (1, -1)), mx.nd.reshape(order, (-1, 1)))
+    sup = mx.nd.broadcast_mul((iou > th_nms) * same_cls, mx.nd.expand_dims(later, axis=0))
+
+    keep = cids >= 0  # (n_batch, topk, 1)
+    keep = mx.nd.reshape(keep, (n_batch, topk))
+    for i in range(topk):
+        ki = mx.nd.slice_axis(keep, axis=1, begin=i, end=i+1)
+        si = mx.nd.reshape(mx.nd.slice_axis(sup, axis=1, begin=i, end=i+1), (n_batch, topk))
+        keep = keep * (1 - mx.nd.broadcast_mul(si, ki))
+
+    # kept detections first, in score order, as box_nms does
+    kidx = mx.nd.topk(mx.nd.broadcast_sub(keep * 2, mx.nd.reshape(order, (1, -1)) / float(topk)), \
+            axis=1, k=topk, ret_typ='indices')
+    offset = mx.nd.reshape(mx.nd.arange(0, n_batch, ctx=dets.context) * topk, (n_batch, 1))
+    kidx = mx.nd.reshape(mx.nd.broadcast_add(kidx, offset), (-1,))
+    keep = mx.nd.reshape(mx.nd.take(mx.nd.reshape(keep, (-1,)), kidx), (n_batch, topk, 1))
+    top = mx.nd.reshape(mx.nd.take(mx.nd.reshape(top, (-1, 6)), kidx), (n_batch, topk, 6))
+    top = mx.nd.broadcast_add(mx.nd.broadcast_mul(top, keep), keep - 1)
+
+    if topk == n_anchor:
+        return top
+    return mx.nd.concat(top, mx.nd.full((n_batch, n_anchor - topk, 6), -1, ctx=dets.context), dim=1)
+
+
+def _transform_roi_batch(reg, anc, variances, ratio=1.0):
+    '''
+    reg: (n_batch, n_anchor, 4), anc: (1, n_anchor, 4)
+    returns decoded boxes of all anchors, (n_batch, n_anchor, 4)
+    '''
+    reg_t = [mx.nd.slice_axis(reg, axis=2, begin=i, end=i+1) * float(variances[i]) for i in range(4)]
+    anc_t = [mx.nd.slice_axis(anc, axis=2, begin=i, end=i+1) for i in range(4)]
+
+    cx = (anc_t[0] + anc_t[2]) * 0.5
+    cy = (anc_t[1] + anc_t[3]) * 0.5
+    aw = (anc_t[2] - anc_t[0]) * ratio
+    ah = anc_t[3] - anc_t[1]
+    cx = mx.nd.broadcast_add(cx, mx.nd.broadcast_mul(reg_t[0], aw))
+    cy = mx.nd.broadcast_add(cy, mx.nd.broadcast_mul(reg_t[1], ah))
+    w = mx.nd.broadcast_mul(mx.nd.exp(reg_t[2]), aw) * 0.5
+    h = mx.nd.broadcast_mul(mx.nd.exp(reg_t[3]), ah) * 0.5
+    return mx.nd.concat(cx - w, cy - h, cx + w, cy + h, dim=2)
 
 
 def _transform_roi(reg, anc, iidx, variances, ratio=1.0):
@@ -143,7 +246,8 @@ class MultiBoxDetectionProp(mx.operator.CustomOpProp):
                  th_pos=0.5,
                  th_nms=0.35,
                  per_cls_reg=False,
-                 variances=(0.1, 0.1, 0.2, 0.2)):
+                 variances=(0.1, 0.1, 0.2, 0.2),
+                 decode_mode='legacy'):
         #
         super(MultiBoxDetectionProp, self).__init__(need_top_grad=False)
         self.max_detection = int(max_detection)
@@ -153,6 +257,9 @@ class MultiBoxDetectionProp(mx.operator.CustomOpProp):
         if isinstance(variances, str):
             variances = make_tuple(variances)
         self.variances = np.array(variances)
+        assert decode_mode in ('legacy', 'batch'), \
+                'decode_mode should be legacy or batch, got {}'.format(decode_mode)
+        self.decode_mode = decode_mode
 
     def list_arguments(self):
         return ['probs_cls', 'preds_reg', 'anchors']
@@ -167,4 +274,4 @@ class MultiBoxDetectionProp(mx.operator.CustomOpProp):
 
     def create_operator(self, ctx, shapes, dtypes):
         return MultiBoxDetection(self.max_detection, self.th_pos,
-                                 self.th_nms, self.per_cls_reg, self.variances)
+                                 self.th_nms, self.per_cls_reg, self.variances, self.decode_mode)
@@ -6,13 +6,15 @@ import mxnet as mx
 import numpy as np
 import logging
 from ast import literal_eval as make_tuple
+from anchor_index import AnchorIndex
 
 class MultiBoxTarget(mx.operator.CustomOp):
     """
     Python implementation of MultiBoxTarget layer.
     """
     def __init__(self, th_iou, th_iou_neg, th_nms_neg, th_small, square_bb, per_cls_reg,
-            reg_sample_ratio, hard_neg_ratio, variances, ignore_labels):
+            reg_sample_ratio, hard_neg_ratio, variances, ignore_labels, match_engine='legacy',
+            use_anchor_index=True):
         #
         super(MultiBoxTarget, self).__init__()
         self.th_iou = th_iou
@@ -25,12 +27,21 @@ class MultiBoxTarget(mx.operator.CustomOp):
         self.hard_neg_ratio = hard_neg_ratio
         self.variances = variances
         self.ignore_labels = ignore_labels
+        # 'legacy': per image, per label matching. 'batch': whole batch in one numpy pass.
+        # per class regression targets are only supported by the legacy path.
+        self.match_engine = match_engine if not per_cls_reg else 'legacy'
+        self.use_anchor_index = use_anchor_index
 
         # precompute nms candidates
         self.anchors = None
         self.nidx_neg = None
         self.anchors_t = None
         self.area_anchors_t = None
+        self.anchors_np_t = None
+        self.area_anchors_np_t = None
+        self.anchor_index = None
+        # ious below this do not change the targets, see _label_iou
+        self.th_prune = max(min(th_iou, th_iou_neg), 0.0)
 
         self.th_anc_overlap = 0.6
 
@@ -60,9 +71,21 @@ class MultiBoxTarget(mx.operator.CustomOp):
             overlaps = _compute_overlap(self.anchors_t, self.area_anchors_t, (0, 0, 1, 1))
             # self.oob_mask = (overlaps <= self.th_anc_overlap)
             self.n_class = nch
+            self.anchors_np_t = np.ascontiguousarray(self.anchors.T.astype(np.float32))
+            self.area_anchors_np_t = (self.anchors_np_t[2] - self.anchors_np_t[0]) * \
+                    (self.anchors_np_t[3] - self.anchors_np_t[1])
+            if self.use_anchor_index:
+                self.anchor_index = AnchorIndex(self.anchors)
         else:
             assert self.anchors.shape == in_data[0].shape[1:]
 
+        if self.match_engine == 'batch':
+            target_cls, target_reg, mask_reg = self._forward_batched(labels_all, probs_bg_cls)
+            self.assign(out_data[0], req[0], mx.nd.array(target_reg, ctx=in_data[2].context))
+            self.assign(out_data[1], req[1], mx.nd.array(mask_reg, ctx=in_data[2].context))
+            self.assign(out_data[2], req[2], mx.nd.array(target_cls, ctx=in_data[2].context))
+            return
+
         # numpy arrays for outputs of the layer
         target_reg = np.zeros((n_batch, n_anchors, 4), dtype=np.float32)
         mask_reg = np.zeros_like(target_reg)
@@ -103,6 +126,123 @@ class MultiBoxTarget(mx.operator.CustomOp):
         for i, r in enumerate(req):
             self.assign(in_grad[i], r, 0)
 
+    def _forward_batched(self, labels_all, probs_bg_cls):
+        '''
+        Batched version of _forward_batch_pos, _forward_batch_neg and _forward_batch_ignore.
+        Produces the same targets as the legacy path, for all images at once.
+
+        labels_all: (n_batch, n_label, 5)
+        probs_bg_cls: (n_batch, n_anchor)
+        '''
+        anchors_t = self.anchors_np_t
+        n_batch = labels_all.shape[0]
+        n_anchors = anchors_t.shape[1]
+
+        target_reg = np.zeros((n_batch, n_anchors, 4), dtype=np.float32)
+        mask_reg = np.zeros_like(target_reg)
+        target_cls = np.full((n_batch, n_anchors), -1, dtype=np.float32)
+
+        # valid labels are the leading rows that are not all -1, as in _get_valid_labels
+        valid = np.cumprod(np.any(labels_all != -1.0, axis=2), axis=1).astype(bool)
+        n_label = int(np.max(np.sum(valid, axis=1))) if valid.size > 0 else 0
+
+        if n_label > 0:
+            labels = labels_all[:, :n_label, :]
+            valid = valid[:, :n_label]
+            boxes = np.reshape(labels[:, :, 1:], (-1, 4))
+            # padded rows are all -1 and give 0/0 here, they are masked out right after.
+            with np.errstate(divide='ignore', invalid='ignore'):
+                if self.square_bb:
+                    lsq = _fit_box_ratio(boxes, 1.0)
+                else:
+                    lsq = _autofit_ratio_batch(boxes)
+            lsq = np.reshape(lsq, (n_batch, n_label, 4))
+            iou = np.zeros((n_batch, n_label, n_anchors), dtype=np.float32)
+            iou[valid] = self._label_iou(lsq[valid], self.th_prune)
+
+            # 'already occupied' test of the legacy path, against the running max of previous labels
+            assigned = np.empty(iou.shape, dtype=bool)
+            max_iou = np.zeros((n_batch, n_anchors), dtype=np.float32)
+            for i in range(n_label):
+                np.greater(iou[:, i], max_iou, out=assigned[:, i])
+                np.maximum(max_iou, iou[:, i], out=max_iou)
+
+            gt_sz = np.maximum(labels[:, :, 3] - labels[:, :, 1], labels[:, :, 4] - labels[:, :, 2])
+            best_iou = np.max(iou, axis=2)
+            active = np.logical_and(valid, labels[:, :, 0] != -1)
+            active[np.logical_and(gt_sz < self.th_small, best_iou < self.th_iou_neg)] = False
+
+            # positive samples, at least one per active label
+            assigned &= iou > self.th_iou
+            assigned &= active[:, :, np.newaxis]
+            fallback = np.logical_and(active, np.any(assigned, axis=2) == False)
+            bidx, lidx = np.where(fallback)
+            if bidx.size > 0:
+                if self.anchor_index is None or self.th_prune == 0:
+                    fiou = iou[bidx, lidx]
+                else:
+                    fiou = self._label_iou(lsq[bidx, lidx])
+                assigned[bidx, lidx, np.argmax(fiou, axis=1)] = True
+
+            # later labels overwrite earlier ones, so each anchor takes the last assigned label
+            has_pos = np.any(assigned, axis=1)
+            last = n_label - 1 - np.argmax(assigned[:, ::-1, :], axis=1)
+            bidx, aidx = np.where(has_pos)
+            gt = labels[bidx, last[bidx, aidx]]
+            target_cls[bidx, aidx] = gt[:, 0].astype(int) + 1
+            rt, rm = _compute_loc_target_batch(gt[:, 1:], self.anchors[aidx, :], self.variances)
+            target_reg[bidx, aidx, :] = rt
+            mask_reg[bidx, aidx, :] = rm
+        else:
+            max_iou = np.zeros((n_batch, n_anchors), dtype=np.float32)
+
+        # negative samples
+        rmask = np.logical_or(max_iou > self.th_iou_neg, target_cls > 0)
+        if self.hard_neg_ratio <= 0:
+            target_cls[rmask == False] = 0
+        else:
+            bg_probs = probs_bg_cls.copy()
+            bg_probs[rmask] = -1.0
+            n_neg_sample = (np.sum(target_cls > 0, axis=1) * self.hard_neg_ratio).astype(int)
+            n_neg_sample = np.maximum(n_neg_sample, 1)
+            # the nms of the legacy path never changes the picking order, so top-k is enough.
+            eidx = np.argsort(bg_probs, axis=1)[:, ::-1]
+            rank_mask = np.arange(n_anchors)[np.newaxis, :] < n_neg_sample[:, np.newaxis]
+            bidx, ridx = np.where(rank_mask)
+            target_cls[bidx, eidx[bidx, ridx]] = 0
+
+        # ignore regions
+        if self.ignore_labels:
+            imask = np.isin(labels_all[:, :, 0], self.ignore_labels)
+            bidx, lidx = np.where(imask)
+            if bidx.size > 0:
+                overlaps = _compute_overlap_batch( \
+                        labels_all[bidx, lidx, 1:], anchors_t, self.area_anchors_np_t)
+                ignored = np.zeros((n_batch, n_anchors), dtype=bool)
+                np.logical_or.at(ignored, bidx, overlaps > self.th_anc_overlap)
+                target_cls[ignored] = -1
+                mask_reg[ignored] = 0
+
+        target_reg = np.reshape(target_reg, (n_batch, -1))
+        mask_reg = np.reshape(mask_reg, (n_batch, -1))
+        target_cls = np.reshape(target_cls, (n_batch, 1, n_anchors))
+        return target_cls, target_reg, mask_reg
+
+    def _label_iou(self, lsq, th_prune=0.0):
+        '''
+        IOUs between labels (n_label, 4) and all anchors, (n_label, n_anchor).
+        With the anchor index, only anchors overlapping a label are computed and the rest are 0.
+        IOUs below th_prune may also be left as 0. Those never pass th_iou or th_iou_neg,
+        so only the argmax for the 'at least one positive' case needs th_prune = 0.
+        '''
+        if self.anchor_index is None:
+            return _compute_iou_batch(lsq[:, np.newaxis, :], self.anchors_np_t, self.area_anchors_np_t)
+        iou = np.zeros((lsq.shape[0], self.anchors_np_t.shape[1]), dtype=np.float32)
+        rows, cols = self.anchor_index.query_pairs(lsq, th_prune)
+        iou[rows, cols] = _compute_iou_batch(lsq[rows], \
+                self.anchors_np_t[:, cols], self.area_anchors_np_t[cols])
+        return iou
+
     def _forward_batch_pos(self, labels, max_cids, target_cls, target_reg, mask_reg):
         '''
         labels: (n_label, 5)
@@ -125,7 +265,10 @@ class MultiBoxTarget(mx.operator.CustomOp):
             else:
                 # lsq = label[1:]
                 lsq = _autofit_ratio(label[1:])
-            iou = _compute_iou(lsq, self.anchors_t, self.area_anchors_t)
+            if self.anchor_index is None:
+                iou = _compute_iou(lsq, self.anchors_t, self.area_anchors_t)
+            else:
+                iou = self._label_iou(np.reshape(lsq, (1, 4)), self.th_prune)[0]
 
             # skip already occupied ones
             iou_mask = iou > max_iou
@@ -142,7 +285,10 @@ class MultiBoxTarget(mx.operator.CustomOp):
             pidx = np.where(np.logical_and(iou_mask, iou > self.th_iou))[0]
             if len(pidx) == 0:
                 # at least one positive sample
-                pidx = [np.argmax(iou)]
+                if self.anchor_index is not None and self.th_prune > 0:
+                    pidx = [np.argmax(self._label_iou(np.reshape(lsq, (1, 4)))[0])]
+                else:
+                    pidx = [np.argmax(iou)]
 
             target_cls[pidx] = gt_cls
             rt, rm = _compute_loc_target(label[1:], self.anchors[pidx, :], self.variances)
@@ -207,8 +353,12 @@ class MultiBoxTarget(mx.operator.CustomOp):
             if self.th_nms_neg < 1.0:
                 # apply nms
                 if len(self.nidx_neg[ii]) == 0:
-                    self.nidx_neg[ii] = _compute_nms_cands( \
-                            self.anchors[ii], self.anchors_t, self.area_anchors_t, self.th_nms_neg)
+                    if self.anchor_index is None:
+                        self.nidx_neg[ii] = _compute_nms_cands( \
+                                self.anchors[ii], self.anchors_t, self.area_anchors_t, self.th_nms_neg)
+                    else:
+                        self.nidx_neg[ii] = _compute_nms_cands_indexed(self.anchors[ii], \
+                                self.anchors_np_t, self.anchor_index, self.th_nms_neg)
                 idx = self.nidx_neg[ii]
                 bg_probs[idx] = -1
             k += 1
@@ -252,6 +402,23 @@ def _compute_nms_cands(anc, anchors_t, area_anchors_t, th_nms):
     iidx = np.where(iou > th_nms)[0]
     return iidx
 
+def _compute_nms_cands_indexed(anc, anchors_t, anchor_index, th_nms):
+    '''
+    _compute_nms_cands, but only for the anchors the index returns.
+    anchors_t: (4, n_anchor) numpy array
+    '''
+    sf = 192.0 / (anc[3] - anc[1])
+    if sf > 1.0:
+        anc = _rescale_anchor(anc, sf)
+        cidx = anchor_index.query(anc, th_nms, scale=sf)
+        anc_t = _rescale_anchor(anchors_t[:, cidx], np.float32(sf))
+    else:
+        cidx = anchor_index.query(anc, th_nms)
+        anc_t = anchors_t[:, cidx]
+    aanc_t = (anc_t[3]-anc_t[1]) * (anc_t[2]-anc_t[0])
+    iou = _compute_iou_batch(anc, anc_t, aanc_t)
+    return cidx[iou > th_nms]
+
 def _compute_iou(label, anchors_t, area_anchors_t):
     #
     iw = mx.nd.minimum(label[2], anchors_t[2]) - mx.nd.maximum(label[0], anchors_t[0])
@@ -262,6 +429,39 @@ def _compute_iou(label, anchors_t, area_anchors_t):
     iou = I / mx.nd.maximum((U - I), 1e-08)
     return iou.asnumpy() # (num_anchors, )
 
+def _compute_iou_batch(labels, anchors_t, area_anchors_t):
+    '''
+    numpy version of _compute_iou, broadcasting labels (..., 4) against anchors_t (4, ...).
+    ex) labels: (n_label, 1, 4), anchors_t: (4, n_anchor) gives (n_label, n_anchor)
+    '''
+    l = labels.astype(np.float32)
+    area_l = ((labels[..., 3] - labels[..., 1]) * (labels[..., 2] - labels[..., 0])).astype(np.float32)
+    # same ops as _compute_iou, done in place
+    I = np.minimum(l[..., 2], anchors_t[2])
+    I -= np.maximum(l[..., 0], anchors_t[0])
+    np.maximum(I, 0, out=I)
+    ih = np.minimum(l[..., 3], anchors_t[3])
+    ih -= np.maximum(l[..., 1], anchors_t[1])
+    np.maximum(ih, 0, out=ih)
+    I *= ih
+    U = np.add(area_l, area_anchors_t, out=ih)
+    U -= I
+    np.maximum(U, np.float32(1e-08), out=U)
+    I /= U
+    return I
+
+def _compute_overlap_batch(boxes, anchors_t, area_anchors_t):
+    '''
+    numpy version of _compute_overlap for many boxes at once.
+    boxes: (n_box, 4), anchors_t: (4, n_anchor), returns (n_box, n_anchor)
+    '''
+    b = boxes.astype(np.float32)
+    iw = np.minimum(b[:, 2:3], anchors_t[2]) - np.maximum(b[:, 0:1], anchors_t[0])
+    ih = np.minimum(b[:, 3:4], anchors_t[3]) - np.maximum(b[:, 1:2], anchors_t[1])
+    I = np.maximum(iw, 0) * np.maximum(ih, 0)
+    overlap = I / np.maximum(area_anchors_t, np.float32(1e-08))
+    return overlap
+
 def _compute_overlap(anchors_t, area_anchors_t, img_shape):
     #
     iw = mx.nd.minimum(img_shape[2], anchors_t[2]) - mx.nd.maximum(img_shape[0], anchors_t[0])
@@ -286,6 +486,20 @@ def _compute_loc_target(gt_bb, bb, variances):
     loc_target[:, 3] = np.log(np.maximum((gt_bb[3] - gt_bb[1]) / ah, np.finfo(np.float32).eps))
     return loc_target / variances, np.ones_like(loc_target)
 
+def _compute_loc_target_batch(gt_bb, bb, variances):
+    '''
+    _compute_loc_target with one gt box per anchor.
+    gt_bb: (n, 4), bb: (n, 4)
+    '''
+    loc_target = np.zeros_like(bb)
+    aw = (bb[:, 2] - bb[:, 0])
+    ah = (bb[:, 3] - bb[:, 1])
+    loc_target[:, 0] = ((gt_bb[:, 2] + gt_bb[:, 0]) - (bb[:, 2] + bb[:, 0])) * 0.5 / aw
+    loc_target[:, 1] = ((gt_bb[:, 3] + gt_bb[:, 1]) - (bb[:, 3] + bb[:, 1])) * 0.5 / ah
+    loc_target[:, 2] = np.log(np.maximum((gt_bb[:, 2] - gt_bb[:, 0]) / aw, np.finfo(np.float32).eps))
+    loc_target[:, 3] = np.log(np.maximum((gt_bb[:, 3] - gt_bb[:, 1]) / ah, np.finfo(np.float32).eps))
+    return loc_target / variances, np.ones_like(loc_target)
+
 def _rescale_anchor(anchors_t, sf):
     ranc = anchors_t.copy()
     ranc[0] = (ranc[0] + ranc[2]) * 0.5
@@ -336,6 +550,27 @@ def _autofit_ratio(bb):
     return res
 
 
+def _autofit_ratio_batch(bb):
+    '''
+    _autofit_ratio for (n, 4) boxes.
+    '''
+    ww = bb[:, 2] - bb[:, 0]
+    hh = bb[:, 3] - bb[:, 1]
+    cx = (bb[:, 0] + bb[:, 2]) / 2.0
+    cy = (bb[:, 1] + bb[:, 3]) / 2.0
+
+    ratio = ww / hh
+    hh = np.where(ratio > 2.0, ww * 0.5, hh)
+    ww = np.where(ratio < 0.5, hh * 0.5, ww)
+
+    res = bb.copy()
+    res[:, 0] = cx - ww * 0.5
+    res[:, 1] = cy - hh * 0.5
+    res[:, 2] = cx + ww * 0.5
+    res[:, 3] = cy + hh * 0.5
+    return res
+
+
 def _expand_target(loc_target, cid, n_cls):
     n_target = loc_target.shape[0]
     loc_target_e = np.zeros((n_target, 4 * n_cls), dtype=np.float32)
@@ -355,7 +590,8 @@ class MultiBoxTargetProp(mx.operator.CustomOpProp):
             th_iou=0.5, th_iou_neg=0.4, th_nms_neg=1.0,
             th_small=0.04, square_bb=False, per_cls_reg=False,
             reg_sample_ratio=1.0, hard_neg_ratio=3.0,
-            variances=(0.1, 0.1, 0.2, 0.2), ignore_labels=''):
+            variances=(0.1, 0.1, 0.2, 0.2), ignore_labels='', match_engine='legacy',
+            anchor_index=True):
         #
         super(MultiBoxTargetProp, self).__init__(need_top_grad=False)
         self.th_iou = float(th_iou)
@@ -375,6 +611,10 @@ class MultiBoxTargetProp(mx.operator.CustomOpProp):
                 self.ignore_labels = [self.ignore_labels,]
         except:
             self.ignore_labels = []
+        assert match_engine in ('legacy', 'batch'), \
+                'match_engine should be legacy or batch, got {}'.format(match_engine)
+        self.match_engine = match_engine
+        self.anchor_index = bool(make_tuple(str(anchor_index)))
 
     def list_arguments(self):
         return ['anchors', 'label', 'probs_cls']
@@ -400,4 +640,4 @@ class MultiBoxTargetProp(mx.operator.CustomOpProp):
                 self.th_iou, self.th_iou_neg, self.th_nms_neg,
                 self.th_small, self.square_bb, self.per_cls_reg,
                 self.reg_sample_ratio, self.hard_neg_ratio,
-                self.variances, self.ignore_labels)
+                self.variances, self.ignore_labels, self.match_engine, self.anchor_index)
@@ -0,0 +1,70 @@
+import argparse
+import tools.find_mxnet
+import mxnet as mx
+import os
+import sys
+from detect.detector import Detector
+from detect.server import DetectionServer, serve_http
+from symbol.symbol_factory import get_symbol
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Serve a detection network over http')
+    parser.add_argument('--network', dest='network', type=str, default='resnet50',
+                        help='which network to use')
+    parser.add_argument('--epoch', dest='epoch', help='epoch of trained model',
+                        default=0, type=int)
+    parser.add_argument('--prefix', dest='prefix', help='trained model prefix',
+                        default=os.path.join(os.getcwd(), 'model', 'ssd_'),
+                        type=str)
+    parser.add_argument('--cpu', dest='cpu', help='(override GPU) use CPU to detect',
+                        action='store_true', default=False)
+    parser.add_argument('--gpu', dest='gpu_id', type=int, default=0,
+                        help='GPU device id to detect with')
+    parser.add_argument('--data-shape', dest='data_shape', type=int, default=512,
+                        help='set image shape')
+    parser.add_argument('--mean-r', dest='mean_r', type=float, default=123,
+                        help='red mean value')
+    parser.add_argument('--mean-g', dest='mean_g', type=float, default=117,
+                        help='green mean value')
+    parser.add_argument('--mean-b', dest='mean_b', type=float, default=104,
+                        help='blue mean value')
+    parser.add_argument('--num-class', dest='num_class', type=int, default=20,
+                        help='number of classes')
+    parser.add_argument('--nms', dest='nms_thresh', type=float, default=0.5,
+                        help='non-maximum suppression threshold, default 0.5')
+    parser.add_argument('--force', dest='force_nms', type=bool, default=True,
+                        help='force non-maximum suppression on different class')
+    parser.add_argument('--deploy', dest='deploy_net', action='store_true', default=False,
+                        help='Load network from json file, rather than from symbol')
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=8,
+                        help='max number of requests in one forward')
+    parser.add_argument('--max-latency', dest='max_latency', type=float, default=10.0,
+                        help='max time in ms a request waits for its batch to be filled')
+    parser.add_argument('--host', dest='host', type=str, default='127.0.0.1',
+                        help='http host')
+    parser.add_argument('--port', dest='port', type=int, default=8080,
+                        help='http port')
+    args = parser.parse_args()
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.cpu:
+        ctx = mx.cpu()
+    else:
+        ctx = mx.gpu(args.gpu_id)
+
+    net = None
+    if not args.deploy_net:
+        net = get_symbol(args.network, args.data_shape, num_classes=args.num_class,
+            nms_thresh=args.nms_thresh, force_nms=args.force_nms)
+    if args.prefix.endswith('_'):
+        prefix = args.prefix + args.network + '_' + str(args.data_shape)
+    else:
+        prefix = args.prefix
+    detector = Detector(net, prefix, args.epoch, args.data_shape,
+                        (args.mean_r, args.mean_g, args.mean_b),
+                        batch_size=args.batch_size, ctx=ctx)
+    with DetectionServer(detector, max_latency_ms=args.max_latency) as server:
+        serve_http(server, args.host, args.port)
+        print(server.stats())
@@ -99,11 +99,13 @@ def get_symbol_train(network, num_classes, from_layers, num_filters, strides, pa
     if use_python_layer:
         neg_ratio = -1 if use_focal_loss else 3
         th_small = 0.04 if not 'th_small' in kwargs else kwargs['th_small']
+        match_engine = 'legacy' if not 'match_engine' in kwargs else kwargs['match_engine']
         cls_probs = mx.sym.SoftmaxActivation(cls_preds, mode='channel')
         tmp = mx.sym.Custom(*[anchor_boxes, label, cls_probs], name='multibox_target',
                 op_type='multibox_target',
                 ignore_labels=ignore_labels,
-                per_cls_reg=per_cls_reg, hard_neg_ratio=neg_ratio, th_small=th_small, square_bb=square_bb)
+                per_cls_reg=per_cls_reg, hard_neg_ratio=neg_ratio, th_small=th_small, square_bb=square_bb,
+                match_engine=match_engine)
     else:
         assert not per_cls_reg
         neg_ratio = -1 if use_focal_loss else 3
@@ -234,6 +236,7 @@ def get_symbol(network, num_classes, from_layers, num_filters, sizes, ratios,
     mimic_fc = 0 if not 'mimic_fc' in kwargs else kwargs['mimic_fc']
     python_anchor = False if not 'python_anchor' in kwargs else kwargs['python_anchor']
     dense_vh = False if not 'dense_vh' in kwargs else kwargs['dense_vh']
+    decode_mode = 'legacy' if not 'decode_mode' in kwargs else kwargs['decode_mode']
 
     kwargs['use_global_stats'] = True
     body = import_module(network).get_symbol(num_classes, **kwargs)
@@ -256,7 +259,8 @@ def get_symbol(network, num_classes, from_layers, num_filters, sizes, ratios,
     ###
     cls_prob = mx.sym.slice_axis(cls_prob, axis=1, begin=1, end=None)
     out = mx.sym.Custom(cls_prob, loc_preds, anchor_boxes, name='detection', op_type='multibox_detection',
-            th_pos=cfg.valid['th_pos'], th_nms=cfg.valid['th_nms'], per_cls_reg=per_cls_reg)
+            th_pos=cfg.valid['th_pos'], th_nms=cfg.valid['th_nms'], per_cls_reg=per_cls_reg,
+            max_detection=nms_topk, decode_mode=decode_mode)
     ###
     # out = mx.contrib.symbol.MultiBoxDetection(*[cls_prob, loc_preds, anchor_boxes], \
     #         name="detection", nms_threshold=nms_thresh, force_suppress=force_suppress,
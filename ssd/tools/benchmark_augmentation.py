@@ -0,0 +1,169 @@
+from __future__ import print_function
+import argparse
+import os
+import sys
+import shutil
+import tempfile
+import time
+import numpy as np
+import cv2
+import mxnet as mx
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from dataset.iterator import DetIter
+from dataset.imdb import Imdb
+from dataset.label_store import LabelStore
+from tools.rand_sampler import RandScaler, RandEraser
+from tools.crop_roi_patch import crop_roi_patch
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark DetIter augmentation')
+    parser.add_argument('--data-shape', dest='data_shape', type=int, default=640,
+                        help='training patch size')
+    parser.add_argument('--image-size', dest='image_size', type=str, default='1024,768',
+                        help='width,height of synthetic images')
+    parser.add_argument('--num-image', dest='num_image', type=int, default=32,
+                        help='number of synthetic images')
+    parser.add_argument('--num-gt', dest='num_gt', type=int, default=16,
+                        help='number of ground truths per image')
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    return parser.parse_args()
+
+
+class SyntheticImdb(Imdb):
+    '''
+    Random jpeg images with random face-like boxes, in a temporary directory.
+    '''
+    def __init__(self, root, num_image, image_wh, num_gt, rng):
+        super(SyntheticImdb, self).__init__('synthetic')
+        self.num_images = num_image
+        self.max_objects = num_gt
+        self._paths = []
+        labels = []
+        ww, hh = image_wh
+        for i in range(num_image):
+            img = rng.randint(0, 256, (hh // 8, ww // 8, 3)).astype(np.uint8)
+            img = cv2.resize(img, (ww, hh), interpolation=cv2.INTER_LINEAR)
+            path = os.path.join(root, '{:06d}.jpg'.format(i))
+            cv2.imwrite(path, img)
+            self._paths.append(path)
+
+            sz = rng.uniform(0.02, 0.2, (num_gt, 1))
+            cxy = rng.uniform(0.2, 0.8, (num_gt, 2))
+            label = np.hstack((np.zeros((num_gt, 1)), cxy - sz / 2, cxy + sz / 2))
+            labels.append(label)
+        self.labels = LabelStore.from_labels(labels, 5)
+
+    def image_path_from_index(self, index):
+        return self._paths[index]
+
+    def label_from_index(self, index):
+        return self.labels[index]
+
+
+def augment_ndarray(det_iter, data, label):
+    '''
+    Previous DetIter augmentation on NDArray, with the settings of det_iter.
+    '''
+    data_shape = det_iter._data_shape
+    if det_iter.is_train and det_iter._rand_sampler:
+        width = data.shape[1]
+        height = data.shape[0]
+        rand_crop = det_iter._rand_sampler.sample(label, (height, width))
+        xmin, ymin, xmax, ymax = np.array(rand_crop[0]).astype(int)
+        data = crop_roi_patch(data.asnumpy(), (xmin, ymin, xmax, ymax))
+        label = rand_crop[1]
+    if det_iter.is_train:
+        interp_methods = [cv2.INTER_LINEAR, cv2.INTER_CUBIC, cv2.INTER_AREA, \
+                          cv2.INTER_NEAREST, cv2.INTER_LANCZOS4]
+    else:
+        interp_methods = [cv2.INTER_LINEAR]
+    interp_method = interp_methods[int(np.random.uniform(0, 1) * len(interp_methods))]
+    data = mx.img.imresize(data, data_shape[1], data_shape[0], interp_method)
+    if det_iter._rand_eraser and det_iter.is_train:
+        label_scaler = np.array((data_shape[0], data_shape[1]))
+        label_scaler = np.tile(np.reshape(label_scaler, (1, -1)), (1, 2))
+        data = mx.nd.array(det_iter._rand_eraser.sample(data.asnumpy(), label[:, 1:] * label_scaler))
+    if det_iter.is_train:
+        valid_mask = np.where(np.any(label != -1, axis=1))[0]
+        if det_iter._rand_mirror:
+            rr = rand_crop[2]
+            if np.random.uniform(0, 1) > 0.5:
+                data = mx.nd.flip(data, axis=1)
+                tmp = rr - label[valid_mask, 1]
+                label[valid_mask, 1] = rr - label[valid_mask, 3]
+                label[valid_mask, 3] = tmp
+    data = mx.nd.transpose(data, (2,0,1))
+    data = data.astype('float32')
+    data = data - mx.nd.array(det_iter._mean_np)
+    return data, label
+
+
+def load_ndarray(det_iter, imdb, index):
+    '''
+    Previous pipeline: mx.img.imdecode and NDArray/numpy conversions at each step.
+    '''
+    with open(imdb.image_path_from_index(index), 'rb') as fp:
+        img = mx.img.imdecode(fp.read())
+    data, _ = augment_ndarray(det_iter, img, imdb.padded_label_from_index(index))
+    data.wait_to_read()
+
+
+def load_numpy(det_iter, imdb, index, out):
+    '''
+    Numpy pipeline, writing into a preallocated buffer.
+    '''
+    det_iter._load_image(index, out)
+
+
+def measure(fn, num_image):
+    '''
+    Returns (ms per image, peak bytes allocated per image).
+    Bytes are numpy/python allocations traced by tracemalloc above the memory in use
+    before each image, NDArray memory of the mxnet storage pool is not included.
+    '''
+    for i in range(num_image):
+        fn(i)  # warm up
+    tic = time.time()
+    for i in range(num_image):
+        fn(i)
+    t = (time.time() - tic) * 1000.0 / num_image
+    if tracemalloc is None or not hasattr(tracemalloc, 'reset_peak'):
+        return t, -1
+
+    tracemalloc.start()
+    peaks = []
+    for i in range(num_image):
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        fn(i)
+        peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    tracemalloc.stop()
+    return t, int(np.mean(peaks))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    rng = np.random.RandomState(args.seed)
+    image_wh = [int(x) for x in args.image_size.split(',')]
+    root = tempfile.mkdtemp()
+    try:
+        imdb = SyntheticImdb(root, args.num_image, image_wh, args.num_gt, rng)
+        rand_scaler = RandScaler(args.data_shape, min_gt_scale=8.0 / args.data_shape)
+        det_iter = DetIter(imdb, 1, args.data_shape, rand_scaler, rand_eraser=RandEraser(),
+                           mean_pixels=[123, 117, 104], rand_mirror=True)
+        out = np.zeros((3, args.data_shape, args.data_shape), dtype=np.float32)
+
+        print('{:>10s} {:>12s} {:>16s}'.format('pipeline', 'ms / image', 'peak MB / image'))
+        for name, fn in (('ndarray', lambda i: load_ndarray(det_iter, imdb, i)),
+                         ('numpy', lambda i: load_numpy(det_iter, imdb, i, out))):
+            t, nbytes = measure(fn, args.num_image)
+            print('{:>10s} {:>12.2f} {:>16.2f}'.format(name, t, nbytes / 1024.0**2))
+    finally:
+        shutil.rmtree(root)
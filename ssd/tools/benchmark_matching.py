@@ -0,0 +1,137 @@
+from __future__ import print_function
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import mxnet as mx
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'layer'))
+from multibox_target_layer import MultiBoxTarget
+
+
+# anchor presets, (data_shape, feature map sizes, sizes, ratios, steps, style)
+# 'ssd' style follows mx.contrib MultiBoxPrior: sizes[0] with all ratios, then other sizes with ratio 1.
+# 'python' style follows layer/multibox_prior_layer.py: all sizes with all ratios, in pixels.
+_SSD300_RATIOS = [[1,2,.5], [1,2,.5,3,1./3], [1,2,.5,3,1./3], [1,2,.5,3,1./3], [1,2,.5], [1,2,.5]]
+_SSD512_RATIOS = [[1,2,.5], [1,2,.5,3,1./3], [1,2,.5,3,1./3], [1,2,.5,3,1./3], \
+        [1,2,.5,3,1./3], [1,2,.5], [1,2,.5]]
+_FACE_SIZES = [[s / 2.0**(1/3.), s, s * 2.0**(1/3.)] for s in [12.0 * 2**i for i in range(6)]]
+_FACE_SIZES[-1] = _FACE_SIZES[-1][:2]
+
+PRESETS = {
+    'ssd300': (300, [38, 19, 10, 5, 3, 1],
+        [[.1, .141], [.2,.272], [.37, .447], [.54, .619], [.71, .79], [.88, .961]],
+        _SSD300_RATIOS, [x / 300.0 for x in [8, 16, 32, 64, 100, 300]], 'ssd'),
+    'ssd512': (512, [64, 32, 16, 8, 4, 2, 1],
+        [[.07, .1025], [.15,.2121], [.3, .3674], [.45, .5196], [.6, .6708], [.75, .8216], [.9, .9721]],
+        _SSD512_RATIOS, [x / 512.0 for x in [8, 16, 32, 64, 128, 256, 512]], 'ssd'),
+    'dilateface384': (384, [96, 48, 24, 12, 6, 3], _FACE_SIZES, [[1.0]] * 6,
+        [2**(2+i) for i in range(6)], 'python'),
+    'dilateface512': (512, [128, 64, 32, 16, 8, 4], _FACE_SIZES, [[1.0]] * 6,
+        [2**(2+i) for i in range(6)], 'python'),
+    'dilateface640': (640, [160, 80, 40, 20, 10, 5], _FACE_SIZES, [[1.0]] * 6,
+        [2**(2+i) for i in range(6)], 'python'),
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark MultiBoxTarget matching')
+    parser.add_argument('--presets', dest='presets', type=str,
+                        default='ssd300,ssd512,dilateface384,dilateface512,dilateface640',
+                        help='comma separated anchor presets, ' + ','.join(sorted(PRESETS)))
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=8,
+                        help='number of images per batch')
+    parser.add_argument('--num-gt', dest='num_gt', type=int, default=32,
+                        help='number of ground truths per image')
+    parser.add_argument('--num-iter', dest='num_iter', type=int, default=5,
+                        help='number of timed forwards')
+    parser.add_argument('--engines', dest='engines', type=str, default='legacy,batch',
+                        help='comma separated match engines')
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def generate_anchors(data_shape, fmap_sizes, sizes, ratios, steps, style):
+    '''
+    Anchors of a preset in normalized coordinates, (n_anchor, 4).
+    '''
+    scale = 1.0 if style == 'ssd' else float(data_shape)
+    anchors = []
+    for fs, s, r, st in zip(fmap_sizes, sizes, ratios, steps):
+        if style == 'ssd':
+            whs = [(s[0] * np.sqrt(ri), s[0] / np.sqrt(ri)) for ri in r]
+            whs += [(si, si) for si in s[1:]]
+        else:
+            whs = [(si * np.sqrt(ri), si / np.sqrt(ri)) for si in s for ri in r]
+        whs = np.array(whs) / scale
+        c = (np.arange(fs) + 0.5) * st / scale
+        cx, cy = np.meshgrid(c, c)
+        cx = np.reshape(cx, (-1, 1))
+        cy = np.reshape(cy, (-1, 1))
+        anc = np.stack([cx - whs[:, 0] / 2, cy - whs[:, 1] / 2, \
+                cx + whs[:, 0] / 2, cy + whs[:, 1] / 2], axis=2)
+        anchors.append(np.reshape(anc, (-1, 4)))
+    return np.vstack(anchors).astype(np.float32)
+
+
+def generate_labels(batch_size, num_gt, data_shape, rng):
+    '''
+    Random face-like boxes, (batch_size, num_gt, 6), mostly small ones.
+    '''
+    labels = np.full((batch_size, num_gt, 6), -1, dtype=np.float32)
+    for i in range(batch_size):
+        sz = np.exp(rng.uniform(np.log(8.0), np.log(data_shape / 2.0), num_gt)) / data_shape
+        cx = rng.uniform(0, 1, num_gt)
+        cy = rng.uniform(0, 1, num_gt)
+        labels[i, :, 0] = 0
+        labels[i, :, 1] = cx - sz * 0.4
+        labels[i, :, 2] = cy - sz * 0.5
+        labels[i, :, 3] = cx + sz * 0.4
+        labels[i, :, 4] = cy + sz * 0.5
+    return labels
+
+
+def benchmark(op, in_data, out_data, num_iter):
+    '''
+    Returns (first forward time, average time of the following forwards) in ms.
+    The first forward builds anchor caches, including the anchor index.
+    '''
+    req = ['write'] * len(out_data)
+    tic = time.time()
+    op.forward(True, req, in_data, out_data, [])
+    mx.nd.waitall()
+    t_first = (time.time() - tic) * 1000.0
+    tic = time.time()
+    for _ in range(num_iter):
+        op.forward(True, req, in_data, out_data, [])
+    mx.nd.waitall()
+    return t_first, (time.time() - tic) * 1000.0 / num_iter
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    rng = np.random.RandomState(args.seed)
+    variances = np.reshape(np.array((0.1, 0.1, 0.2, 0.2)), (1, -1))
+
+    print('{:>14s} {:>9s} {:>7s} {:>6s} {:>12s} {:>12s}'.format( \
+            'preset', 'n_anchor', 'engine', 'index', 'first (ms)', 'avg (ms)'))
+    for preset in args.presets.split(','):
+        data_shape = PRESETS[preset][0]
+        anchors = generate_anchors(*PRESETS[preset])
+        n_anchors = anchors.shape[0]
+        labels = generate_labels(args.batch_size, args.num_gt, data_shape, rng)
+        probs = rng.uniform(0, 1, (args.batch_size, 2, n_anchors)).astype(np.float32)
+        probs /= np.sum(probs, axis=1, keepdims=True)
+        in_data = [mx.nd.array(np.reshape(anchors, (1, -1, 4))), mx.nd.array(labels), mx.nd.array(probs)]
+
+        for engine in args.engines.split(','):
+            for use_index in (False, True):
+                op = MultiBoxTarget(0.5, 0.4, 1.0, 8.0 / data_shape, False, False, 1, 3.0,
+                        variances, [], engine, use_index)
+                out_data = [mx.nd.zeros((args.batch_size, n_anchors * 4)),
+                            mx.nd.zeros((args.batch_size, n_anchors * 4)),
+                            mx.nd.zeros((args.batch_size, 1, n_anchors))]
+                t_first, t_avg = benchmark(op, in_data, out_data, args.num_iter)
+                print('{:>14s} {:>9d} {:>7s} {:>6s} {:>12.1f} {:>12.1f}'.format( \
+                        preset, n_anchors, engine, str(use_index), t_first, t_avg))
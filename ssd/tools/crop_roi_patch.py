@@ -1,10 +1,17 @@
 import mxnet as mx
 import numpy as np
 
-def crop_roi_patch(img, roi):
+def crop_roi_patch(img, roi, as_ndarray=True):
+    '''
+    Crop roi from a (h, w, 3) numpy image, out of image area is padded with 128.
+    Returns a NDArray, or a numpy array if as_ndarray is False
+    (a view of img when roi is inside the image).
+    '''
     hh = img.shape[0]
     ww = img.shape[1]
     if roi[0] >= 0 and roi[1] >= 0 and roi[2] <= ww and roi[3] <= hh:
+        if not as_ndarray:
+            return img[roi[1]:roi[3], roi[0]:roi[2], :]
         patch = mx.img.fixed_crop(mx.nd.array(img), roi[0], roi[1], roi[2]-roi[0], roi[3]-roi[1])
     else:
         try:
@@ -24,6 +31,8 @@ def crop_roi_patch(img, roi):
 
             patch_ = np.full((ph, pw, 3), 128, dtype=np.uint8)
             patch_[up_:bp, lp:rp, :] = img[ui:bi, li:ri, :]
+            if not as_ndarray:
+                return patch_
             patch = mx.nd.array(patch_)
         except:
             import ipdb
@@ -32,4 +41,3 @@ def crop_roi_patch(img, roi):
     # patch = patch.astype('float32')
     # patch = patch - self._mean_pixels
     return patch
-
@@ -28,7 +28,8 @@ def train_net(net, dataset, image_set, devkit_path, batch_size,
               min_obj_size=32.0, use_difficult=False,
               nms_thresh=0.45, force_suppress=False, ovp_thresh=0.5,
               voc07_metric=True, nms_topk=400,
-              iter_monitor=0, monitor_pattern=".*", log_file=None):
+              iter_monitor=0, monitor_pattern=".*", log_file=None,
+              num_workers=0, prefetch_batches=2):
     """
     Wrapper for training phase.
 
@@ -86,6 +87,10 @@ def train_net(net, dataset, image_set, devkit_path, batch_size,
         regex pattern for monitoring network stats
     log_file : str
         log to file if enabled
+    num_workers : int
+        number of data loading processes, 0 to load in the main process
+    prefetch_batches : int
+        number of batches loaded ahead by the data loading processes
     """
     # set up logger
     logging.basicConfig()
@@ -133,11 +138,12 @@ def train_net(net, dataset, image_set, devkit_path, batch_size,
                          rand_eraser=rand_eraser,
                          mean_pixels=mean_pixels, rand_mirror=cfg.train['rand_mirror_prob'] > 0,
                          shuffle=cfg.train['shuffle'], rand_seed=cfg.train['seed'],
-                         is_train=True)
+                         is_train=True, num_workers=num_workers, prefetch_batches=prefetch_batches)
     if val_imdb:
         rand_scaler = RandScaler(patch_size, no_random=True, force_resize=force_resize)
         val_iter = DetIter(val_imdb, batch_size, data_shape[1], rand_scaler,
-                           mean_pixels=mean_pixels, is_train=True)
+                           mean_pixels=mean_pixels, is_train=True,
+                           num_workers=num_workers, prefetch_batches=prefetch_batches)
     else:
         val_iter = None
 
@@ -87,6 +87,10 @@ def parse_args():
                         help='force non-maximum suppression on different class')
     parser.add_argument('--voc07', dest='use_voc07_metric', type=bool, default=True,
                         help='use PASCAL VOC 07 11-point metric')
+    parser.add_argument('--num-workers', dest='num_workers', type=int, default=0,
+                        help='number of data loading processes, 0 to load in the main process')
+    parser.add_argument('--prefetch-batches', dest='prefetch_batches', type=int, default=2,
+                        help='number of batches loaded ahead by the data loading processes')
     args = parser.parse_args()
     return args
 
@@ -119,4 +123,6 @@ if __name__ == '__main__':
               nms_thresh=args.nms_thresh,
               ovp_thresh=args.overlap_thresh,
               force_suppress=args.force_nms,
-              voc07_metric=args.use_voc07_metric)
+              voc07_metric=args.use_voc07_metric,
+              num_workers=args.num_workers,
+              prefetch_batches=args.prefetch_batches)